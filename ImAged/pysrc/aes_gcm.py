@@ -5,6 +5,8 @@ from cryptography.hazmat.backends import default_backend
 import os
 import hmac
 from typing import Tuple
+import metrics
+import tracing
 
 
 class InvalidInputException(Exception):
@@ -222,12 +224,20 @@ class AES_GCM:
             modes.CTR(self._inc32(j0)),
             backend=self._backend
         )
+        ctr_start = time.perf_counter()
         encryptor = cipher.encryptor()
         ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        ctr_end = time.perf_counter()
+        metrics.observe(metrics.STAGE_CTR, ctr_end - ctr_start)
+        tracing.record(metrics.STAGE_CTR, ctr_start, ctr_end, cat="crypto", bytes=len(ciphertext))
         self._perf_data['aes_operations'] += 1
 
         # Our own optimized GHASH implementation
+        ghash_start = time.perf_counter()
         tag = self._ghash_optimized(associated_data, ciphertext)
+        ghash_end = time.perf_counter()
+        metrics.observe(metrics.STAGE_GHASH, ghash_end - ghash_start)
+        tracing.record(metrics.STAGE_GHASH, ghash_start, ghash_end, cat="crypto", bytes=len(ciphertext))
         
         # NIST SP 800-38D: T = GHASH ⊕ E_K(J0)
         # Use cryptography library for single AES block encryption
@@ -238,6 +248,7 @@ class AES_GCM:
 
         total_time = time.perf_counter() - start_time
         self._perf_data['total_encrypt'] += total_time
+        metrics.inc("aes_gcm.encrypt_bytes", len(plaintext))
         
         # V1's tag truncation support
         full_tag = tag.to_bytes(16, 'big')
@@ -262,7 +273,11 @@ class AES_GCM:
         j0 = self._derive_J0(nonce)
 
         # Our own optimized GHASH implementation
+        ghash_start = time.perf_counter()
         computed_tag_val = self._ghash_optimized(associated_data, ciphertext)
+        ghash_end = time.perf_counter()
+        metrics.observe(metrics.STAGE_GHASH, ghash_end - ghash_start)
+        tracing.record(metrics.STAGE_GHASH, ghash_start, ghash_end, cat="crypto", bytes=len(ciphertext))
         
         # NIST SP 800-38D: T = GHASH ⊕ E_K(J0)
         # Use cryptography library for single AES block encryption
@@ -283,12 +298,17 @@ class AES_GCM:
             modes.CTR(self._inc32(j0)),
             backend=self._backend
         )
+        ctr_start = time.perf_counter()
         decryptor = cipher.decryptor()
         plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+        ctr_end = time.perf_counter()
+        metrics.observe(metrics.STAGE_CTR, ctr_end - ctr_start)
+        tracing.record(metrics.STAGE_CTR, ctr_start, ctr_end, cat="crypto", bytes=len(ciphertext))
         self._perf_data['aes_operations'] += 1
 
         total_time = time.perf_counter() - start_time
         self._perf_data['total_decrypt'] += total_time
+        metrics.inc("aes_gcm.decrypt_bytes", len(plaintext))
         
         return plaintext
 
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the ImAged crypto and TTL container paths.
+
+    python benchmark.py run [--quick] [--output results.json]
+    python benchmark.py run --baseline baseline.json
+    python benchmark.py compare baseline.json results.json [--threshold 0.10]
+
+Results are JSON. Compare mode prints each case's median ratio against the
+baseline and exits with status 1 if any case regressed beyond the threshold.
+The image corpus is synthetic and seeded, so runs on the same machine
+measure the same bytes.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SEED = 1337
+AES_SIZES = [64, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+GHASH_SIZES = [64, 1024, 16 * 1024, 64 * 1024]
+CORPUS_SPECS = [
+    ("small", (320, 240), "PNG"),
+    ("photo", (1920, 1080), "JPEG"),
+    ("large", (4000, 3000), "JPEG"),
+    ("alpha", (1024, 1024), "PNG"),
+    ("bitmap", (1280, 960), "BMP"),
+]
+
+
+def _deterministic_bytes(size: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    return rng.randbytes(size)
+
+
+def make_corpus(directory: str, seed: int = DEFAULT_SEED) -> list:
+    """Render a fixed set of synthetic images (gradients, shapes, noise)."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    paths = []
+    for name, (width, height), fmt in CORPUS_SPECS:
+        mode = "RGBA" if name == "alpha" else "RGB"
+        img = Image.linear_gradient("L").resize((width, height)).convert(mode)
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1, y1 = x0 + rng.randrange(1, width // 4), y0 + rng.randrange(1, height // 4)
+            fill = tuple(rng.randrange(256) for _ in range(len(mode)))
+            draw.rectangle([x0, y0, x1, y1], fill=fill)
+        noise = Image.frombytes("L", (width, height), rng.randbytes(width * height)).convert(mode)
+        img = Image.blend(img, noise, 0.15)
+        ext = {"JPEG": ".jpg", "PNG": ".png", "BMP": ".bmp"}[fmt]
+        path = os.path.join(directory, f"{name}{ext}")
+        save_kwargs = {"quality": 90} if fmt == "JPEG" else {}
+        img.save(path, format=fmt, **save_kwargs)
+        paths.append(path)
+    return paths
+
+
+def _measure(fn, min_time: float, max_runs: int, setup=None) -> list:
+    """Run fn until min_time has elapsed (at least once); return per-run seconds.
+
+    One untimed warm-up call runs first so lazily built state (GHASH tables,
+    imports, page cache) doesn't land in the first sample.
+    """
+    fn(setup()) if setup else fn()
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_runs:
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        samples.append(time.perf_counter() - start)
+        if time.perf_counter() >= deadline:
+            break
+    return samples
+
+
+def _summarize(samples: list, nbytes: int = None) -> dict:
+    median = statistics.median(samples)
+    result = {
+        "runs": len(samples),
+        "median_s": median,
+        "min_s": min(samples),
+        "mean_s": statistics.fmean(samples),
+        "stdev_s": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+    if nbytes:
+        result["bytes"] = nbytes
+        result["mb_per_s"] = (nbytes / (1024 * 1024)) / median if median > 0 else None
+    return result
+
+
+def _size_label(size: int) -> str:
+    for unit, factor in (("MB", 1024 * 1024), ("KB", 1024)):
+        if size >= factor:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def bench_aes_gcm(results: dict, sizes: list, seed: int, min_time: float):
+    from aes_gcm import AES_GCM
+
+    key = _deterministic_bytes(32, seed)
+    aad = b"\x00" * 8
+    for size in sizes:
+        data = _deterministic_bytes(size, seed + size)
+        aes = AES_GCM(key)
+        aes.set_enforce_iv_uniqueness(False)
+        nonce = _deterministic_bytes(12, seed)
+        label = _size_label(size)
+
+        samples = _measure(lambda: aes.encrypt(nonce, data, aad), min_time, 50)
+        results[f"aes_gcm.encrypt.{label}"] = _summarize(samples, size)
+
+        sealed = aes.encrypt(nonce, data, aad)
+        samples = _measure(lambda: aes.decrypt(nonce, sealed, aad), min_time, 50)
+        results[f"aes_gcm.decrypt.{label}"] = _summarize(samples, size)
+        del data, sealed
+
+
+def bench_ghash(results: dict, seed: int, min_time: float):
+    from aes_gcm import AES_GCM
+
+    key = _deterministic_bytes(32, seed)
+    samples = _measure(lambda k: AES_GCM(k)._ensure_table_built(), min_time, 20,
+                       setup=lambda: key)
+    results["aes_gcm.table_build"] = _summarize(samples)
+
+    aes = AES_GCM(key)
+    aes._ensure_table_built()
+    for size in GHASH_SIZES:
+        data = _deterministic_bytes(size, seed + size)
+        label = _size_label(size)
+        samples = _measure(lambda: aes._ghash_simple(b"", data), min_time, 200)
+        results[f"ghash.simple.{label}"] = _summarize(samples, size)
+        samples = _measure(lambda: aes._ghash_table_based(b"", data), min_time, 200)
+        results[f"ghash.table.{label}"] = _summarize(samples, size)
+
+
+def bench_kdf(results: dict, seed: int, min_time: float):
+    from crypto import derive_cek, derive_subkey
+
+    salt = _deterministic_bytes(16, seed)
+    samples = _measure(lambda: derive_cek(salt), min_time, 2000)
+    results["crypto.derive_cek"] = _summarize(samples)
+    samples = _measure(lambda: derive_subkey(salt, b"ImAged HDR"), min_time, 2000)
+    results["crypto.derive_subkey"] = _summarize(samples)
+
+
+def bench_container(results: dict, corpus: list, workdir: str, min_time: float):
+    import time_utils
+    from file_manager import TTLFileManager
+
+    manager = TTLFileManager()
+    for src in corpus:
+        name = os.path.basename(src)
+        size = os.path.getsize(src)
+        out_path = os.path.join(workdir, name + ".ttl")
+
+        def create():
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            manager.create_ttl_file(src, int(time.time()) + 3600, out_path)
+
+        samples = _measure(create, min_time, 20)
+        results[f"ttl.create.{name}"] = _summarize(samples, size)
+
+        # Seed the trusted time base locally so the open path measures the
+        # container work rather than an NTP round trip.
+        time_utils.record_ntp_time(time.time())
+        samples = _measure(lambda: manager.open_ttl_file(out_path), min_time, 20)
+        results[f"ttl.open.{name}"] = _summarize(samples, size)
+
+        expiry = iter(itertools.count(int(time.time()) + 7200))
+        samples = _measure(lambda: manager.extend_ttl_file(out_path, next(expiry)), min_time, 200)
+        results[f"ttl.extend.{name}"] = _summarize(samples, size)
+
+
+def _isolate_state(workdir: str) -> dict:
+    """Point the config layer and the per-user state at workdir.
+
+    Must run before the ImAged modules are imported: the user config path
+    is fixed at import. The user's own settings (durable writes, container
+    format, ...) would otherwise apply to the run, and their index.bin
+    would collect entries for the temporary files. Returns the previous
+    environment values for _restore_state.
+    """
+    appdata = os.path.join(workdir, "appdata")
+    os.makedirs(appdata)
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump({"index_path": os.path.join(appdata, "index.bin"), "durable_writes": True}, f)
+    saved = {key: os.environ.get(key) for key in ("APPDATA", "IMAGED_CONFIG")}
+    os.environ["APPDATA"] = appdata
+    os.environ["IMAGED_CONFIG"] = config_path
+    return saved
+
+
+def _restore_state(saved: dict):
+    for key, value in saved.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+def run_benchmarks(args) -> dict:
+    sizes = [s for s in AES_SIZES if s <= args.max_size]
+    if args.quick:
+        sizes = [s for s in sizes if s <= 1024 * 1024]
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="imaged-bench-")
+    saved_env = _isolate_state(workdir)
+    try:
+        suites = {
+            "aes_gcm": lambda: bench_aes_gcm(results, sizes, args.seed, args.min_time),
+            "ghash": lambda: bench_ghash(results, args.seed, args.min_time),
+            "kdf": lambda: bench_kdf(results, args.seed, args.min_time),
+            "ttl": lambda: bench_container(
+                results, make_corpus(workdir, args.seed), workdir, args.min_time
+            ),
+        }
+        for name, suite in suites.items():
+            if args.only and name not in args.only:
+                continue
+            print(f"[bench] {name}", file=sys.stderr)
+            suite()
+    finally:
+        _restore_state(saved_env)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "min_time": args.min_time,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> tuple:
+    rows = []
+    regressions = []
+    base_results = baseline.get("results", {})
+    for name, cur in sorted(current.get("results", {}).items()):
+        base = base_results.get(name)
+        if not base:
+            rows.append((name, None, cur["median_s"], None, "new"))
+            continue
+        ratio = cur["median_s"] / base["median_s"] if base["median_s"] > 0 else float("inf")
+        status = "ok"
+        if ratio > 1.0 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1.0 - threshold:
+            status = "improved"
+        rows.append((name, base["median_s"], cur["median_s"], ratio, status))
+    return rows, regressions
+
+
+def _print_comparison(rows: list, out=sys.stdout):
+    print(f"{'case':<36} {'baseline':>12} {'current':>12} {'ratio':>8}  status", file=out)
+    for name, base, cur, ratio, status in rows:
+        base_s = f"{base * 1000:.3f}ms" if base is not None else "-"
+        ratio_s = f"{ratio:.2f}x" if ratio is not None else "-"
+        print(f"{name:<36} {base_s:>12} {cur * 1000:>10.3f}ms {ratio_s:>8}  {status}", file=out)
+
+
+def _load_json(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ImAged crypto and container benchmarks")
+    sub = parser.add_subparsers(dest="mode", required=True)
+
+    run_p = sub.add_parser("run", help="run the benchmark suite")
+    run_p.add_argument("--output", "-o", help="write JSON results here (default: stdout)")
+    run_p.add_argument("--quick", action="store_true", help="cap AES-GCM sizes at 1 MB")
+    run_p.add_argument("--max-size", type=int, default=AES_SIZES[-1], help="largest AES-GCM payload in bytes")
+    run_p.add_argument("--min-time", type=float, default=0.5, help="minimum seconds spent per case")
+    run_p.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    run_p.add_argument("--only", nargs="+", choices=["aes_gcm", "ghash", "kdf", "ttl"])
+    run_p.add_argument("--baseline", help="compare against this stored result after running")
+    run_p.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown fraction")
+
+    cmp_p = sub.add_parser("compare", help="compare two stored results")
+    cmp_p.add_argument("baseline")
+    cmp_p.add_argument("current")
+    cmp_p.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown fraction")
+
+    args = parser.parse_args(argv)
+
+    if args.mode == "run":
+        report = run_benchmarks(args)
+        text = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(text)
+        else:
+            print(text)
+        if not args.baseline:
+            return 0
+        baseline, current = _load_json(args.baseline), report
+    else:
+        baseline, current = _load_json(args.baseline), _load_json(args.current)
+
+    rows, regressions = compare_results(baseline, current, args.threshold)
+    _print_comparison(rows, out=sys.stderr if args.mode == "run" and not args.output else sys.stdout)
+    if regressions:
+        print(f"{len(regressions)} case(s) regressed by more than {args.threshold:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""
+Cooperative cancellation of backend requests.
+
+The dispatcher binds a threading.Event to every request it runs. Long
+operations poll it at their stage boundaries (between files, between
+read / decrypt / resize) through check() or is_cancelled() and stop
+there; nothing is interrupted mid-stage, so no file or session is left
+half done.
+"""
+
+import contextvars
+import threading
+
+_event = contextvars.ContextVar("imaged_cancel_event", default=None)
+
+
+class Cancelled(Exception):
+    """Raised by check() once the current request has been cancelled."""
+
+
+def bind(event: threading.Event):
+    """Make event the current request's cancel flag; returns a reset token."""
+    return _event.set(event)
+
+
+def unbind(token):
+    _event.reset(token)
+
+
+def current_event():
+    return _event.get()
+
+
+def is_cancelled() -> bool:
+    event = _event.get()
+    return event is not None and event.is_set()
+
+
+def check():
+    if is_cancelled():
+        raise Cancelled("Request cancelled")
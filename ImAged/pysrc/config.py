@@ -1,6 +1,8 @@
-import json, sys, os
+import json, sys, os, threading, time, logging
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 def resource_path(*parts):
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
         base = Path(sys._MEIPASS)
@@ -8,14 +10,135 @@ def resource_path(*parts):
         base = Path(__file__).parent
     return base.joinpath(*parts)
 
+def app_data_dir() -> Path:
+    """Per-user state directory (%APPDATA%/ImAged)."""
+    return Path(os.environ.get("APPDATA", str(Path.home() / "AppData" / "Roaming"))) / "ImAged"
+
+def _user_config_path() -> Path:
+    return app_data_dir() / "config.json"
+
+# Bundled defaults ship next to the backend; user settings saved through
+# SET_CONFIG live under %APPDATA% and override them key by key.
+# IMAGED_CONFIG points the backend at an alternate user config file (used by
+# the load generator to aim NTP at a loopback stub).
 CONFIG_PATH = resource_path("config", "config.json")
+USER_CONFIG_PATH = Path(os.environ["IMAGED_CONFIG"]) if os.environ.get("IMAGED_CONFIG") else _user_config_path()
 
-def load_config() -> dict:
-    if CONFIG_PATH.exists():
-        cfg = json.loads(CONFIG_PATH.read_text())
+# How often (seconds) load_config() stats the files for external edits
+STAT_INTERVAL = 1.0
+
+class ConfigService:
+    """Layered config (bundled defaults + user file) parsed once and cached.
+
+    The merged dict is rebuilt only when a layer's mtime/size changes or
+    after save(); subscribers are called with (config, changed_keys) so
+    long-lived components can pick up new values without re-reading.
+    """
+
+    def __init__(self, layers, stat_interval: float = STAT_INTERVAL):
+        self._layers = [Path(p) for p in layers]
+        self._stat_interval = stat_interval
+        self._lock = threading.RLock()
+        self._config = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._subscribers = []
+
+    def _stat_signature(self) -> tuple:
+        sig = []
+        for path in self._layers:
+            try:
+                st = path.stat()
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    def _read_layers(self) -> dict:
+        merged = {}
+        for path in self._layers:
+            if not path.exists():
+                continue
+            try:
+                layer = json.loads(path.read_text())
+            except ValueError as e:
+                raise ValueError(f"Invalid JSON in {path}: {e}")
+            if isinstance(layer, dict):
+                merged.update(layer)
+        if merged:
+            validate_config(merged)
+        return merged
+
+    def get(self) -> dict:
+        """Return a copy of the merged config, reloading if a file changed."""
+        now = time.monotonic()
+        with self._lock:
+            if self._config is None or now - self._checked_at >= self._stat_interval:
+                self._checked_at = now
+                signature = self._stat_signature()
+                if self._config is None or signature != self._signature:
+                    try:
+                        self._reload(signature)
+                    except ValueError as e:
+                        if self._config is None:
+                            raise
+                        # Keep serving the last good config until the file is fixed
+                        self._signature = signature
+                        logger.error(f"Ignoring invalid configuration: {e}")
+            return dict(self._config)
+
+    def _reload(self, signature):
+        new_config = self._read_layers()
+        old_config = self._config
+        self._config = new_config
+        self._signature = signature
+        if old_config is not None:
+            changed = {k for k in set(old_config) | set(new_config) if old_config.get(k) != new_config.get(k)}
+            if changed:
+                logger.info("Configuration changed: %s", ", ".join(sorted(changed)))
+                self._notify(changed)
+
+    def invalidate(self):
+        """Force the next get() to re-stat the layers."""
+        with self._lock:
+            self._checked_at = 0.0
+            self._signature = None
+
+    def save(self, cfg: dict, path: Path = None):
         validate_config(cfg)
-        return cfg
-    return {}
+        path = Path(path) if path else self._layers[-1]
+        with self._lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(cfg, indent=2))
+            self.invalidate()
+        self.get()
+
+    def subscribe(self, callback):
+        """Register callback(config, changed_keys); returns it for unsubscribe."""
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _notify(self, changed: set):
+        config = dict(self._config)
+        for callback in list(self._subscribers):
+            try:
+                callback(config, changed)
+            except Exception as e:
+                logger.error(f"Config subscriber {callback!r} failed: {e}")
+
+service = ConfigService([CONFIG_PATH, USER_CONFIG_PATH])
+
+def load_config() -> dict:
+    return service.get()
+
+def subscribe(callback):
+    return service.subscribe(callback)
 
 def validate_config(config: dict):
     required_fields = ["ntp_server", "default_ttl_hours"]
@@ -34,8 +157,54 @@ def validate_config(config: dict):
     if not isinstance(ttl_hours, (int, float)) or ttl_hours <= 0:
         raise ValueError("default_ttl_hours must be a positive number")
 
+    version = config.get("container_version")
+    if version is not None and version not in (1, 2):
+        raise ValueError("container_version must be 1 or 2")
+
+    wrapping = config.get("key_wrapping")
+    if wrapping is not None and not isinstance(wrapping, bool):
+        raise ValueError("key_wrapping must be true or false")
+
+    min_saving = config.get("transcode_min_saving")
+    if min_saving is not None and (not isinstance(min_saving, (int, float)) or not 0 <= min_saving < 1):
+        raise ValueError("transcode_min_saving must be between 0 and 1")
+
+    for key in ("pyramid_levels", "pyramid_min_size"):
+        value = config.get(key)
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise ValueError(f"{key} must be a positive integer")
+    if config.get("pyramid_levels", 0) > 8:
+        raise ValueError("pyramid_levels must be at most 8")
+
+    tile_size = config.get("tile_size")
+    if tile_size is not None and (not isinstance(tile_size, int) or not 64 <= tile_size <= 65535):
+        raise ValueError("tile_size must be an integer between 64 and 65535")
+
+    for key in ("durable_writes", "exif_thumbnails"):
+        value = config.get(key)
+        if value is not None and not isinstance(value, bool):
+            raise ValueError(f"{key} must be true or false")
+
+    group_size = config.get("group_commit_max_files")
+    if group_size is not None and (not isinstance(group_size, int) or group_size <= 0):
+        raise ValueError("group_commit_max_files must be a positive integer")
+
+    window = config.get("group_commit_window_ms")
+    if window is not None and (not isinstance(window, (int, float)) or window < 0):
+        raise ValueError("group_commit_window_ms must be a non-negative number")
+
+    for key in ("pipeline_workers", "pipeline_read_ahead", "atlas_cache_entries", "atlas_cache_seconds"):
+        value = config.get(key)
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise ValueError(f"{key} must be a positive integer")
+
+    policy = config.get("expiry_policy")
+    if policy is not None and policy not in ("report", "quarantine", "delete"):
+        raise ValueError("expiry_policy must be one of report, quarantine, delete")
+
+    thumb_size = config.get("thumbnail_max_size")
+    if thumb_size is not None and (not isinstance(thumb_size, int) or thumb_size <= 0):
+        raise ValueError("thumbnail_max_size must be a positive integer")
+
 def save_config(cfg: dict):
-    validate_config(cfg)
-    appdir = Path(os.environ.get("APPDATA", str(Path.home() / "AppData" / "Roaming"))) / "ImAged"
-    appdir.mkdir(parents=True, exist_ok=True)
-    (appdir / "config.json").write_text(json.dumps(cfg, indent=2))
\ No newline at end of file
+    service.save(cfg)
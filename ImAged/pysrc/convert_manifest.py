@@ -0,0 +1,163 @@
+"""
+Source manifest for incremental batch conversion.
+
+Maps every converted source image to the container produced from it:
+
+    {source key: {"size", "mtime_ns", "sha256", "output", "converted_at"}}
+
+A source whose size and mtime still match its entry, and whose container
+still exists, is skipped without being read. If only the mtime moved
+(copied or touched files) the content hash decides. Like the TTL index the
+manifest is stored encrypted, since it links file names to each other.
+
+    manifest.bin: MANIFEST_MAGIC | salt(16) | nonce(12) | AESGCM(zlib(json))
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import config
+from crypto import derive_subkey
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_MAGIC = b"IMMAN1"
+MANIFEST_INFO = b"ImAged MANIFEST"
+MANIFEST_FORMAT = 1
+HASH_CHUNK = 1024 * 1024
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def _norm(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConvertManifest:
+    def __init__(self, path=None):
+        if path is None:
+            path = config.load_config().get("manifest_path") or (config.app_data_dir() / "manifest.bin")
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._entries = None
+        self._salt = None
+        self._dirty = False
+
+    def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            blob = self.path.read_bytes()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Could not read conversion manifest {self.path}: {e}")
+            return
+        try:
+            if blob[:len(MANIFEST_MAGIC)] != MANIFEST_MAGIC:
+                raise ValueError("bad magic")
+            off = len(MANIFEST_MAGIC)
+            salt, nonce = blob[off:off + 16], blob[off + 16:off + 28]
+            aes = AESGCM(derive_subkey(salt, MANIFEST_INFO))
+            doc = json.loads(zlib.decompress(aes.decrypt(nonce, blob[off + 28:], MANIFEST_MAGIC)))
+            if doc.get("format") != MANIFEST_FORMAT:
+                raise ValueError(f"unsupported format {doc.get('format')}")
+            self._entries = doc.get("entries", {})
+            self._salt = salt
+        except Exception as e:
+            # Losing the manifest only costs one full re-conversion
+            logger.warning(f"Discarding unreadable conversion manifest {self.path}: {e}")
+            self._entries = {}
+
+    def flush(self):
+        """Write the manifest if it changed (temp file + atomic replace)."""
+        with self._lock:
+            if not self._dirty or self._entries is None:
+                return
+            if self._salt is None:
+                self._salt = os.urandom(16)
+            payload = zlib.compress(json.dumps(
+                {"format": MANIFEST_FORMAT, "entries": self._entries}, separators=(",", ":")
+            ).encode("utf-8"))
+            nonce = os.urandom(12)
+            sealed = AESGCM(derive_subkey(self._salt, MANIFEST_INFO)).encrypt(nonce, payload, MANIFEST_MAGIC)
+            self._dirty = False
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(MANIFEST_MAGIC + self._salt + nonce + sealed)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write conversion manifest {self.path}: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def check(self, source: str) -> tuple:
+        """Classify a source as NEW, CHANGED or UNCHANGED.
+
+        Returns (status, previous entry or None, sha256 if it was computed).
+        An entry whose container has disappeared counts as NEW.
+        """
+        st = os.stat(source)
+        key = _norm(source)
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.get(key)
+        if entry is None or not os.path.exists(entry["output"]):
+            return NEW, None, None
+        if entry["size"] != st.st_size:
+            return CHANGED, entry, None
+        if entry["mtime_ns"] == st.st_mtime_ns:
+            return UNCHANGED, entry, None
+        digest = file_sha256(source)
+        if digest != entry["sha256"]:
+            return CHANGED, entry, digest
+        with self._lock:
+            entry["mtime_ns"] = st.st_mtime_ns
+            self._dirty = True
+        return UNCHANGED, entry, digest
+
+    def record(self, source: str, output: str, digest: str = None, st=None):
+        """Remember that output was produced from the current source contents."""
+        if st is None:
+            st = os.stat(source)
+        if digest is None:
+            digest = file_sha256(source)
+        with self._lock:
+            self._ensure_loaded()
+            self._entries[_norm(source)] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "sha256": digest,
+                "output": os.path.abspath(output),
+                "converted_at": int(time.time()),
+            }
+            self._dirty = True
+
+    def forget(self, source: str) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            if self._entries.pop(_norm(source), None) is None:
+                return False
+            self._dirty = True
+            return True
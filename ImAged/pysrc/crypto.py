@@ -1,9 +1,14 @@
 import logging
 from pathlib import Path
 import os, sys
+import time
+import metrics
+import tracing
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+logger = logging.getLogger(__name__)
+
 def resource_path(*parts):
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
         base = Path(sys._MEIPASS)
@@ -22,15 +27,15 @@ def _load_or_create_static_master_key() -> bytes:
             key = raw if len(raw) == 32 else raw[:32]
             if len(key) != 32:
                 raise ValueError(f"master.key must be 32 bytes (got {len(key)})")
-            logging.info("Loaded static MASTER_KEY from %s", path)
+            logger.info("Loaded static MASTER_KEY from %s", path)
             return key
         # Generate a default in memory only (don’t write inside bundle)
         import os
         key = os.urandom(32)
-        logging.warning("master.key not found; generated ephemeral key")
+        logger.warning("master.key not found; generated ephemeral key")
         return key
     except Exception as e:
-        logging.error("Failed to load/create static master key: %s", e)
+        logger.error("Failed to load/create static master key: %s", e)
         raise
 
 MASTER_KEY = _load_or_create_static_master_key()
@@ -39,6 +44,7 @@ def generate_salt(length: int = 16) -> bytes:
     return os.urandom(length)
 
 def derive_cek(salt: bytes, length: int = 32) -> bytes:
+    start = time.perf_counter()
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
         length=length,
@@ -46,14 +52,72 @@ def derive_cek(salt: bytes, length: int = 32) -> bytes:
         info=b"ImAged CEK",
     )
     cek = hkdf.derive(MASTER_KEY)
-    logging.debug("Derived CEK with salt %s", salt.hex())
+    end = time.perf_counter()
+    metrics.observe(metrics.STAGE_HKDF, end - start)
+    tracing.record(metrics.STAGE_HKDF, start, end, cat="crypto")
+    logger.debug("Derived CEK with salt %s", salt.hex())
     return cek
 
 def derive_subkey(salt: bytes, info: bytes, length: int = 32) -> bytes:
+    start = time.perf_counter()
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
         length=length,
         salt=salt,
         info=info,
     )
-    return hkdf.derive(MASTER_KEY)
\ No newline at end of file
+    key = hkdf.derive(MASTER_KEY)
+    end = time.perf_counter()
+    metrics.observe(metrics.STAGE_HKDF, end - start)
+    tracing.record(metrics.STAGE_HKDF, start, end, cat="crypto")
+    return key
+
+def derive_key(ikm: bytes, salt: bytes, info: bytes, length: int = 32) -> bytes:
+    """HKDF-SHA256 over arbitrary input keying material (e.g. a per-file CEK)."""
+    start = time.perf_counter()
+    key = HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(ikm)
+    end = time.perf_counter()
+    metrics.observe(metrics.STAGE_HKDF, end - start)
+    tracing.record(metrics.STAGE_HKDF, start, end, cat="crypto")
+    return key
+
+# Key-encryption keys wrap the random per-file CEKs of wrapped containers.
+# They are derived from a master key and identified by a short hash, so a
+# header records which master key it was wrapped under.
+KEK_INFO = b"ImAged KEK"
+KEK_ID_LEN = 8
+
+def kek_from_master(master_key: bytes) -> bytes:
+    return derive_key(master_key, None, KEK_INFO)
+
+def kek_id(kek: bytes) -> bytes:
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(kek)
+    return digest.finalize()[:KEK_ID_LEN]
+
+def _previous_master_keys_path() -> Path:
+    return resource_path("config", "previous_master.keys")
+
+def _load_previous_master_keys() -> list:
+    # Concatenated 32-byte keys kept while a rotation is in progress, so
+    # files not yet rewrapped stay readable
+    path = _previous_master_keys_path()
+    if not path.exists():
+        return []
+    raw = path.read_bytes()
+    keys = [raw[i:i + 32] for i in range(0, len(raw) - len(raw) % 32, 32)]
+    logger.info("Loaded %d previous master key(s) from %s", len(keys), path)
+    return keys
+
+CURRENT_KEK = kek_from_master(MASTER_KEY)
+CURRENT_KEK_ID = kek_id(CURRENT_KEK)
+KEYRING = {CURRENT_KEK_ID: CURRENT_KEK}
+for _previous in _load_previous_master_keys():
+    _kek = kek_from_master(_previous)
+    KEYRING.setdefault(kek_id(_kek), _kek)
+
+def kek_for_id(key_id: bytes) -> bytes:
+    kek = KEYRING.get(key_id)
+    if kek is None:
+        raise ValueError(f"Unknown key-encryption key {key_id.hex()}")
+    return kek
@@ -0,0 +1,276 @@
+"""
+Crash-safe container writes with group commit.
+
+Every file is assembled in one gathered write (os.writev where available)
+into a temp file next to its destination. Committing fsyncs the temp
+file, moves it into place and fsyncs the directory, so a crash leaves
+either the old file or the complete new one, never a torn one. An
+overwrite renames over the destination; a new file is hard-linked in, so
+a file that appeared at that name since the write is never clobbered and
+the new one takes the next free " (n)" name instead.
+
+The fsyncs are what make this slow, so commits are grouped:
+
+  - writers that arrive while a commit is running queue up and the next
+    commit takes them all at once; group_commit_window_ms makes the
+    writer that starts a commit wait that long for others to join;
+  - batch callers pass defer=True and call flush() once at the end, with
+    a commit forced every group_commit_max_files files to bound the
+    number of open temp files;
+  - a group's file fsyncs are issued together from a small thread pool,
+    so the filesystem can fold them into shared journal commits, then
+    each directory is fsynced once for the whole group.
+
+With durable_writes off the temp file + rename is kept (no torn files)
+but nothing is fsynced.
+"""
+
+import errno
+import logging
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_FILES = 64
+# fsyncs in flight at once while committing a group
+FSYNC_WORKERS = 8
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+def write_all(fd: int, parts) -> int:
+    """Write a list of buffers to fd, gathered where the OS supports it."""
+    views = [memoryview(p) for p in parts if len(p)]
+    total = sum(v.nbytes for v in views)
+    if hasattr(os, "writev"):
+        i = 0
+        while i < len(views):
+            written = os.writev(fd, views[i:i + IOV_MAX])
+            # Advance past fully written buffers, trim a partial one
+            while written and i < len(views):
+                if written >= views[i].nbytes:
+                    written -= views[i].nbytes
+                    i += 1
+                else:
+                    views[i] = views[i][written:]
+                    written = 0
+    else:
+        for view in views:
+            while view.nbytes:
+                view = view[os.write(fd, view):]
+    return total
+
+
+def fsync_file(fd: int):
+    os.fsync(fd)
+
+
+def fsync_directory(directory: str):
+    # Makes the rename itself durable; directories cannot be opened on Windows
+    if os.name == "nt":
+        return
+    fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def link_new(tmp_path: str, path: str) -> str:
+    """Move tmp_path to path without replacing anything; returns the name used.
+
+    Takes path, or the first free " (n)" sibling if something exists there.
+    """
+    p = Path(path)
+    candidate = path
+    n = 1
+    while True:
+        try:
+            os.link(tmp_path, candidate)
+        except FileExistsError:
+            candidate = str(p.with_name(f"{p.stem} ({n}){p.suffix}"))
+            n += 1
+            continue
+        except OSError as e:
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EXDEV, errno.EMLINK):
+                raise
+            # No hard links here: reserve the name, then rename over it
+            try:
+                os.close(os.open(candidate, os.O_WRONLY | os.O_CREAT | os.O_EXCL | _O_BINARY, 0o666))
+            except FileExistsError:
+                candidate = str(p.with_name(f"{p.stem} ({n}){p.suffix}"))
+                n += 1
+                continue
+            os.replace(tmp_path, candidate)
+            return candidate
+        os.remove(tmp_path)
+        return candidate
+
+
+class PendingWrite:
+    __slots__ = ("path", "tmp_path", "fd", "overwrite", "on_commit", "done", "error")
+
+    def __init__(self, path, tmp_path, fd, on_commit, overwrite: bool = True):
+        self.path = path
+        self.tmp_path = tmp_path
+        self.fd = fd
+        self.overwrite = overwrite
+        self.on_commit = on_commit
+        self.done = threading.Event()
+        self.error = None
+
+    def result(self) -> str:
+        """Wait for the commit; returns the final path or raises its error."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+
+class GroupCommitter:
+    def __init__(self, durable: bool = None, max_files: int = None, window: float = None):
+        cfg = config.load_config()
+        self.durable = cfg.get("durable_writes", True) if durable is None else durable
+        self.max_files = max_files or cfg.get("group_commit_max_files", DEFAULT_MAX_FILES)
+        self.window = cfg.get("group_commit_window_ms", 0) / 1000 if window is None else window
+        self._cond = threading.Condition()
+        self._pending = []
+        self._committing = False
+        self._fsync_pool = None
+
+    def write(self, path: str, parts, on_commit=None, defer: bool = False,
+              overwrite: bool = True) -> PendingWrite:
+        """Write parts as the new contents of path.
+
+        Blocks until the file is committed unless defer is set, in which
+        case it is committed by a later flush() (or once max_files writes
+        are pending). Without overwrite an existing file is left alone and
+        the write lands on a " (n)" sibling; PendingWrite.path is the final
+        name once committed. on_commit(path) runs after the file is in place.
+        """
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | _O_BINARY, 0o666)
+        try:
+            size = write_all(fd, parts)
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp_path)
+            raise
+        metrics.inc("bytes.io.write", size)
+        item = PendingWrite(path, tmp_path, fd, on_commit, overwrite)
+        with self._cond:
+            self._pending.append(item)
+            if defer and len(self._pending) < self.max_files:
+                return item
+            if self._committing:
+                if defer:
+                    return item
+                leader = False
+            else:
+                self._committing = True
+                leader = True
+        if leader:
+            if self.window and not defer:
+                time.sleep(self.window)
+            self._drain()
+        if not defer:
+            item.result()
+        return item
+
+    def flush(self):
+        """Commit everything pending, including writes deferred by others."""
+        with self._cond:
+            while self._committing:
+                self._cond.wait()
+            if not self._pending:
+                return
+            self._committing = True
+        self._drain()
+
+    def _drain(self):
+        # Runs in whichever writer found no commit in progress; keeps going
+        # while others queue up behind it
+        while True:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._committing = False
+                    self._cond.notify_all()
+                    return
+            self._commit(batch)
+
+    def _sync_all(self, fn, args) -> list:
+        """Run fn over args, concurrently for more than one; returns errors."""
+        def run(arg):
+            try:
+                fn(arg)
+            except OSError as e:
+                return e
+            return None
+        if len(args) < 2:
+            return [run(arg) for arg in args]
+        if self._fsync_pool is None:
+            self._fsync_pool = ThreadPoolExecutor(FSYNC_WORKERS, thread_name_prefix="imaged-fsync")
+        return list(self._fsync_pool.map(run, args))
+
+    def _commit(self, batch):
+        start = time.perf_counter()
+        if self.durable:
+            for item, error in zip(batch, self._sync_all(fsync_file, [item.fd for item in batch])):
+                item.error = error
+        directories = set()
+        for item in batch:
+            os.close(item.fd)
+            if item.error is None:
+                try:
+                    if item.overwrite:
+                        os.replace(item.tmp_path, item.path)
+                    else:
+                        item.path = link_new(item.tmp_path, item.path)
+                    directories.add(os.path.dirname(os.path.abspath(item.path)))
+                except OSError as e:
+                    item.error = e
+            if item.error is not None:
+                logger.error(f"Could not commit {item.path}: {item.error}")
+                try:
+                    os.remove(item.tmp_path)
+                except OSError:
+                    pass
+        if self.durable:
+            directories = sorted(directories)
+            for directory, error in zip(directories, self._sync_all(fsync_directory, directories)):
+                if error is not None:
+                    logger.warning(f"Could not fsync directory {directory}: {error}")
+        metrics.inc("io.group_commits")
+        metrics.inc("io.committed_files", len(batch))
+        metrics.observe("io.commit", time.perf_counter() - start)
+        for item in batch:
+            if item.error is None and item.on_commit is not None:
+                try:
+                    item.on_commit(item.path)
+                except Exception as e:
+                    logger.error(f"Commit callback for {item.path} failed: {e}")
+            item.done.set()
+
+
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def get_committer() -> GroupCommitter:
+    global _committer
+    with _committer_lock:
+        if _committer is None:
+            _committer = GroupCommitter()
+        return _committer
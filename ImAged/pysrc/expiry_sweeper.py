@@ -0,0 +1,213 @@
+"""
+Background expiry sweeper.
+
+Keeps a min-heap of (expiry_ts, path) for every indexed TTL file, fed by
+the TTL index as entries are added, changed or dropped. A single thread
+sleeps until the earliest expiry in trusted (NTP-anchored) time, then
+handles everything that is due as one batch under expiry_policy:
+
+    report       log and notify listeners only (default)
+    quarantine   move the file into expiry_quarantine_dir
+    delete       remove the file
+
+Superseded heap items are skipped lazily when popped, so scheduling and
+rescheduling are O(log n) and no directory is ever rescanned.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import threading
+import time
+
+import config
+import metrics
+import ttl_format
+import ttl_index
+from time_utils import get_current_time_with_fallback
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("report", "quarantine", "delete")
+DEFAULT_POLICY = "report"
+# Upper bound on one sleep, so a refreshed NTP base is picked up
+MAX_SLEEP = 300.0
+# Retry delay when trusted time is unavailable
+TIME_RETRY = 30.0
+
+
+class ExpirySweeper:
+    def __init__(self, index: ttl_index.TTLIndex = None):
+        self._index = index or ttl_index.get_index()
+        self._heap = []
+        self._scheduled = {}  # key -> expiry_ts currently in force
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._listeners = []
+        self._thread = None
+        self._stopped = False
+
+    # -- scheduling ------------------------------------------------------
+
+    def schedule(self, path: str, expiry_ts: int):
+        with self._cond:
+            if self._scheduled.get(path) == expiry_ts:
+                return
+            self._scheduled[path] = expiry_ts
+            heapq.heappush(self._heap, (expiry_ts, next(self._counter), path))
+            if self._heap[0][2] == path:
+                self._cond.notify()
+
+    def unschedule(self, path: str):
+        with self._cond:
+            self._scheduled.pop(path, None)
+
+    def next_expiry(self):
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._scheduled)
+
+    def _on_index_changes(self, changes):
+        for key, entry in changes:
+            if entry is None or not entry.get("valid") or entry.get("expiry") is None:
+                self.unschedule(key)
+            else:
+                self.schedule(key, entry["expiry"])
+
+    def _drop_stale(self):
+        heap = self._heap
+        while heap and self._scheduled.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    # -- listeners -------------------------------------------------------
+
+    def add_listener(self, callback):
+        """Register callback(batch) with batch = [{"path", "expiry", "action"}]."""
+        with self._cond:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    # -- sweeping --------------------------------------------------------
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._index.add_listener(self._on_index_changes)
+            self._thread = threading.Thread(target=self._run, name="imaged-expiry", daemon=True)
+            self._thread.start()
+        self._on_index_changes(self._index.items())
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread, self._thread = self._thread, None
+        self._index.remove_listener(self._on_index_changes)
+        if thread is not None:
+            thread.join(timeout=2)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._drop_stale()
+                while not self._stopped and not self._heap:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                next_ts = self._heap[0][0]
+            try:
+                now, _ = get_current_time_with_fallback()
+            except RuntimeError as e:
+                logger.warning(f"Expiry sweeper has no trusted time: {e}")
+                with self._cond:
+                    self._cond.wait(TIME_RETRY)
+                continue
+            if next_ts > now:
+                # A schedule() of an earlier expiry or stop() wakes us early
+                with self._cond:
+                    self._cond.wait(min(next_ts - now, MAX_SLEEP))
+                continue
+            self._sweep(now)
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                expiry_ts, _, path = heapq.heappop(self._heap)
+                if self._scheduled.get(path) == expiry_ts:
+                    del self._scheduled[path]
+                    due.append((path, expiry_ts))
+        return due
+
+    def _sweep(self, now: float):
+        due = self._pop_due(now)
+        if not due:
+            return
+        policy = config.load_config().get("expiry_policy", DEFAULT_POLICY)
+        batch = []
+        for path, expiry_ts in due:
+            # The index may lag behind the disk; trust only the header itself
+            try:
+                actual = ttl_format.peek_header(path, allow_legacy=True).expiry
+            except (OSError, ValueError):
+                continue
+            if actual > now:
+                self.schedule(path, actual)
+                continue
+            batch.append({"path": path, "expiry": actual, "action": self._apply_policy(policy, path)})
+        if not batch:
+            return
+        metrics.inc("expiry.swept", len(batch))
+        logger.info("Expired %d file(s) (policy: %s)", len(batch), policy)
+        for callback in list(self._listeners):
+            try:
+                callback(batch)
+            except Exception as e:
+                logger.error(f"Expiry listener {callback!r} failed: {e}")
+
+    def _apply_policy(self, policy: str, path: str) -> str:
+        try:
+            if policy == "delete":
+                os.remove(path)
+                self._index.forget(path)
+                return "deleted"
+            if policy == "quarantine":
+                target_dir = config.load_config().get("expiry_quarantine_dir") or str(config.app_data_dir() / "quarantine")
+                os.makedirs(target_dir, exist_ok=True)
+                target = os.path.join(target_dir, os.path.basename(path))
+                base, ext = os.path.splitext(target)
+                n = 1
+                while os.path.exists(target):
+                    target = f"{base} ({n}){ext}"
+                    n += 1
+                shutil.move(path, target)
+                self._index.forget(path)
+                return "quarantined"
+        except OSError as e:
+            logger.error(f"Expiry policy {policy} failed for {path}: {e}")
+            return "failed"
+        return "reported"
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def get_sweeper() -> ExpirySweeper:
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = ExpirySweeper()
+        return _sweeper
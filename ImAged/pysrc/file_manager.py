@@ -10,233 +10,605 @@ from config import load_config
 from crypto import derive_cek, derive_subkey
 from time_utils import get_current_time_with_fallback, validate_expiry_time
 from aes_gcm import AES_GCM
+import cancellation
+import durable_io
+import metrics
+import tracing
+import ttl_format
+from ttl_format import MAGIC
+from logging_setup import SAMPLED
+
+logger = logging.getLogger(__name__)
+
+# Source types picked up when a whole directory is converted
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+
+def find_images(directory: str, recursive: bool = False) -> List[str]:
+    found = []
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for de in it:
+                    if recursive and de.is_dir(follow_symlinks=False):
+                        stack.append(de.path)
+                    elif de.name.lower().endswith(IMAGE_EXTENSIONS) and de.is_file():
+                        found.append(de.path)
+        except OSError as e:
+            if current == directory:
+                raise
+            # One unreadable subdirectory should not sink the whole batch
+            logger.warning(f"Skipping {e.filename}: {e.strerror}")
+    found.sort()
+    return found
 
-MAGIC = b"IMAGED"
 
 class TTLFileManager:    
-    def __init__(self):
-        self.cfg = load_config()
+    @property
+    def cfg(self) -> dict:
+        # Served from the config service cache; reflects SET_CONFIG and edits
+        return load_config()
     
-    def _log_timing(self, step_name, start_time, data_size=None):
-        elapsed = time.time() - start_time
+    def _log_timing(self, stage, start_time, data_size=None):
+        end_time = time.perf_counter()
+        elapsed = end_time - start_time
+        metrics.observe(stage, elapsed)
+        tracing.record(stage, start_time, end_time, cat="ttl")
         if data_size:
-            size_mb = data_size / (1024 * 1024)
-            speed = size_mb / elapsed if elapsed > 0 else 0
-            message = f"{step_name}: {elapsed:.3f}s | {size_mb:.2f} MB | {speed:.2f} MB/s"
-        else:
-            message = f"{step_name}: {elapsed:.3f}s"
-        
-        logging.info(message)
-        print(f"  {message}")
+            metrics.inc(f"bytes.{stage}", data_size)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %.3fs%s", stage, elapsed, f" | {data_size} bytes" if data_size else "")
+
+    def _unique_path(self, path: str, taken: set = None) -> str:
+        """Return a non-conflicting file path by appending " (n)" if needed.
 
-    def _unique_path(self, path: str) -> str:
-        """Return a non-conflicting file path by appending " (n)" if needed."""
+        Names in use come from one directory listing, or from taken (a set
+        of normcased names a batch keeps current), instead of one exists()
+        probe per candidate. The chosen name is added to taken.
+        """
         p = Path(path)
+        if taken is None:
+            if not p.exists():
+                return str(p)
+            taken = self._names_in(p.parent)
         candidate = p
         n = 1
-        while candidate.exists():
+        while os.path.normcase(candidate.name) in taken:
             candidate = p.with_name(f"{p.stem} ({n}){p.suffix}")
             n += 1
+        taken.add(os.path.normcase(candidate.name))
         return str(candidate)
+
+    @staticmethod
+    def _same_dir(a: str, b: str) -> bool:
+        return (os.path.normcase(os.path.dirname(os.path.abspath(a)))
+                == os.path.normcase(os.path.dirname(os.path.abspath(b))))
+
+    @staticmethod
+    def _names_in(directory) -> set:
+        try:
+            with os.scandir(directory or ".") as it:
+                return {os.path.normcase(de.name) for de in it}
+        except FileNotFoundError:
+            return set()
+
+    def _default_output_path(self, input_path: str, out_dir: str = None) -> str:
+        if out_dir is None:
+            out_dir = self.cfg.get("output_dir", "")
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            return str(Path(out_dir) / f"{Path(input_path).stem}.ttl")
+        return str(Path(input_path).with_suffix(".ttl"))
     
-    def create_ttl_file(self, input_path: str, expiry_ts: int = None, output_path: str = None) -> str:
+    def create_ttl_file(self, input_path: str, expiry_ts: int = None, output_path: str = None,
+                        overwrite: bool = False, taken: set = None, commit_group: list = None) -> str:
+        """Encrypt an image into a new container and return its path.
+
+        Without overwrite an existing output_path gets a " (n)" sibling;
+        with it the file is replaced. Either way the container appears
+        atomically (temp file + rename). Given a commit_group list the
+        write is deferred to the next durable_io flush and its PendingWrite
+        is appended to the list; its path is final only once committed.
+        """
         import time
         import struct
         
-        total_start = time.time()
-        print(f"Starting TTL creation process")
-        logging.info(f"Starting TTL creation process")
+        total_start = time.perf_counter()
+        logger.debug("Starting TTL creation process")
         
         default_h = self.cfg.get("default_ttl_hours", 1)
-        out_dir = self.cfg.get("output_dir", "")
-        logging.info("create_ttl_file: %s (default %dh)", input_path, default_h)
+        logger.debug("create_ttl_file: %s (default %dh)", input_path, default_h)
 
         if expiry_ts is None:
             expiry_ts = int(time.time() + default_h * 3600)
 
-        stem = Path(input_path).stem
         if output_path is None:
-            if out_dir:
-                os.makedirs(out_dir, exist_ok=True)
-                output_path = str(Path(out_dir) / f"{stem}.ttl")
-            else:
-                output_path = str(Path(input_path).with_suffix(".ttl"))
+            output_path = self._default_output_path(input_path)
 
-        # Ensure we don't overwrite an existing TTL file
-        output_path = self._unique_path(output_path)
+        if not overwrite:
+            # Ensure we don't overwrite an existing TTL file
+            output_path = self._unique_path(output_path, taken)
 
         # Prepare payload bytes (use original bytes; QOI removed)
-        step_start = time.time()
+        step_start = time.perf_counter()
         with open(input_path, "rb") as src_f:
             payload_data = src_f.read()
-        self._log_timing("Prepare payload", step_start, len(payload_data))
+        self._log_timing(metrics.STAGE_READ, step_start, len(payload_data))
         
-        step_start = time.time()
-        salt = os.urandom(16)
-        cek = derive_cek(salt)
-        key_hdr = derive_subkey(salt, b"ImAged HDR")
-        header = struct.pack(">Q", expiry_ts)
-        self._log_timing("Generate crypto material", step_start)
+        # v1 stays the default on-disk format so clients and older backends
+        # that only read v1 can open new files; v2 is opt-in
+        version = self.cfg.get("container_version", ttl_format.VERSION_1)
+        levels = []
+        if version >= ttl_format.VERSION_2 and self.cfg.get("pyramid", False):
+            step_start = time.perf_counter()
+            from image_processor import build_pyramid
+            levels = build_pyramid(payload_data,
+                                   max_levels=self.cfg.get("pyramid_levels", 3),
+                                   min_size=self.cfg.get("pyramid_min_size", 256))
+            self._log_timing(metrics.STAGE_PYRAMID, step_start, sum(len(level[2]) for level in levels))
+        tiles = None
+        if version >= ttl_format.VERSION_2 and self.cfg.get("tiling", False):
+            step_start = time.perf_counter()
+            from image_processor import build_tiles
+            tiles = build_tiles(payload_data, tile_size=self.cfg.get("tile_size", 512))
+            self._log_timing(metrics.STAGE_TILES, step_start, sum(len(t[3]) for t in tiles[3]) if tiles else None)
+
+        source_format = None
+        # Only v2 can record that the body is no longer the original file
+        if version >= ttl_format.VERSION_2 and self.cfg.get("lossless_transcode", False):
+            step_start = time.perf_counter()
+            from image_processor import transcode_lossless
+            transcoded = transcode_lossless(payload_data, self.cfg.get("transcode_min_saving", 0.25))
+            if transcoded is not None:
+                metrics.inc("bytes.transcode_saved", len(payload_data) - len(transcoded[0]))
+                payload_data, source_format = transcoded
+            self._log_timing(metrics.STAGE_TRANSCODE, step_start, len(payload_data))
+
+        pending = self._write_container(
+            payload_data, expiry_ts, output_path, version, source_format, levels, tiles,
+            on_commit=lambda path: self._index_created(input_path, path, expiry_ts, version, source_format),
+            defer=commit_group is not None, overwrite=overwrite)
+        if commit_group is not None:
+            commit_group.append(pending)
+        else:
+            # A file created at the name meanwhile pushes ours to a sibling
+            output_path = pending.path
         
-        step_start = time.time()
-        aes_hdr = AES_GCM(key_hdr)
-        nonce_hdr = os.urandom(12)
-        tag_hdr_only = aes_hdr.encrypt(nonce_hdr, b"", header) 
-        tag_hdr = tag_hdr_only[-16:]
-        self._log_timing("Authenticate header", step_start)
+        total_elapsed = time.perf_counter() - total_start
+        metrics.observe("op.create_ttl", total_elapsed)
+        tracing.record("op.create_ttl", total_start, total_start + total_elapsed, cat="ttl")
+        logger.info("TTL creation completed in %.3fs", total_elapsed, extra=SAMPLED)
+        logger.info("Wrote TTL %s (exp %d)", output_path, expiry_ts, extra=SAMPLED)
+        return output_path
+
+    def _write_container(self, payload_data: bytes, expiry_ts: int, output_path: str, version: int,
+                         source_format: str = None, levels=(), tiles=None, on_commit=None, defer: bool = False,
+                         overwrite: bool = True):
+        """Encrypt and write a container.
+
+        levels are build_pyramid() output and tiles build_tiles() output;
+        both need version 2. The file is written in one gathered write and
+        committed through durable_io; returns the PendingWrite.
+        """
+        import struct
+
+        step_start = time.perf_counter()
+        if version >= ttl_format.VERSION_2:
+            # Body bound to the prefix (content id), expiry sealed separately;
+            # the CEK is derived from the master key unless key_wrapping is on
+            # (random CEK wrapped under a KEK, needed for key rotation)
+            wrapped = self.cfg.get("key_wrapping", False)
+            table = [(w, h, ttl_format.sealed_level_length(len(data))) for w, h, data in levels]
+            tile_header = None
+            if tiles:
+                width, height, level_count, tile_list = tiles
+                tile_lengths = [ttl_format.sealed_level_length(len(t[3])) for t in tile_list]
+                tile_header = (self.cfg.get("tile_size", 512), width, height, level_count,
+                               ttl_format.tile_index_length(len(tile_list)), sum(tile_lengths))
+            header_bytes, cek, body_aad = ttl_format.build_header_v2(expiry_ts, wrapped=wrapped,
+                                                                     source_format=source_format,
+                                                                     levels=table, tiles=tile_header)
+            header_parts = [header_bytes]
+            self._log_timing(metrics.STAGE_HEADER_SEAL, step_start)
+        else:
+            salt = os.urandom(16)
+            cek = derive_cek(salt)
+            key_hdr = derive_subkey(salt, b"ImAged HDR")
+            header = struct.pack(">Q", expiry_ts)
+            self._log_timing(metrics.STAGE_KEY_MATERIAL, step_start)
+
+            step_start = time.perf_counter()
+            aes_hdr = AES_GCM(key_hdr)
+            nonce_hdr = os.urandom(12)
+            tag_hdr_only = aes_hdr.encrypt(nonce_hdr, b"", header) 
+            tag_hdr = tag_hdr_only[-16:]
+            header_parts = [MAGIC, salt, nonce_hdr, header, tag_hdr]
+            body_aad = header
+            self._log_timing(metrics.STAGE_HEADER_SEAL, step_start)
         
-        step_start = time.time()
         aes_body = AES_GCM(cek)
+        if levels or tiles:
+            # Pyramid levels, then the tile index and tiles, sit between the
+            # header and the full-size body
+            step_start = time.perf_counter()
+            sealed_bytes = 0
+            pieces = [(data, ttl_format.level_aad(body_aad, index)) for index, (_, _, data) in enumerate(levels)]
+            if tiles:
+                pieces.append((ttl_format.tile_index_plaintext(tile_lengths), body_aad + ttl_format.TILE_INDEX_AAD))
+                pieces.extend((data, ttl_format.tile_aad(body_aad, level, col, row))
+                              for level, col, row, data in tiles[3])
+            for data, aad in pieces:
+                nonce = os.urandom(12)
+                sealed = aes_body.encrypt(nonce, data, aad)
+                header_parts.extend((nonce, sealed[-16:], sealed[:-16]))
+                sealed_bytes += len(data)
+            self._log_timing(metrics.STAGE_ENCRYPT, step_start, sealed_bytes)
+
+        step_start = time.perf_counter()
         nonce_body = os.urandom(12)
-        body_ct_and_tag = aes_body.encrypt(nonce_body, payload_data, header)
+        body_ct_and_tag = aes_body.encrypt(nonce_body, payload_data, body_aad)
         ciphertext_body, tag_body = body_ct_and_tag[:-16], body_ct_and_tag[-16:]
-        self._log_timing("Encrypt body", step_start, len(payload_data))
-        
-        step_start = time.time()
-        with open(output_path, "wb") as f:
-            f.write(MAGIC)
-            f.write(salt)
-            f.write(nonce_hdr)
-            f.write(header)
-            f.write(tag_hdr)
-            f.write(nonce_body)
-            f.write(tag_body)
-            f.write(ciphertext_body)
-        self._log_timing("Write TTL file", step_start)
+        self._log_timing(metrics.STAGE_ENCRYPT, step_start, len(payload_data))
         
-        total_elapsed = time.time() - total_start
-        completion_message = f"TTL creation completed in {total_elapsed:.3f}s"
-        logging.info(completion_message)
-        print(completion_message)
-        logging.info("Wrote TTL %s (exp %d)", output_path, expiry_ts)
-        return output_path
+        step_start = time.perf_counter()
+        header_parts.extend((nonce_body, tag_body, ciphertext_body))
+        pending = durable_io.get_committer().write(output_path, header_parts, on_commit=on_commit, defer=defer,
+                                                   overwrite=overwrite)
+        self._log_timing(metrics.STAGE_WRITE, step_start)
+        return pending
+
+    def batch_convert(self, input_paths: List[str], output_dir: str = None, expiry_ts: int = None,
+                      incremental: bool = True, manifest=None) -> dict:
+        """Convert many images, optionally skipping sources converted before.
+
+        With incremental, sources whose size/mtime (or, failing that,
+        content hash) match the manifest and whose container still exists
+        are skipped. A changed source is re-encrypted over the container
+        recorded for it rather than getting a " (n)" duplicate. When
+        output_dir names a different directory than the recorded container,
+        the source is converted afresh there (the old container is left
+        alone). Skipped containers keep their expiry.
+        """
+        from convert_manifest import ConvertManifest, NEW, CHANGED, UNCHANGED, file_sha256
+        if incremental and manifest is None:
+            manifest = ConvertManifest()
+        start = time.perf_counter()
+        converted, skipped, failed = [], [], []
+        taken = {}
+        commit_group = []
+        cancelled = False
+        for source in input_paths:
+            if cancellation.is_cancelled():
+                # Stop between files; what was converted so far is still committed
+                cancelled = True
+                break
+            try:
+                st = os.stat(source)
+                status, entry, digest = manifest.check(source) if incremental else (NEW, None, None)
+                if entry is not None and output_dir is not None and not self._same_dir(
+                        entry["output"], self._default_output_path(source, output_dir)):
+                    status = NEW
+                if status == UNCHANGED:
+                    skipped.append({"input": source, "output": entry["output"]})
+                    continue
+                if incremental and digest is None:
+                    digest = file_sha256(source)
+                if status == CHANGED:
+                    output = self.create_ttl_file(source, expiry_ts, entry["output"], overwrite=True,
+                                                  commit_group=commit_group)
+                else:
+                    target = self._default_output_path(source, output_dir)
+                    directory = os.path.dirname(target)
+                    if directory not in taken:
+                        taken[directory] = self._names_in(directory)
+                    output = self.create_ttl_file(source, expiry_ts, target, taken=taken[directory],
+                                                  commit_group=commit_group)
+                converted.append(({"input": source, "output": output, "status": status},
+                                  commit_group[-1], digest, st))
+            except Exception as e:
+                logger.error(f"Batch conversion failed for {source}: {e}")
+                failed.append({"input": source, "error": str(e)})
+        # One group commit for the whole batch; the manifest only records
+        # containers once they are durable, under their final names
+        durable_io.get_committer().flush()
+        committed = []
+        for item, pending, digest, st in converted:
+            if pending.error is not None:
+                logger.error(f"Batch conversion failed for {item['input']}: {pending.error}")
+                failed.append({"input": item["input"], "error": str(pending.error)})
+                continue
+            item["output"] = pending.path
+            if incremental:
+                manifest.record(item["input"], pending.path, digest, st)
+            committed.append(item)
+        converted = committed
+        if incremental:
+            manifest.flush()
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("op.batch_convert", elapsed)
+        metrics.inc("batch.converted", len(converted))
+        metrics.inc("batch.skipped", len(skipped))
+        logger.info("Batch conversion: %d converted, %d unchanged, %d failed in %.3fs",
+                    len(converted), len(skipped), len(failed), elapsed)
+        return {"converted": converted, "skipped": skipped, "failed": failed, "seconds": round(elapsed, 3),
+                "cancelled": cancelled}
+
+    def extend_ttl_file(self, input_path: str, expiry_ts: int) -> dict:
+        """Move a container's expiry without re-encrypting its body.
+
+        v2 containers get their expiry record rewritten in place. A v1
+        container binds the body to its expiry, so it is upgraded to v2 once
+        (decrypt + re-encrypt, replaced atomically); later extensions are
+        header-only.
+        """
+        total_start = time.perf_counter()
+        step_start = time.perf_counter()
+        header = ttl_format.peek_header(input_path)
+        self._log_timing(metrics.STAGE_HEADER_VERIFY, step_start)
+
+        step_start = time.perf_counter()
+        try:
+            current_time, _ = get_current_time_with_fallback()
+        except RuntimeError as e:
+            raise ValueError(f"NTP time validation failed: {e}")
+        if current_time > header.expiry:
+            raise ValueError(f"File expired on {datetime.fromtimestamp(header.expiry)}")
+        if expiry_ts <= current_time:
+            raise ValueError("New expiry must be in the future")
+        self._log_timing(metrics.STAGE_EXPIRY_CHECK, step_start)
 
-    def open_ttl_file(self, input_path: str, cleanup_callback=None) -> Tuple[bytes, bool]:
+        upgraded = header.version < ttl_format.VERSION_2
+        step_start = time.perf_counter()
+        if upgraded:
+            payload_data, _ = self.open_ttl_file(input_path)
+            self._write_container(payload_data, expiry_ts, input_path, ttl_format.VERSION_2)
+        else:
+            ttl_format.rewrite_expiry(input_path, expiry_ts)
+        self._log_timing(metrics.STAGE_HEADER_SEAL, step_start)
+
+        try:
+            import ttl_index
+            ttl_index.get_index().record(input_path, preserve=("width", "height"),
+                                         expiry=expiry_ts, version=ttl_format.VERSION_2)
+        except Exception as e:
+            logger.debug("Could not index %s: %s", input_path, e)
+
+        total_elapsed = time.perf_counter() - total_start
+        metrics.observe("op.extend_ttl", total_elapsed)
+        tracing.record("op.extend_ttl", total_start, total_start + total_elapsed, cat="ttl", upgraded=upgraded)
+        logger.info("Extended TTL %s to %d in %.3fs", input_path, expiry_ts, total_elapsed, extra=SAMPLED)
+        return {
+            "path": input_path,
+            "old_expiry": header.expiry,
+            "expiry": expiry_ts,
+            "version": ttl_format.VERSION_2,
+            "upgraded": upgraded,
+        }
+
+    def _index_created(self, input_path: str, output_path: str, expiry_ts: int, version: int,
+                       source_format: str = None):
+        # Best effort: listings work without it, they just read the header
+        try:
+            import ttl_index
+            width = height = None
+            try:
+                from PIL import Image
+                with Image.open(input_path) as img:
+                    width, height = img.size
+            except Exception:
+                pass
+            ttl_index.get_index().record(output_path, expiry=expiry_ts, version=version, width=width, height=height,
+                                          source_format=source_format)
+        except Exception as e:
+            logger.debug("Could not index %s: %s", output_path, e)
+
+    def open_ttl_file(self, input_path: str, cleanup_callback=None, display_size=None) -> Tuple[bytes, bool]:
+        """Decrypt a container's image.
+
+        With display_size=(width, height) (either may be None) the smallest
+        pyramid level that fills that box is returned instead of the full
+        image, and only that level is read from disk.
+        """
         import struct
-        logging.info("open_ttl_file: %s", input_path)
+        logger.debug("open_ttl_file: %s", input_path)
         
-        total_start = time.time()
-        print(f"Starting TTL opening process")
-        logging.info(f"Starting TTL opening process")
+        total_start = time.perf_counter()
+        logger.debug("Starting TTL opening process")
         
         try:
-            step_start = time.time()
+            step_start = time.perf_counter()
+            level = None
             with open(input_path, "rb") as f:
-                data = f.read()
-            self._log_timing("Read TTL file", step_start, len(data))
+                if display_size:
+                    data = f.read(ttl_format.PEEK_LEN)
+                    peeked = ttl_format.parse_header(data)
+                    level = ttl_format.select_level(peeked, *display_size)
+                    if level is None:
+                        data += f.read()
+                    else:
+                        level_parts = ttl_format.read_level(f, peeked, level)
+                else:
+                    data = f.read()
+            self._log_timing(metrics.STAGE_READ, step_start, len(data))
 
-            step_start = time.time()
-            min_len = len(MAGIC) + 16 + 12 + 8 + 16 + 12 + 16
-            if len(data) < min_len:
+            step_start = time.perf_counter()
+            header = ttl_format.parse_header(data)
+            if level is None and len(data) < header.min_length:
                 raise ValueError("Invalid TTL file (too short)")
-
-            off = 0
-            magic = data[off:off+len(MAGIC)]; off += len(MAGIC)
-            if magic != MAGIC:
-                raise ValueError("Not an ImAged file")
-            salt = data[off:off+16]; off += 16
-
-            base = off
-            nonce_hdr   = data[base:base+12]
-            cand_header = data[base+12:base+20]
-            cand_taghdr = data[base+20:base+36]
-            self._log_timing("Parse header", step_start)
+            self._log_timing(metrics.STAGE_PARSE, step_start)
             
-            step_start = time.time()
-            key_hdr = derive_subkey(salt, b"ImAged HDR")
-            aes_hdr = AES_GCM(key_hdr)
-            try:
-                aes_hdr.decrypt(nonce_hdr, cand_taghdr, cand_header)
-            except Exception:
-                raise ValueError("Invalid TTL format")
-            self._log_timing("Verify header auth", step_start)
+            step_start = time.perf_counter()
+            ttl_format.verify_header(header)
+            self._log_timing(metrics.STAGE_HEADER_VERIFY, step_start)
             
-            step_start = time.time()
-            expiry_ts = struct.unpack(">Q", cand_header)[0]
-            try:
-                current_time, fallback = get_current_time_with_fallback()
-                if current_time > expiry_ts:
-                    raise ValueError(f"File expired on {datetime.fromtimestamp(expiry_ts)}")
-            except RuntimeError as e:
-                raise ValueError(f"NTP time validation failed: {e}")
-            self._log_timing("Check expiry", step_start)
+            fallback = self._check_expiry(header.expiry)
             
-            step_start = time.time()
-            if len(data) < base + 36 + 12 + 16:
-                raise ValueError("Invalid TTL file (truncated)")
-            nonce_body = data[base+36:base+48]
-            tag_body   = data[base+48:base+64]
-            ciphertext_body = data[base+64:]
+            step_start = time.perf_counter()
+            if level is None:
+                nonce_body, tag_body, ciphertext_body = ttl_format.split_body(header, data)
+                body_aad = header.body_aad
+            else:
+                nonce_body, tag_body, ciphertext_body = level_parts
+                body_aad = ttl_format.level_aad(header.prefix, level)
+                metrics.inc("open.pyramid_level")
 
-            cek = derive_cek(salt)
-            aes_body = AES_GCM(cek)
+            aes_body = AES_GCM(ttl_format.content_key(header))
             try:
-                payload_data = aes_body.decrypt(nonce_body, ciphertext_body + tag_body, cand_header)
+                payload_data = aes_body.decrypt(nonce_body, ciphertext_body + tag_body, body_aad)
             except Exception:
                 raise ValueError("Authentication failed")
-            self._log_timing("Decrypt body", step_start, len(payload_data))
+            self._log_timing(metrics.STAGE_DECRYPT, step_start, len(payload_data))
             
-            total_elapsed = time.time() - total_start
-            completion_message = f"TTL opening completed in {total_elapsed:.3f}s"
-            logging.info(completion_message)
-            print(completion_message)
+            total_elapsed = time.perf_counter() - total_start
+            metrics.observe("op.open_ttl", total_elapsed)
+            tracing.record("op.open_ttl", total_start, total_start + total_elapsed, cat="ttl")
+            logger.info("TTL opening completed in %.3fs", total_elapsed, extra=SAMPLED)
             return payload_data, fallback
             
         except Exception as e:
-            total_elapsed = time.time() - total_start
+            total_elapsed = time.perf_counter() - total_start
+            metrics.inc("errors.open_ttl")
             error_message = f"TTL opening failed after {total_elapsed:.3f}s: {e}"
-            logging.error(error_message)
-            print(error_message)
+            logger.error(error_message)
             if cleanup_callback:
                 cleanup_callback()
             raise
 
+    def _check_expiry(self, expiry_ts: int) -> bool:
+        """Raise ValueError if expired in trusted time; returns the fallback flag."""
+        step_start = time.perf_counter()
+        try:
+            current_time, fallback = get_current_time_with_fallback()
+            if current_time > expiry_ts:
+                raise ValueError(f"File expired on {datetime.fromtimestamp(expiry_ts)}")
+        except RuntimeError as e:
+            raise ValueError(f"NTP time validation failed: {e}")
+        self._log_timing(metrics.STAGE_EXPIRY_CHECK, step_start)
+        return fallback
+
+    def read_region(self, input_path: str, x: int, y: int, width: int, height: int, zoom: float = 1.0) -> dict:
+        """Decrypt only the tiles of a tiled container that cover a viewport.
+
+        x, y, width and height are in full-resolution pixels and zoom is the
+        display scale (1.0 = one image pixel per screen pixel). Tiles come
+        from the coarsest zoom level that is still at least that sharp; the
+        returned region and tile positions are in that level's pixels.
+        """
+        if zoom <= 0 or width <= 0 or height <= 0:
+            raise ValueError("Region size and zoom must be positive")
+        total_start = time.perf_counter()
+        with open(input_path, "rb") as f:
+            step_start = time.perf_counter()
+            header = ttl_format.parse_header(f.read(ttl_format.PEEK_LEN))
+            info = header.tiles
+            if info is None:
+                raise ValueError("Not a tiled TTL container")
+            self._log_timing(metrics.STAGE_PARSE, step_start)
+
+            step_start = time.perf_counter()
+            ttl_format.verify_header(header)
+            self._log_timing(metrics.STAGE_HEADER_VERIFY, step_start)
+            fallback = self._check_expiry(header.expiry)
+
+            step_start = time.perf_counter()
+            aes = AES_GCM(ttl_format.content_key(header))
+            spans = ttl_format.read_tile_index(f, header, aes)
+
+            level = 0
+            while level + 1 < info.level_count and zoom <= 1.0 / (1 << (level + 1)):
+                level += 1
+            scale = 1 << level
+            cols, _rows, level_width, level_height = info.grid(level)
+            left, top = max(0, int(x) // scale), max(0, int(y) // scale)
+            right = min(level_width, -(-int(x + width) // scale))
+            bottom = min(level_height, -(-int(y + height) // scale))
+            if right <= left or bottom <= top:
+                raise ValueError("Region is outside the image")
+
+            size = info.tile_size
+            first_col, last_col = left // size, (right - 1) // size
+            base = info.tile_number(level, 0, 0)
+            tiles = []
+            decrypted = 0
+            for row in range(top // size, (bottom - 1) // size + 1):
+                # A row's tiles are contiguous on disk: one read per row
+                row_spans = spans[base + row * cols + first_col:base + row * cols + last_col + 1]
+                start = row_spans[0][0]
+                f.seek(start)
+                blob = f.read(row_spans[-1][0] + row_spans[-1][1] - start)
+                for col, (off, length) in enumerate(row_spans, first_col):
+                    nonce, tag, ct = ttl_format.split_sealed(blob[off - start:off - start + length])
+                    try:
+                        data = aes.decrypt(nonce, ct + tag, ttl_format.tile_aad(header.prefix, level, col, row))
+                    except Exception:
+                        raise ValueError("Authentication failed")
+                    decrypted += len(data)
+                    tiles.append({"col": col, "row": row, "x": col * size, "y": row * size, "data": data})
+            self._log_timing(metrics.STAGE_DECRYPT, step_start, decrypted)
+
+        total_elapsed = time.perf_counter() - total_start
+        metrics.observe("op.get_region", total_elapsed)
+        tracing.record("op.get_region", total_start, total_start + total_elapsed, cat="ttl")
+        return {
+            "image_width": info.width,
+            "image_height": info.height,
+            "level_count": info.level_count,
+            "level": level,
+            "scale": 1.0 / scale,
+            "tile_size": size,
+            "level_width": level_width,
+            "level_height": level_height,
+            "x": left,
+            "y": top,
+            "width": right - left,
+            "height": bottom - top,
+            "tiles": tiles,
+            "time_fallback": fallback,
+        }
+
     def debug_build_ttl_stages(self, input_path: str, expiry_ts: int | None = None):
         import time, struct
         
-        total_start = time.time()
-        print(f"Starting debug build stages process")
-        logging.info(f"Starting debug build stages process")
+        total_start = time.perf_counter()
+        logger.debug("Starting debug build stages process")
         
-        step_start = time.time()
+        step_start = time.perf_counter()
         with open(input_path, "rb") as f:
             original_bytes = f.read()
-        self._log_timing("Read original image", step_start, len(original_bytes))
-
-        step_start = time.time()
+        self._log_timing(metrics.STAGE_READ, step_start, len(original_bytes))
         payload_data = original_bytes
-        self._log_timing("Prepare payload", step_start, len(payload_data))
 
-        step_start = time.time()
+        step_start = time.perf_counter()
         salt = os.urandom(16)
         cek = derive_cek(salt)
         key_hdr = derive_subkey(salt, b"ImAged HDR")
         if expiry_ts is None: expiry_ts = int(time.time() + self.cfg.get("default_ttl_hours", 1) * 3600)
         header = struct.pack(">Q", expiry_ts)
-        self._log_timing("Generate crypto material", step_start)
+        self._log_timing(metrics.STAGE_KEY_MATERIAL, step_start)
 
-        step_start = time.time()
+        step_start = time.perf_counter()
         aes_hdr = AES_GCM(key_hdr)
         nonce_hdr = os.urandom(12)
         tag_hdr = aes_hdr.encrypt(nonce_hdr, b"", header)
-        self._log_timing("Header authentication", step_start)
+        self._log_timing(metrics.STAGE_HEADER_SEAL, step_start)
 
-        step_start = time.time()
+        step_start = time.perf_counter()
         aes_body = AES_GCM(cek)
         nonce_body = os.urandom(12)
         ct_body = aes_body.encrypt(nonce_body, payload_data, header) 
-        self._log_timing("Body encryption", step_start, len(payload_data))
+        self._log_timing(metrics.STAGE_ENCRYPT, step_start, len(payload_data))
 
-        step_start = time.time()
+        step_start = time.perf_counter()
         final_bytes = b"".join([
             MAGIC, salt, nonce_hdr, header, tag_hdr, nonce_body, ct_body[-16:], ct_body[:-16]
         ])
-        self._log_timing("Final file layout", step_start, len(final_bytes))
+        self._log_timing(metrics.STAGE_WRITE, step_start, len(final_bytes))
         
-        total_elapsed = time.time() - total_start
-        completion_message = f"Debug build stages completed in {total_elapsed:.3f}s"
-        logging.info(completion_message)
-        print(completion_message)
+        total_elapsed = time.perf_counter() - total_start
+        logger.info("Debug build stages completed in %.3fs", total_elapsed, extra=SAMPLED)
 
         return {
             "original": original_bytes,
@@ -254,52 +626,43 @@ class TTLFileManager:
     def debug_open_ttl_stages(self, ttl_path: str):
         import struct
         
-        total_start = time.time()
-        print(f"Starting debug open stages process")
-        logging.info(f"Starting debug open stages process")
+        total_start = time.perf_counter()
+        logger.debug("Starting debug open stages process")
         
-        step_start = time.time()
+        step_start = time.perf_counter()
         with open(ttl_path, "rb") as f:
             data = f.read()
-        self._log_timing("Read TTL file", step_start, len(data))
+        self._log_timing(metrics.STAGE_READ, step_start, len(data))
         
-        step_start = time.time()
-        off = len(MAGIC)
-        salt = data[off:off+16]; off += 16
-        nonce_hdr = data[off:off+12]; off += 12
-        header = data[off:off+8]; off += 8
-        tag_hdr = data[off:off+16]; off += 16
-        nonce_body = data[off:off+12]; off += 12
-        tag_body = data[off:off+16]; off += 16
-        ciphertext_body = data[off:]
-        self._log_timing("Parse segments", step_start)
+        step_start = time.perf_counter()
+        parsed = ttl_format.parse_header(data)
+        nonce_body, tag_body, ciphertext_body = ttl_format.split_body(parsed, data)
+        self._log_timing(metrics.STAGE_PARSE, step_start)
         
-        step_start = time.time()
-        key_hdr = derive_subkey(salt, b"ImAged HDR")
-        aes_hdr = AES_GCM(key_hdr)
-        try:
-            aes_hdr.decrypt(nonce_hdr, tag_hdr, header)
-        except Exception:
-            raise ValueError("Invalid TTL format")
-        self._log_timing("Verify header", step_start)
+        step_start = time.perf_counter()
+        ttl_format.verify_header(parsed)
+        self._log_timing(metrics.STAGE_HEADER_VERIFY, step_start)
         
-        step_start = time.time()
-        cek = derive_cek(salt)
-        aes_body = AES_GCM(cek)
-        payload_data = aes_body.decrypt(nonce_body, ciphertext_body + tag_body, header)
-        self._log_timing("Decrypt body", step_start, len(payload_data))
+        step_start = time.perf_counter()
+        aes_body = AES_GCM(ttl_format.content_key(parsed))
+        payload_data = aes_body.decrypt(nonce_body, ciphertext_body + tag_body, parsed.body_aad)
+        self._log_timing(metrics.STAGE_DECRYPT, step_start, len(payload_data))
         
-        total_elapsed = time.time() - total_start
-        completion_message = f"Debug open stages completed in {total_elapsed:.3f}s"
-        logging.info(completion_message)
-        print(completion_message)
+        total_elapsed = time.perf_counter() - total_start
+        logger.info("Debug open stages completed in %.3fs", total_elapsed, extra=SAMPLED)
 
         return {
             "file_bytes": data,
-            "salt": salt,
-            "header": header,
-            "nonce_hdr": nonce_hdr,
-            "tag_hdr": tag_hdr,
+            "version": parsed.version,
+            "source_format": parsed.source_format,
+            "levels": [(lvl.width, lvl.height, data[lvl.offset:lvl.offset + lvl.length]) for lvl in parsed.levels],
+            "tiles": data[parsed.tiles.index_offset:parsed.body_offset] if parsed.tiles else b"",
+            "prefix": parsed.prefix,
+            "key_block": parsed.key_block,
+            "salt": parsed.salt,
+            "header": parsed.expiry_header,
+            "nonce_hdr": parsed.nonce_hdr,
+            "tag_hdr": parsed.tag_hdr,
             "nonce_body": nonce_body,
             "tag_body": tag_body,
             "ciphertext_body": ciphertext_body,
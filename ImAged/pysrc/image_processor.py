@@ -2,10 +2,232 @@ from PIL import Image
 import logging
 import io
 
-def convert_image_to_bytes(image: Image.Image, format: str = "PNG") -> bytes:
+logger = logging.getLogger(__name__)
+
+# Input formats that are often stored uncompressed or barely compressed
+TRANSCODE_SOURCES = ("BMP", "TIFF", "PNG", "PPM")
+# Modes PNG stores without loss ("I" would be truncated to 16 bits)
+_PNG_LOSSLESS_MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "I;16")
+# Already compressed at least this much against raw pixels: not worth a try
+_COMPACT_RATIO = 0.5
+# Metadata carried over to the re-encoded image
+_KEPT_INFO = ("icc_profile", "exif", "dpi", "transparency")
+
+
+def convert_image_to_bytes(image: Image.Image, format: str = "PNG", **save_params) -> bytes:
     buffer = io.BytesIO()
-    image.save(buffer, format=format)
+    image.save(buffer, format=format, **save_params)
     image_bytes = buffer.getvalue()
     buffer.close()
-    logging.debug("Converted image to %d bytes in memory", len(image_bytes))
-    return image_bytes
\ No newline at end of file
+    logger.debug("Converted image to %d bytes in memory", len(image_bytes))
+    return image_bytes
+
+
+def transcode_lossless(data: bytes, min_saving: float = 0.25):
+    """Re-encode an uncompressed image as PNG without changing its pixels.
+
+    Returns (png_bytes, source_format), or None if the input is not a
+    candidate (other format, multi-frame, a mode PNG cannot hold, already
+    compressed) or the result would not be at least min_saving smaller.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            source_format = img.format
+            if source_format not in TRANSCODE_SOURCES or getattr(img, "n_frames", 1) > 1:
+                return None
+            if img.mode not in _PNG_LOSSLESS_MODES:
+                return None
+            if source_format == "TIFF" and img.info.get("compression", "raw") != "raw":
+                return None
+            bits = 1 if img.mode == "1" else 8 * len(img.getbands()) * (2 if img.mode == "I;16" else 1)
+            raw_size = img.width * img.height * bits // 8
+            if source_format == "PNG" and len(data) < raw_size * _COMPACT_RATIO:
+                return None
+            params = {k: img.info[k] for k in _KEPT_INFO if img.info.get(k) is not None}
+            encoded = convert_image_to_bytes(img, "PNG", **params)
+    except Exception as e:
+        logger.debug("Not transcoding input: %s", e)
+        return None
+    if len(encoded) > len(data) * (1 - min_saving):
+        return None
+    logger.debug("Transcoded %s %d -> %d bytes", source_format, len(data), len(encoded))
+    return encoded, source_format
+
+
+def build_pyramid(data: bytes, max_levels: int = 3, min_size: int = 256, quality: int = 90) -> list:
+    """Reduced renditions of an image at 1/2, 1/4, ... of its size.
+
+    Returns [(width, height, encoded_bytes)], largest first, stopping after
+    max_levels or once the long side would drop below min_size. Photos
+    (JPEG sources) are re-encoded as JPEG, everything else as PNG. Empty if
+    the input cannot be decoded or is already small.
+    """
+    levels = []
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            as_jpeg = img.format == "JPEG"
+            exif = img.info.get("exif")
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            level = img.convert("RGBA" if has_alpha and not as_jpeg else "RGB")
+            while len(levels) < max_levels and max(level.size) // 2 >= min_size:
+                level = level.reduce(2)
+                params = {"exif": exif} if exif else {}
+                if as_jpeg:
+                    encoded = convert_image_to_bytes(level, "JPEG", quality=quality, **params)
+                else:
+                    encoded = convert_image_to_bytes(level, "PNG", compress_level=6, **params)
+                levels.append((level.width, level.height, encoded))
+    except Exception as e:
+        logger.debug("Not building pyramid: %s", e)
+        return []
+    return levels
+
+
+def build_tiles(data: bytes, tile_size: int = 512, quality: int = 90):
+    """Cut an image into tiles at zoom levels 1, 1/2, 1/4, ...
+
+    Returns (width, height, level_count, [(level, col, row, encoded_bytes)])
+    in level / row-major order, down to the first level that fits a single
+    tile, or None if the image already fits one tile or cannot be decoded.
+    Encoding follows build_pyramid (JPEG for JPEG sources, else PNG);
+    tiles are in stored pixel orientation and carry no metadata.
+    """
+    tiles = []
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.width <= tile_size and img.height <= tile_size:
+                return None
+            as_jpeg = img.format == "JPEG"
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            level_img = img.convert("RGBA" if has_alpha and not as_jpeg else "RGB")
+            width, height = level_img.size
+            level = 0
+            while True:
+                for top in range(0, level_img.height, tile_size):
+                    for left in range(0, level_img.width, tile_size):
+                        tile = level_img.crop((left, top, min(left + tile_size, level_img.width),
+                                               min(top + tile_size, level_img.height)))
+                        if as_jpeg:
+                            encoded = convert_image_to_bytes(tile, "JPEG", quality=quality)
+                        else:
+                            encoded = convert_image_to_bytes(tile, "PNG", compress_level=6)
+                        tiles.append((level, left // tile_size, top // tile_size, encoded))
+                if level_img.width <= tile_size and level_img.height <= tile_size:
+                    break
+                level_img = level_img.reduce(2)
+                level += 1
+    except Exception as e:
+        logger.debug("Not tiling input: %s", e)
+        return None
+    return width, height, level + 1, tiles
+
+
+def compose_region(region: dict) -> Image.Image:
+    """Paste the tiles of a read_region() result into one image of the region."""
+    canvas = None
+    for tile in region["tiles"]:
+        with Image.open(io.BytesIO(tile["data"])) as tile_img:
+            tile_img.load()
+            if canvas is None:
+                canvas = Image.new(tile_img.mode if tile_img.mode in ("RGB", "RGBA") else "RGBA",
+                                   (region["width"], region["height"]))
+            canvas.paste(tile_img, (tile["x"] - region["x"], tile["y"] - region["y"]))
+    return canvas
+
+
+def to_bgra32(image: Image.Image) -> dict:
+    """Raw pixels in the layout of a WPF WriteableBitmap (PixelFormats.Bgra32).
+
+    Straight (not premultiplied) alpha, rows top-down with no padding.
+    Returns {"data", "width", "height", "stride", "pixel_format"}.
+    """
+    rgba = image if image.mode == "RGBA" else image.convert("RGBA")
+    return {
+        "data": rgba.tobytes("raw", "BGRA"),
+        "width": rgba.width,
+        "height": rgba.height,
+        "stride": rgba.width * 4,
+        "pixel_format": "Bgra32",
+    }
+
+
+# JPEG markers that start a frame (carry the image size); C4, C8 and CC
+# are DHT, JPG and DAC
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _jpeg_segments(data: bytes):
+    # (marker, segment payload) up to the start of scan; no pixel data read
+    if data[:2] != b"\xff\xd8":
+        return
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            return
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        yield marker, data[pos + 4:pos + 2 + length]
+        pos += 2 + length
+
+
+def jpeg_size(data: bytes):
+    """(width, height) from a JPEG's frame header, or None."""
+    for marker, payload in _jpeg_segments(data):
+        if marker in _SOF_MARKERS and len(payload) >= 5:
+            return int.from_bytes(payload[3:5], "big"), int.from_bytes(payload[1:3], "big")
+    return None
+
+
+def exif_thumbnail(data: bytes):
+    """The JPEG thumbnail embedded in a JPEG's Exif (APP1) block.
+
+    Returns (thumbnail_bytes, (width, height), (image_width, image_height))
+    or None. Only the marker segments are walked; nothing is decoded.
+    """
+    exif = None
+    image_size = None
+    for marker, payload in _jpeg_segments(data):
+        if marker == 0xE1 and exif is None and payload[:6] == b"Exif\x00\x00":
+            exif = payload[6:]
+        elif marker in _SOF_MARKERS and len(payload) >= 5:
+            image_size = int.from_bytes(payload[3:5], "big"), int.from_bytes(payload[1:3], "big")
+            break
+    if exif is None or image_size is None or exif[:2] not in (b"II", b"MM"):
+        return None
+    order = "little" if exif[:2] == b"II" else "big"
+
+    def u16(off):
+        return int.from_bytes(exif[off:off + 2], order)
+
+    def u32(off):
+        return int.from_bytes(exif[off:off + 4], order)
+
+    try:
+        ifd0 = u32(4)
+        # IFD1 (the thumbnail's) follows IFD0's entries
+        ifd1 = u32(ifd0 + 2 + 12 * u16(ifd0))
+        if not ifd1 or ifd1 + 2 > len(exif):
+            return None
+        tags = {}
+        for i in range(u16(ifd1)):
+            entry = ifd1 + 2 + 12 * i
+            tag, kind = u16(entry), u16(entry + 2)
+            tags[tag] = u16(entry + 8) if kind == 3 else u32(entry + 8)
+    except (IndexError, ValueError):
+        return None
+    offset, length = tags.get(0x0201), tags.get(0x0202)
+    if tags.get(0x0103, 6) != 6 or not offset or not length or offset + length > len(exif):
+        return None
+    thumbnail = exif[offset:offset + length]
+    size = jpeg_size(thumbnail)
+    if size is None:
+        return None
+    return thumbnail, size, image_size
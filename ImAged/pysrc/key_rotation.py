@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Master-key rotation for wrapped TTL containers.
+
+    python key_rotation.py rotate ROOT --new-key new.key [--old-key old.key]
+                           [--workers 8] [--journal rotation.log] [--dry-run]
+
+Every .ttl file under ROOT whose CEK is wrapped under the old key gets its
+key block rewrapped under the new one in place: one small read and one
+68-byte write per file, no body crypto. Files are handled by a thread
+pool, and each outcome is appended to a journal so an interrupted run
+resumes where it stopped (files already wrapped under the new key are
+also recognized from their header).
+
+Files without a wrapped key (v1, or v2 written with key_wrapping off)
+derive their key from the master key directly, and the keyring does
+not help them: once the new key is installed they can no longer be
+opened. rotate therefore checks the tree first and refuses to run while
+any such file is found; re-encrypt them as wrapped v2 containers first
+(container_version 2, key_wrapping on), or pass --allow-unwrapped to
+rotate the rest anyway and accept that those files become unreadable.
+
+Suggested procedure: run the rotation, then install the new key as
+config/master.key and append the old one to config/previous_master.keys
+so that any file missed by the run stays readable. The TTL index is
+sealed under the master key as well; it is discarded and rebuilt from
+the containers on first use after the new key is installed.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import config
+import crypto
+import ttl_format
+
+DONE_STATUSES = ("rewrapped", "current")
+PROGRESS_INTERVAL = 2.0
+# Unwrapped files listed when rotate refuses to run
+UNWRAPPED_SHOWN = 10
+
+
+def _read_key(path: str) -> bytes:
+    with open(path, "rb") as f:
+        raw = f.read()
+    if len(raw) < 32:
+        raise ValueError(f"{path}: key must be 32 bytes (got {len(raw)})")
+    return raw[:32]
+
+
+def _iter_ttl_files(root: str):
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for de in it:
+                    if de.is_dir(follow_symlinks=False):
+                        stack.append(de.path)
+                    elif de.name.lower().endswith(".ttl") and de.is_file():
+                        yield de.path
+        except OSError as e:
+            print(f"skipping {e.filename}: {e.strerror}", file=sys.stderr)
+
+
+def _default_journal(root: str, new_kek_id: bytes) -> str:
+    root_id = hashlib.sha256(os.path.abspath(root).encode("utf-8")).hexdigest()[:12]
+    return str(config.app_data_dir() / f"rotation-{root_id}-{new_kek_id.hex()}.log")
+
+
+def _load_journal(path: str) -> set:
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            status, _, file_path = line.rstrip("\n").partition("\t")
+            if status in DONE_STATUSES:
+                done.add(file_path)
+    return done
+
+
+class Rotator:
+    def __init__(self, old_master: bytes, new_master: bytes, dry_run: bool = False):
+        self.old_kek = crypto.kek_from_master(old_master)
+        self.old_kek_id = crypto.kek_id(self.old_kek)
+        self.new_kek = crypto.kek_from_master(new_master)
+        self.new_kek_id = crypto.kek_id(self.new_kek)
+        self.dry_run = dry_run
+
+    def rotate_file(self, path: str) -> tuple:
+        try:
+            with open(path, "rb") as f:
+                header = ttl_format.parse_header(f.read(ttl_format.PEEK_LEN))
+            if not header.wrapped:
+                return "unwrapped", None
+            key_id = ttl_format.key_block_kek_id(header)
+            if key_id == self.new_kek_id:
+                return "current", None
+            if key_id != self.old_kek_id:
+                return "unknown_key", key_id.hex()
+            if self.dry_run:
+                return "would_rewrap", None
+            changed = ttl_format.rewrap_key_block(path, self.old_kek, self.new_kek, self.new_kek_id)
+            return ("rewrapped" if changed else "current"), None
+        except (OSError, ValueError) as e:
+            return "failed", str(e)
+
+
+def _is_unwrapped(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return not ttl_format.parse_header(f.read(ttl_format.PEEK_LEN)).wrapped
+    except (OSError, ValueError):
+        # Unreadable files are reported by the rotation itself
+        return False
+
+
+def find_unwrapped(root: str, workers: int) -> list:
+    """Containers under root whose key derives from the master key directly."""
+    paths = list(_iter_ttl_files(root))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rotate-scan") as pool:
+        return [p for p, unwrapped in zip(paths, pool.map(_is_unwrapped, paths)) if unwrapped]
+
+
+def rotate_tree(root: str, rotator: Rotator, workers: int, journal_path: str) -> dict:
+    done = _load_journal(journal_path)
+    counts = {"resumed": len(done)}
+    lock = threading.Lock()
+    os.makedirs(os.path.dirname(os.path.abspath(journal_path)), exist_ok=True)
+    start = time.monotonic()
+    last_report = start
+
+    with open(journal_path, "a", encoding="utf-8") as journal, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rotate") as pool:
+        in_flight = {}
+
+        def drain(block: bool):
+            nonlocal last_report
+            if not in_flight:
+                return
+            finished, _ = wait(list(in_flight), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                path = in_flight.pop(fut)
+                status, detail = fut.result()
+                with lock:
+                    counts[status] = counts.get(status, 0) + 1
+                if not rotator.dry_run:
+                    journal.write(f"{status}\t{path}\n")
+                if detail:
+                    print(f"{status}: {path}: {detail}", file=sys.stderr)
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                journal.flush()
+                handled = sum(v for k, v in counts.items() if k != "resumed")
+                print(f"[rotate] {handled} files, {handled / (now - start):.0f}/s", file=sys.stderr)
+
+        for path in _iter_ttl_files(root):
+            if path in done:
+                continue
+            in_flight[pool.submit(rotator.rotate_file, path)] = path
+            if len(in_flight) >= workers * 4:
+                drain(block=True)
+        while in_flight:
+            drain(block=True)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    counts["seconds"] = round(time.monotonic() - start, 3)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rewrap TTL container keys under a new master key")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    rot = sub.add_parser("rotate", help="rewrap every wrapped .ttl file under ROOT")
+    rot.add_argument("root")
+    rot.add_argument("--new-key", required=True, help="file holding the new 32-byte master key")
+    rot.add_argument("--old-key", help="file holding the old master key (default: the installed master.key)")
+    rot.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 2) * 2))
+    rot.add_argument("--journal", help="progress journal (default: under %%APPDATA%%/ImAged)")
+    rot.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    rot.add_argument("--allow-unwrapped", action="store_true",
+                     help="rotate even though unwrapped files will become unreadable under the new key")
+    args = parser.parse_args(argv)
+
+    old_master = _read_key(args.old_key) if args.old_key else crypto.MASTER_KEY
+    rotator = Rotator(old_master, _read_key(args.new_key), dry_run=args.dry_run)
+    if rotator.old_kek_id == rotator.new_kek_id:
+        print("old and new master keys are identical", file=sys.stderr)
+        return 2
+    journal = args.journal or _default_journal(args.root, rotator.new_kek_id)
+
+    if not args.allow_unwrapped:
+        unwrapped = find_unwrapped(args.root, max(1, args.workers))
+        if unwrapped:
+            print(f"{len(unwrapped)} file(s) are not wrapped and would become unreadable "
+                  f"once the new key is installed:", file=sys.stderr)
+            for path in unwrapped[:UNWRAPPED_SHOWN]:
+                print(f"  {path}", file=sys.stderr)
+            if len(unwrapped) > UNWRAPPED_SHOWN:
+                print(f"  ... and {len(unwrapped) - UNWRAPPED_SHOWN} more", file=sys.stderr)
+            print("re-encrypt them as wrapped v2 containers first, or pass --allow-unwrapped",
+                  file=sys.stderr)
+            return 2
+
+    counts = rotate_tree(args.root, rotator, max(1, args.workers), journal)
+    print(" ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    print(f"journal: {journal}", file=sys.stderr)
+    return 1 if counts.get("failed") or counts.get("unknown_key") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
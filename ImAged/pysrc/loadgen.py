@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Headless load generator for secure_backend.py.
+
+Stands in for SecureProcessManager.cs: spawns backend processes, performs
+the RSA-OAEP(SHA-256) session key handshake and sends the same
+length-prefixed AES-GCM frames, then drives a weighted mix of OPEN_TTL
+(thumbnail and full), CONVERT_TO_TTL and GET_CONFIG at a target
+concurrency. Everything runs locally: the backends are pointed at a stub
+NTP responder on loopback through a temporary config file.
+
+    python loadgen.py --mix thumb=60,full=20,convert=10,config=10 \\
+        --concurrency 8 --processes 2 --duration 30
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from metrics import Histogram
+
+BACKEND_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "secure_backend.py")
+NTP_EPOCH_OFFSET = 2208988800
+DEFAULT_MIX = "thumb=60,full=20,convert=10,config=10"
+OPERATIONS = ("thumb", "full", "convert", "config")
+
+
+class StubNTPServer(threading.Thread):
+    """Answers NTP client requests on loopback with the local clock."""
+
+    def __init__(self):
+        super().__init__(daemon=True, name="stub-ntp")
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.settimeout(0.5)
+        self._stopped = threading.Event()
+        self.requests = 0
+
+    @property
+    def address(self) -> str:
+        host, port = self._sock.getsockname()
+        return f"{host}:{port}"
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                _, addr = self._sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            now = int(time.time()) + NTP_EPOCH_OFFSET
+            words = [0] * 12
+            words[0] = (4 << 27) | (4 << 24)  # version 4, server mode
+            words[8] = words[10] = now
+            self._sock.sendto(struct.pack("!12I", *words), addr)
+            self.requests += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._sock.close()
+
+
+class BackendChannel:
+    """One backend process plus the client half of its secure channel.
+
+    In --async mode several requests may be in flight on one channel; they
+    are matched to responses through the echoed request id.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, env: dict, async_mode: bool, depth: int, stderr):
+        args = [sys.executable, BACKEND_SCRIPT] + (["--async"] if async_mode else [])
+        self.process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr, env=env
+        )
+        self._slots = threading.Semaphore(depth if async_mode else 1)
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._handshake()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True, name="loadgen-reader")
+        self._reader.start()
+
+    def _read_line(self):
+        # The backend shares stdout with stray prints; like the C# client,
+        # only base64 lines are considered protocol frames.
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                return None
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                return base64.b64decode(line, validate=True)
+            except ValueError:
+                continue
+
+    def _handshake(self):
+        public_pem = self._read_line()
+        if public_pem is None:
+            raise RuntimeError("backend exited before sending its public key")
+        public_key = serialization.load_pem_public_key(public_pem)
+        self._session_key = os.urandom(32)
+        self._aes = AESGCM(self._session_key)
+        enc_session_key = public_key.encrypt(
+            self._session_key,
+            asym_padding.OAEP(
+                mgf=asym_padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+        self.process.stdin.write(base64.b64encode(enc_session_key) + b"\n")
+        self.process.stdin.flush()
+        confirmation = self._read_line()
+        if confirmation is None or self._decrypt(confirmation) != b"CHANNEL_ESTABLISHED":
+            raise RuntimeError("secure channel confirmation failed")
+
+    def _encrypt(self, data: bytes) -> bytes:
+        nonce = os.urandom(12)
+        return nonce + self._aes.encrypt(nonce, data, None)
+
+    def _decrypt(self, data: bytes) -> bytes:
+        return self._aes.decrypt(data[:12], data[12:], None)
+
+    def _read_loop(self):
+        while True:
+            frame = self._read_line()
+            if frame is None:
+                break
+            try:
+                response = json.loads(self._decrypt(frame))
+            except Exception:
+                continue
+            with self._pending_lock:
+                future = self._pending.pop(response.get("request_id"), None)
+            if future is not None:
+                future.set_result(response)
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("backend closed the channel"))
+
+    def call(self, command: str, parameters: dict, timeout: float = 120) -> dict:
+        request_id = f"lg-{next(self._ids)}"
+        future = Future()
+        with self._slots:
+            with self._pending_lock:
+                self._pending[request_id] = future
+            body = json.dumps({"Command": command, "Parameters": parameters, "RequestId": request_id})
+            encrypted_command = self._encrypt(body.encode())
+            # Same framing as SecureProcessManager.CreatePayload
+            payload = struct.pack(">I", len(encrypted_command)) + encrypted_command
+            with self._write_lock:
+                self.process.stdin.write(base64.b64encode(payload) + b"\n")
+                self.process.stdin.flush()
+            return future.result(timeout)
+
+    def rss_bytes(self):
+        try:
+            import psutil
+            return psutil.Process(self.process.pid).memory_info().rss
+        except ImportError:
+            pass
+        except Exception:
+            return None
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown operation '{name}' (expected one of {', '.join(OPERATIONS)})")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("mix has no positive weights")
+    return mix
+
+
+def build_config(ntp_address: str, path: str):
+    from config import load_config
+    cfg = load_config()
+    cfg.update({"ntp_server": ntp_address, "output_dir": ""})
+    cfg.setdefault("default_ttl_hours", 1)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cfg, f, indent=2)
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+        self._convert_seq = itertools.count(1)
+        self.histograms = {op: Histogram() for op in OPERATIONS}
+        self.errors = {op: 0 for op in OPERATIONS}
+        self.error_samples = []
+        self.peak_rss = {}
+        self.channels = []
+        self._channel_cycle = None
+        self._stats_lock = threading.Lock()
+
+    def _pick_operation(self):
+        ops, weights = zip(*self.mix.items())
+        with self.rng_lock:
+            return self.rng.choices(ops, weights)[0]
+
+    def _request_for(self, op: str):
+        with self.rng_lock:
+            if op in ("thumb", "full"):
+                ttl = self.rng.choice(self.ttl_files)
+            else:
+                src = self.rng.choice(self.sources)
+                seq = next(self._convert_seq)
+        if op == "thumb":
+            return "OPEN_TTL", {"input_path": ttl, "thumbnail_mode": True, "max_size": self.args.thumb_size}
+        if op == "full":
+            return "OPEN_TTL", {"input_path": ttl, "thumbnail_mode": False}
+        if op == "convert":
+            # A fresh name per request, so no run piles up " (n)" siblings
+            # that make later converts probe further for a free name
+            out = os.path.join(self.convert_dir, f"{os.path.basename(src)}.{seq}.ttl")
+            return "CONVERT_TO_TTL", {
+                "input_path": src, "output_path": out, "expiry_ts": int(time.time()) + 3600
+            }
+        return "GET_CONFIG", {}
+
+    def _next_channel(self):
+        with self._stats_lock:
+            return next(self._channel_cycle)
+
+    def _one_request(self):
+        op = self._pick_operation()
+        command, parameters = self._request_for(op)
+        channel = self._next_channel()
+        start = time.perf_counter()
+        try:
+            response = channel.call(command, parameters)
+            ok = response.get("success", False)
+            error = response.get("error")
+        except Exception as e:
+            ok, error = False, str(e)
+        self.histograms[op].record_seconds(time.perf_counter() - start)
+        if not ok:
+            with self._stats_lock:
+                self.errors[op] += 1
+                if len(self.error_samples) < 10:
+                    self.error_samples.append(f"{op}: {error}")
+
+    def _sample_rss(self, stop: threading.Event):
+        while not stop.wait(0.25):
+            for i, channel in enumerate(self.channels):
+                rss = channel.rss_bytes()
+                if rss is not None:
+                    self.peak_rss[i] = max(self.peak_rss.get(i, 0), rss)
+
+    def _prepare_corpus(self, workdir: str):
+        from benchmark import make_corpus
+        corpus_dir = os.path.join(workdir, "corpus")
+        self.convert_dir = os.path.join(workdir, "converted")
+        os.makedirs(corpus_dir)
+        os.makedirs(self.convert_dir)
+        self.sources = make_corpus(corpus_dir, self.args.seed)
+        self.ttl_files = []
+        for src in self.sources:
+            response = self.channels[0].call("CONVERT_TO_TTL", {
+                "input_path": src,
+                "output_path": src + ".ttl",
+                "expiry_ts": int(time.time()) + 24 * 3600
+            })
+            if not response.get("success"):
+                raise RuntimeError(f"corpus conversion failed: {response.get('error')}")
+            self.ttl_files.append(response["result"])
+
+    def run(self) -> dict:
+        args = self.args
+        workdir = tempfile.mkdtemp(prefix="imaged-loadgen-")
+        ntp = StubNTPServer()
+        ntp.start()
+        stderr = open(args.backend_log or os.path.join(workdir, "backend.log"), "wb")
+        try:
+            config_path = os.path.join(workdir, "config.json")
+            build_config(ntp.address, config_path)
+            env = dict(os.environ, IMAGED_CONFIG=config_path, PYTHONUNBUFFERED="1")
+
+            for _ in range(args.processes):
+                self.channels.append(BackendChannel(env, args.async_mode, args.depth, stderr))
+            self._channel_cycle = itertools.cycle(self.channels)
+            self._prepare_corpus(workdir)
+
+            stop_sampling = threading.Event()
+            sampler = threading.Thread(target=self._sample_rss, args=(stop_sampling,), daemon=True)
+            sampler.start()
+
+            deadline = time.perf_counter() + args.duration if args.duration else None
+            issued = itertools.count()
+            issued_lock = threading.Lock()
+
+            def worker():
+                while True:
+                    with issued_lock:
+                        n = next(issued)
+                    if args.requests and n >= args.requests:
+                        return
+                    if deadline and time.perf_counter() >= deadline:
+                        return
+                    self._one_request()
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="loadgen") as pool:
+                for future in [pool.submit(worker) for _ in range(args.concurrency)]:
+                    future.result()
+            elapsed = time.perf_counter() - start
+            stop_sampling.set()
+            sampler.join()
+            return self._report(elapsed, ntp.requests)
+        finally:
+            for channel in self.channels:
+                channel.close()
+            ntp.stop()
+            stderr.close()
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    def _report(self, elapsed: float, ntp_requests: int) -> dict:
+        total = sum(h.snapshot()["count"] for h in self.histograms.values())
+        operations = {}
+        for op, hist in self.histograms.items():
+            snap = hist.snapshot()
+            if snap["count"]:
+                snap["errors"] = self.errors[op]
+                snap["throughput_rps"] = snap["count"] / elapsed if elapsed > 0 else None
+                operations[op] = snap
+        return {
+            "config": {
+                "mix": self.mix,
+                "concurrency": self.args.concurrency,
+                "processes": self.args.processes,
+                "async": self.args.async_mode,
+                "depth": self.args.depth if self.args.async_mode else 1,
+            },
+            "elapsed_s": elapsed,
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "throughput_rps": total / elapsed if elapsed > 0 else None,
+            "operations": operations,
+            "peak_rss_mb": {str(i): round(v / (1024 * 1024), 1) for i, v in sorted(self.peak_rss.items())},
+            "ntp_requests": ntp_requests,
+            "error_samples": self.error_samples,
+        }
+
+
+def _print_report(report: dict):
+    cfg = report["config"]
+    print(f"{report['requests']} requests in {report['elapsed_s']:.2f}s "
+          f"({report['throughput_rps']:.1f} req/s), {report['errors']} errors, "
+          f"concurrency {cfg['concurrency']} over {cfg['processes']} process(es)"
+          f"{' async' if cfg['async'] else ''}")
+    print(f"{'op':<8} {'count':>7} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for op, s in report["operations"].items():
+        print(f"{op:<8} {s['count']:>7} {s['errors']:>5} {s['throughput_rps']:>8.1f} "
+              f"{s['p50_ms']:>9.2f} {s['p90_ms']:>9.2f} {s['p99_ms']:>9.2f} {s['max_ms']:>9.2f}")
+    for proc, rss in report["peak_rss_mb"].items():
+        print(f"backend {proc}: peak RSS {rss} MB")
+    for sample in report["error_samples"]:
+        print(f"  error: {sample}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the ImAged secure backend")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted operations (default {DEFAULT_MIX})")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight across all backends")
+    parser.add_argument("--processes", type=int, default=1, help="backend processes to spawn")
+    parser.add_argument("--async", dest="async_mode", action="store_true",
+                        help="start backends with --async and pipeline requests on each channel")
+    parser.add_argument("--depth", type=int, default=4, help="max in-flight requests per async channel")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run (0 = use --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--thumb-size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--json", help="also write the report as JSON to this path")
+    parser.add_argument("--backend-log", help="write backend stderr here instead of the temp dir")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    args = parser.parse_args(argv)
+    if not args.duration and not args.requests:
+        parser.error("one of --duration or --requests must be non-zero")
+
+    report = LoadGenerator(args).run()
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Non-blocking logging for the ImAged backend.
+
+Every log call only formats the record and pushes it onto an in-memory
+queue; a QueueListener thread does the actual I/O. Output goes to stderr
+(and optionally a rotating file), never to stdout, which carries protocol
+frames. Per-request stage messages are logged with extra=SAMPLED so they
+are rate limited per message template instead of flooding the log on a
+gallery load.
+
+Settings come from config.json or the environment:
+
+    log_level          root level (IMAGED_LOG_LEVEL), default INFO
+    log_levels         {"file_manager": "DEBUG", ...} (IMAGED_LOG_LEVELS="a=DEBUG,b=WARNING")
+    log_file           path of a rotating log file (IMAGED_LOG_FILE)
+    log_rate_limit     sampled messages allowed per template per second, default 5
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+DEFAULT_RATE_LIMIT = 5
+
+# Pass as extra= on hot-path messages to subject them to rate limiting
+SAMPLED = {"sampled": True}
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per (logger, template) for records flagged as sampled.
+
+    Suppressed records are counted and the next record that gets through
+    carries the count, so bursts are visible without their volume.
+    """
+
+    def __init__(self, rate_per_second: float = DEFAULT_RATE_LIMIT):
+        super().__init__()
+        self.rate = float(rate_per_second)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, suppressed = self._buckets.get(key, (self.rate, now, 0))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1.0:
+                self._buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[key] = (tokens - 1.0, now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar suppressed]"
+        return True
+
+
+def _parse_levels(spec) -> dict:
+    if isinstance(spec, dict):
+        return {str(k): str(v).upper() for k, v in spec.items()}
+    levels = {}
+    for part in (spec or "").split(","):
+        name, sep, level = part.partition("=")
+        if sep and name.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(cfg: dict = None) -> logging.handlers.QueueListener:
+    """Install the queue-based handlers on the root logger (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    cfg = cfg or {}
+    root_level = os.environ.get("IMAGED_LOG_LEVEL") or cfg.get("log_level") or "INFO"
+    module_levels = _parse_levels(cfg.get("log_levels"))
+    module_levels.update(_parse_levels(os.environ.get("IMAGED_LOG_LEVELS")))
+    log_file = os.environ.get("IMAGED_LOG_FILE") or cfg.get("log_file")
+    rate_limit = cfg.get("log_rate_limit", DEFAULT_RATE_LIMIT)
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = []
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setFormatter(formatter)
+    handlers.append(stderr_handler)
+    if log_file:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8"
+            )
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
+        except OSError as e:
+            sys.stderr.write(f"Could not open log file {log_file}: {e}\n")
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(root_level.upper())
+    for name, level in module_levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def shutdown_logging():
+    """Drain the queue and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
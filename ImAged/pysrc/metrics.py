@@ -0,0 +1,225 @@
+"""
+Process-wide metrics registry for the ImAged backend.
+
+Counters, gauges and HDR-style latency histograms that are cheap enough to
+update on every request. Histograms use log-linear buckets (about 1.6%
+relative precision) over microsecond values, so recording is O(1) and a
+snapshot can report p50/p99 without keeping individual samples.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Stage names shared by the TTL open/create paths
+STAGE_READ = "stage.read"
+STAGE_TRANSCODE = "stage.transcode"
+STAGE_PYRAMID = "stage.pyramid"
+STAGE_TILES = "stage.tiles"
+STAGE_PARSE = "stage.parse"
+STAGE_HEADER_VERIFY = "stage.header_verify"
+STAGE_HEADER_SEAL = "stage.header_seal"
+STAGE_EXPIRY_CHECK = "stage.expiry_check"
+STAGE_NTP = "stage.ntp"
+STAGE_HKDF = "stage.hkdf"
+STAGE_KEY_MATERIAL = "stage.key_material"
+STAGE_GHASH = "stage.ghash"
+STAGE_CTR = "stage.ctr"
+STAGE_DECRYPT = "stage.decrypt"
+STAGE_ENCRYPT = "stage.encrypt"
+STAGE_WRITE = "stage.write"
+STAGE_DECODE = "stage.decode"
+STAGE_THUMBNAIL = "stage.thumbnail"
+STAGE_ENCODE = "stage.encode"
+
+_SUB_BUCKET_BITS = 7
+_SUB_BUCKET_COUNT = 1 << _SUB_BUCKET_BITS
+_SUB_BUCKET_HALF = _SUB_BUCKET_COUNT >> 1
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = 0
+
+
+class Gauge:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def reset(self):
+        # Gauges describe current state, so a reset leaves them alone
+        pass
+
+
+class Histogram:
+    def __init__(self):
+        self._buckets = {}
+        self._count = 0
+        self._sum = 0
+        self._min = None
+        self._max = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bucket_index(value: int) -> int:
+        if value < _SUB_BUCKET_COUNT:
+            return value
+        shift = value.bit_length() - _SUB_BUCKET_BITS
+        return shift * _SUB_BUCKET_HALF + (value >> shift)
+
+    @staticmethod
+    def _bucket_upper(index: int) -> int:
+        if index < _SUB_BUCKET_COUNT:
+            return index
+        shift = (index - _SUB_BUCKET_HALF) // _SUB_BUCKET_HALF
+        mantissa = index - shift * _SUB_BUCKET_HALF
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value_us: int):
+        value_us = max(0, int(value_us))
+        index = self._bucket_index(value_us)
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self._count += 1
+            self._sum += value_us
+            if self._min is None or value_us < self._min:
+                self._min = value_us
+            if value_us > self._max:
+                self._max = value_us
+
+    def record_seconds(self, seconds: float):
+        self.record(seconds * 1_000_000)
+
+    def value_at_percentile(self, percentile: float) -> int:
+        with self._lock:
+            if self._count == 0:
+                return 0
+            target = max(1, int(round(self._count * percentile / 100.0)))
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= target:
+                    return min(self._bucket_upper(index), self._max)
+            return self._max
+
+    def snapshot(self) -> dict:
+        count = self._count
+        if count == 0:
+            return {"count": 0}
+        return {
+            "count": count,
+            "min_ms": self._min / 1000.0,
+            "mean_ms": self._sum / count / 1000.0,
+            "p50_ms": self.value_at_percentile(50) / 1000.0,
+            "p90_ms": self.value_at_percentile(90) / 1000.0,
+            "p99_ms": self.value_at_percentile(99) / 1000.0,
+            "p999_ms": self.value_at_percentile(99.9) / 1000.0,
+            "max_ms": self._max / 1000.0,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._buckets = {}
+            self._count = 0
+            self._sum = 0
+            self._min = None
+            self._max = 0
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def _get_or_create(self, table: dict, name: str, factory):
+        metric = table.get(name)
+        if metric is None:
+            with self._lock:
+                metric = table.get(name)
+                if metric is None:
+                    metric = factory()
+                    table[name] = metric
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_create(self._counters, name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get_or_create(self._gauges, name, Gauge)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get_or_create(self._histograms, name, Histogram)
+
+    def observe(self, name: str, seconds: float):
+        self.histogram(name).record_seconds(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self, reset: bool = False) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = dict(self._histograms)
+        result = {
+            "uptime_s": time.time() - self._started,
+            "counters": {name: c.value for name, c in sorted(counters.items())},
+            "gauges": {name: g.value for name, g in sorted(gauges.items())},
+            "histograms": {name: h.snapshot() for name, h in sorted(histograms.items())},
+        }
+        if reset:
+            for metric in list(counters.values()) + list(histograms.values()):
+                metric.reset()
+        return result
+
+
+registry = MetricsRegistry()
+
+
+def observe(name: str, seconds: float):
+    registry.observe(name, seconds)
+
+
+def inc(name: str, amount: int = 1):
+    registry.counter(name).inc(amount)
+
+
+def timer(name: str):
+    return registry.timer(name)
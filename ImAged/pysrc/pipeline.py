@@ -0,0 +1,135 @@
+"""
+Bounded multi-stage pipeline for per-file work.
+
+Each stage runs on its own worker threads and hands items to the next
+through a bounded queue, so while one file is being decrypted the next is
+already being read and the previous one resized. The queue bounds are
+the read-ahead: a fast reader gets at most that many files ahead of the
+CPU stages, which keeps memory flat on large batches.
+
+An item that fails in any stage skips the remaining stages and comes out
+as (key, None, exception). Results come out in completion order. If the
+items iterable itself raises, the pipeline stops and the consumer gets
+that exception.
+
+Workers run in a copy of the caller's context, so the request id used
+for tracing and the request's cancellation flag carry over to them.
+"""
+
+import contextvars
+import queue
+import threading
+import time
+
+import metrics
+
+_DONE = object()
+# How often blocked workers wake up to check for a stop request
+_POLL_INTERVAL = 0.1
+
+
+class Stage:
+    __slots__ = ("name", "fn", "workers")
+
+    def __init__(self, name: str, fn, workers: int = 1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+
+
+class Pipeline:
+    def __init__(self, stages, depth: int = 4):
+        self.stages = list(stages)
+        self.depth = max(1, depth)
+
+    def run(self, items, stop: threading.Event = None):
+        """Feed (key, value) pairs through every stage.
+
+        Generator of (key, result, error). Closing it early, or setting
+        stop, makes the workers drop queued items and exit at the next
+        stage boundary. An exception raised by items is re-raised here.
+        """
+        # The caller's stop event is only read; halt also covers closing
+        halt = threading.Event()
+        feed_error = []
+
+        def stopped() -> bool:
+            return halt.is_set() or (stop is not None and stop.is_set())
+
+        queues = [queue.Queue(self.depth) for _ in range(len(self.stages) + 1)]
+        threads = []
+
+        def put(q, entry) -> bool:
+            while not stopped():
+                try:
+                    q.put(entry, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def feed():
+            try:
+                for key, value in items:
+                    if not put(queues[0], (key, value, None)):
+                        return
+            except Exception as e:
+                feed_error.append(e)
+                halt.set()
+                return
+            put(queues[0], _DONE)
+
+        def work(index, stage, remaining):
+            inbox, outbox = queues[index], queues[index + 1]
+            while not stopped():
+                try:
+                    entry = inbox.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if entry is _DONE:
+                    # Let sibling workers see it too; the last one passes it on
+                    put(inbox, _DONE)
+                    with remaining[1]:
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    if last:
+                        put(outbox, _DONE)
+                    return
+                key, value, error = entry
+                if error is None:
+                    start = time.perf_counter()
+                    try:
+                        value = stage.fn(value)
+                    except Exception as e:
+                        value, error = None, e
+                    metrics.observe(f"pipeline.{stage.name}", time.perf_counter() - start)
+                if not put(outbox, (key, value, error)):
+                    return
+
+        context = contextvars.copy_context()
+        threads.append(threading.Thread(target=context.copy().run, args=(feed,),
+                                        name="imaged-pipeline-feed", daemon=True))
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers, threading.Lock()]
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=context.copy().run, args=(work, index, stage, remaining),
+                                                name=f"imaged-pipeline-{stage.name}-{n}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        results = queues[-1]
+        try:
+            while True:
+                try:
+                    entry = results.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    if feed_error:
+                        raise feed_error[0]
+                    if stopped():
+                        return
+                    continue
+                if entry is _DONE:
+                    return
+                yield entry
+        finally:
+            halt.set()
@@ -7,12 +7,24 @@ import os
 import gc
 import weakref
 import signal
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import serialization, hashes, padding as sym_padding
 from cryptography.hazmat.primitives.asymmetric import rsa, padding as asym_padding
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+import cancellation
+import config
+import metrics
+import tracing
+from logging_setup import SAMPLED, configure_logging
+
 # Disable tkinter message boxes to prevent popups
 try:
     import tkinter as tk
@@ -30,9 +42,78 @@ try:
 except ImportError:
     pass
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+NTP_REFRESH_INTERVAL = 30
+DEFAULT_THUMBNAIL_SIZE = 1024
+STDIN_LINE_LIMIT = 64 * 1024 * 1024
+
+# Request priorities from the command envelope, most urgent first. The
+# async dispatcher always starts the most urgent queued request next.
+PRIORITIES = ("visible", "prefetch", "background")
+DEFAULT_PRIORITY = "visible"
+CANCELLED_ERROR = "Cancelled"
+
+# Every command dispatch_command handles. Metric and span names are built
+# only from these; anything else a client sends counts as "unknown".
+COMMANDS = frozenset((
+    "CONVERT_TO_TTL", "OPEN_TTL", "CANCEL", "OPEN_TTL_BATCH", "BATCH_CONVERT", "GET_REGION",
+    "EXTEND_TTL", "LIST_TTL", "WATCH_DIRECTORY", "UNWATCH_DIRECTORY", "SUBSCRIBE_EXPIRY",
+    "UNSUBSCRIBE_EXPIRY", "GET_CONFIG", "SET_CONFIG", "GET_METRICS", "SET_TRACING", "EXPORT_TRACE",
+))
+
+
+def _norm_path(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+class _Job:
+    """A parsed request waiting for (or holding) a dispatcher slot."""
+    __slots__ = ("parsed", "request_id", "priority", "cancel", "context", "queued_at", "running")
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+        self.request_id = parsed["request_id"]
+        self.priority = parsed["priority"]
+        self.cancel = threading.Event()
+        self.context = contextvars.copy_context()
+        self.queued_at = time.perf_counter()
+        self.running = False
+
+class _LoopTimer:
+    """threading.Timer look-alike scheduled on the asyncio loop.
+
+    The callback runs in the backend executor so slow cleanups (gc passes)
+    never stall the loop.
+    """
+
+    def __init__(self, loop, executor, interval, function, args=None, kwargs=None):
+        self._loop = loop
+        self._executor = executor
+        self.interval = interval
+        self.function = function
+        self.args = args if args is not None else []
+        self.kwargs = kwargs if kwargs is not None else {}
+        self._handle = None
+        self._cancelled = False
+
+    def start(self):
+        self._loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        if not self._cancelled:
+            self._handle = self._loop.call_later(self.interval, self._fire)
+
+    def _fire(self):
+        if not self._cancelled:
+            self._loop.run_in_executor(self._executor, functools.partial(self.function, *self.args, **self.kwargs))
+
+    def cancel(self):
+        self._cancelled = True
+        handle = self._handle
+        if handle is not None:
+            self._loop.call_soon_threadsafe(handle.cancel)
+
 class SecureBackend:
     _instance = None
     _initialized = False
@@ -48,10 +129,40 @@ class SecureBackend:
             self.private_key = None
             self.public_key = None
             self._memory_pool = weakref.WeakSet()
+            self._write_lock = threading.Lock()
+            self._loop = None
+            self._executor = None
+            self._stdin_executor = None
+            self._out_queue = None
+            self._protocol_out = sys.stdout
+            self._watcher = None
+            self._expiry_listener = None
+            self._expiry_paths = set()
+            self._job_queue = None
+            self._jobs_lock = threading.Lock()
+            self._jobs = set()
+            self._job_seq = 0
+            self._thumbnail_max_size = DEFAULT_THUMBNAIL_SIZE
+            self._apply_config(config.load_config(), {"thumbnail_max_size"})
+            config.subscribe(self._apply_config)
             self.establish_secure_channel()
+            self._start_expiry_sweeper()
             logger.info("Secure backend initialized")
             SecureBackend._initialized = True
 
+    def _apply_config(self, cfg, changed):
+        if "thumbnail_max_size" in changed:
+            self._thumbnail_max_size = cfg.get("thumbnail_max_size", DEFAULT_THUMBNAIL_SIZE)
+
+    def _start_expiry_sweeper(self):
+        if not config.load_config().get("expiry_sweeper", True):
+            return
+        try:
+            import expiry_sweeper
+            expiry_sweeper.get_sweeper().start()
+        except Exception as e:
+            logger.error(f"Could not start expiry sweeper: {e}")
+
     def establish_secure_channel(self):
         try:
             self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
@@ -100,36 +211,19 @@ class SecureBackend:
 
                 encrypted_payload = base64.b64decode(line)
                 response = self.process_command(encrypted_payload)
-
-                if isinstance(response, tuple) and len(response) == 3 and response[0] == "STREAM":
-                    _, meta, payload = response
-                    encrypted_meta = self.encrypt_data(json.dumps(meta).encode())
-                    sys.stdout.write(base64.b64encode(encrypted_meta).decode() + "\n")
-                    sys.stdout.flush()
-
-                    encrypted_payload_out = self.encrypt_data(payload)
-                    sys.stdout.write(base64.b64encode(encrypted_payload_out).decode() + "\n")
-                    sys.stdout.flush()
+                if self._is_multi(response):
+                    for part in response[1]:
+                        self._write_lines(self._format_response_lines(part))
                 else:
-                    encrypted_response = self.encrypt_data(json.dumps(response).encode())
-                    response_base64 = base64.b64encode(encrypted_response).decode()
-                    sys.stdout.write(response_base64 + "\n")
-                    sys.stdout.flush()
-                logger.info("Response sent and flushed")
+                    self._write_lines(self._format_response_lines(response))
+                logger.debug("Response sent and flushed")
 
             except Exception as e:
                 logger.error(f"Error processing command: {e}")
                 # Don't send error response if it's a GCM error, just continue
                 if "mac check in GCM failed" not in str(e) and "InvalidTagException" not in str(e):
                     try:
-                        error_response = {
-                            "success": False,
-                            "error": str(e),
-                            "result": None
-                        }
-                        encrypted_error = self.encrypt_data(json.dumps(error_response).encode())
-                        sys.stdout.write(base64.b64encode(encrypted_error).decode() + "\n")
-                        sys.stdout.flush()
+                        self._write_lines(self._format_error_lines(e))
                     except:
                         # If we can't even send an error response, just continue silently
                         pass
@@ -144,52 +238,412 @@ class SecureBackend:
                 logger.error("Unexpected error in command processing loop, continuing...")
                 continue
 
-    def process_command(self, encrypted_payload):
+    def process_commands_async(self):
+        """Event-loop variant of process_commands.
+
+        Frames are read from stdin without blocking the loop, each command runs
+        in a worker thread, NTP refreshes run on the loop and a single writer
+        task serializes everything that goes back over stdout.
+        """
+        logger.info("Starting asyncio command processing loop")
+        asyncio.run(self._async_command_loop())
+
+    async def _async_command_loop(self):
+        from secure_image_service import SecureImageService
+
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self._out_queue = asyncio.Queue()
+        workers = max(2, min(8, os.cpu_count() or 2))
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="imaged-worker"
+        )
+        writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="imaged-writer")
+        SecureImageService.timer_factory = functools.partial(_LoopTimer, loop, self._executor)
+        # Workers run concurrently, so a stray print() could split a protocol
+        # line; only the writer task touches the real stdout from here on.
+        sys.stdout = sys.stderr
+
+        writer = asyncio.create_task(self._writer_task(writer_executor))
+        ntp_refresh = asyncio.create_task(self._ntp_refresh_task())
+        # One dispatcher per worker thread, so requests wait in the priority
+        # queue (where they can be reordered or cancelled), not the executor's
+        self._job_queue = asyncio.PriorityQueue()
+        dispatchers = [asyncio.create_task(self._dispatcher_task()) for _ in range(workers)]
+        pending = set()
+        try:
+            readline = await self._open_stdin_reader()
+            while True:
+                line = await readline()
+                line = line.strip() if line else b""
+                if not line:
+                    logger.info("No more input, shutting down")
+                    break
+                task = asyncio.create_task(self._handle_line_async(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            await self._job_queue.join()
+        finally:
+            for dispatcher in dispatchers:
+                dispatcher.cancel()
+            ntp_refresh.cancel()
+            await self._out_queue.put(None)
+            await writer
+            SecureImageService.timer_factory = threading.Timer
+            sys.stdout = self._protocol_out
+            self._executor.shutdown(wait=False)
+            if self._stdin_executor is not None:
+                self._stdin_executor.shutdown(wait=False)
+                self._stdin_executor = None
+            writer_executor.shutdown(wait=True)
+            self._loop = None
+
+    async def _open_stdin_reader(self):
+        loop = asyncio.get_running_loop()
+        try:
+            reader = asyncio.StreamReader(limit=STDIN_LINE_LIMIT)
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            return reader.readline
+        except (NotImplementedError, OSError, ValueError) as e:
+            # Anonymous pipes can't be registered with every event loop
+            # (e.g. Windows proactor); fall back to a dedicated reader thread.
+            logger.info(f"Pipe reader unavailable ({e}), using threaded stdin reads")
+            stdin_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="imaged-stdin")
+            self._stdin_executor = stdin_executor
+
+            async def readline():
+                return await loop.run_in_executor(stdin_executor, sys.stdin.buffer.readline)
+            return readline
+
+    async def _handle_line_async(self, line):
+        try:
+            encrypted_payload = base64.b64decode(line)
+            try:
+                parsed = self.parse_command(encrypted_payload)
+            except Exception as e:
+                logger.error(f"Error processing command: {e}")
+                await self._out_queue.put(self._format_response_lines(self._command_error(e)))
+                return
+            if parsed["command"] == "CANCEL":
+                # Answered on the loop so it never waits behind the work it cancels
+                await self._out_queue.put(self._format_response_lines(self.process_command(None, parsed)))
+                return
+            job = _Job(parsed)
+            with self._jobs_lock:
+                self._jobs.add(job)
+                self._job_seq += 1
+                seq = self._job_seq
+            metrics.registry.gauge("dispatch.queued").inc()
+            await self._job_queue.put((PRIORITIES.index(job.priority), seq, job))
+        except Exception as e:
+            logger.error(f"Error processing command: {e}")
+            if "mac check in GCM failed" not in str(e) and "InvalidTagException" not in str(e):
+                try:
+                    await self._out_queue.put(self._format_error_lines(e))
+                except Exception:
+                    pass
+
+    async def _dispatcher_task(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._job_queue.get()
+            metrics.registry.gauge("dispatch.queued").dec()
+            try:
+                metrics.observe(f"dispatch.wait.{job.priority}", time.perf_counter() - job.queued_at)
+                if job.cancel.is_set():
+                    # Already answered by the CANCEL that dropped it
+                    continue
+                job.running = True
+                await loop.run_in_executor(self._executor, job.context.run, self._run_job, job)
+            except Exception as e:
+                logger.error(f"Error processing command: {e}")
+                try:
+                    await self._out_queue.put(self._format_error_lines(e))
+                except Exception:
+                    pass
+            finally:
+                with self._jobs_lock:
+                    self._jobs.discard(job)
+                self._job_queue.task_done()
+
+    def _run_job(self, job):
+        token = cancellation.bind(job.cancel)
         try:
-            cmd_length = struct.unpack('>I', encrypted_payload[:4])[0]
-            encrypted_command = encrypted_payload[4:4+cmd_length]
-
-            decrypted_command = self.decrypt_data(encrypted_command)
-            command_data = json.loads(decrypted_command.decode())
-
-            command = command_data.get('Command') or command_data.get('command')
-            parameters = command_data.get('Parameters', {}) or command_data.get('parameters', {})
-
-            if command == "CONVERT_TO_TTL":
-                return self.handle_convert_to_ttl(parameters)
-            elif command == "OPEN_TTL":
-                return self.handle_open_ttl(parameters)
-            elif command == "BATCH_CONVERT":
-                return self.handle_batch_convert(parameters)
-            elif command == "GET_CONFIG":
-                return self.handle_get_config(parameters)
-            elif command == "SET_CONFIG":
-                return self.handle_set_config(parameters)
+            response = self.process_command(None, job.parsed)
+            if self._is_multi(response):
+                # Parts are produced and queued as they finish
+                self._stream_multi(response)
+            elif job.cancel.is_set():
+                # Cancelled mid-flight: whatever the handler returned is moot
+                metrics.inc("dispatch.cancelled_running")
+                self._enqueue_lines(self._format_response_lines(self._cancelled_response(job.request_id)))
             else:
-                return {
-                    "success": False,
-                    "error": f"Unknown command: {command}",
-                    "result": None
-                }
+                self._enqueue_lines(self._format_response_lines(response))
+        finally:
+            cancellation.unbind(token)
+
+    @staticmethod
+    def _cancelled_response(request_id):
+        response = {"success": False, "error": CANCELLED_ERROR, "result": None, "cancelled": True}
+        if request_id is not None:
+            response["request_id"] = request_id
+        return response
+
+    async def _writer_task(self, writer_executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            lines = await self._out_queue.get()
+            if lines is None:
+                break
+            try:
+                await loop.run_in_executor(writer_executor, self._write_lines, lines)
+                logger.debug("Response sent and flushed")
+            except Exception as e:
+                logger.error(f"Failed to write response: {e}")
+
+    async def _ntp_refresh_task(self):
+        from time_utils import fetch_ntp_time_async
+        while True:
+            try:
+                await fetch_ntp_time_async()
+            except RuntimeError:
+                pass
+            await asyncio.sleep(NTP_REFRESH_INTERVAL)
+
+    def _format_response_lines(self, response):
+        with tracing.span("pipe.encode", cat="pipe"):
+            if isinstance(response, tuple) and len(response) == 3 and response[0] == "STREAM":
+                _, meta, payload = response
+                encrypted_meta = self.encrypt_data(json.dumps(meta).encode())
+                encrypted_payload_out = self.encrypt_data(payload)
+                return [
+                    base64.b64encode(encrypted_meta).decode(),
+                    base64.b64encode(encrypted_payload_out).decode()
+                ]
+            encrypted_response = self.encrypt_data(json.dumps(response).encode())
+            return [base64.b64encode(encrypted_response).decode()]
+
+    @staticmethod
+    def _is_multi(response):
+        return isinstance(response, tuple) and len(response) == 2 and response[0] == "MULTI"
+
+    def _multi_parts(self, parts, request_id):
+        # A MULTI response is ("MULTI", iterator of responses); each part is
+        # sent as its own message. A handler failing mid-stream still ends
+        # the stream with an error message.
+        try:
+            for part in parts:
+                if cancellation.is_cancelled():
+                    # Stops the producer (e.g. the render pipeline) too
+                    parts.close()
+                    metrics.inc("dispatch.cancelled_running")
+                    yield self._cancelled_response(request_id)
+                    return
+                yield self._attach_request_id(part, request_id)
+        except Exception as e:
+            logger.error(f"Error streaming response: {e}")
+            yield self._attach_request_id({"success": False, "error": str(e), "result": None}, request_id)
+
+    def _timed_parts(self, parts, command, trace_id, start):
+        # Each part is produced under the request's trace id; the command
+        # latency covers the whole stream, recorded when it ends
+        stream_start = time.perf_counter()
+        try:
+            while True:
+                trace_token = tracing.begin_request(trace_id)
+                try:
+                    part = next(parts, None)
+                finally:
+                    tracing.end_request(trace_token)
+                if part is None:
+                    return
+                yield part
+        finally:
+            parts.close()
+            end = time.perf_counter()
+            trace_token = tracing.begin_request(trace_id)
+            try:
+                tracing.record(f"command.{command}.stream", stream_start, end, cat="command")
+            finally:
+                tracing.end_request(trace_token)
+            metrics.observe(f"command.{command}", end - start)
+
+    def _stream_multi(self, response):
+        for part in response[1]:
+            self._enqueue_lines(self._format_response_lines(part))
+
+    def _enqueue_lines(self, lines):
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._out_queue.put_nowait, lines)
+        else:
+            self._write_lines(lines)
+
+    def _format_error_lines(self, error):
+        error_response = {
+            "success": False,
+            "error": str(error),
+            "result": None
+        }
+        return self._format_response_lines(error_response)
+
+    def _write_lines(self, lines):
+        # Multi-line responses (STREAM) must never interleave with other output
+        with self._write_lock, tracing.span("pipe.write", cat="pipe", bytes=sum(len(line) for line in lines)):
+            for line in lines:
+                self._protocol_out.write(line + "\n")
+            self._protocol_out.flush()
+
+    def send_event(self, event, result):
+        """Push an unsolicited message to the client; safe from any thread.
+
+        Events carry an "event" key instead of a request id and are only sent
+        after the client has opted in (e.g. WATCH_DIRECTORY).
+        """
+        lines = self._format_response_lines({"event": event, "success": True, "error": None, "result": result})
+        try:
+            self._enqueue_lines(lines)
+            metrics.inc(f"events.{event}")
+        except Exception as e:
+            logger.error(f"Failed to send {event} event: {e}")
+
+    def parse_command(self, encrypted_payload):
+        """Decrypt a command frame into command, parameters, request_id, priority."""
+        cmd_length = struct.unpack('>I', encrypted_payload[:4])[0]
+        encrypted_command = encrypted_payload[4:4+cmd_length]
+
+        decrypted_command = self.decrypt_data(encrypted_command)
+        command_data = json.loads(decrypted_command.decode())
+
+        priority = command_data.get('Priority') or command_data.get('priority') or DEFAULT_PRIORITY
+        if priority not in PRIORITIES:
+            logger.warning(f"Unknown priority {priority!r}, using {DEFAULT_PRIORITY}")
+            priority = DEFAULT_PRIORITY
+        return {
+            "command": command_data.get('Command') or command_data.get('command'),
+            "parameters": command_data.get('Parameters', {}) or command_data.get('parameters', {}),
+            "request_id": command_data.get('RequestId') or command_data.get('request_id'),
+            "priority": priority,
+        }
+
+    def process_command(self, encrypted_payload, parsed=None):
+        try:
+            if parsed is None:
+                parsed = self.parse_command(encrypted_payload)
+            command = parsed["command"]
+            parameters = parsed["parameters"]
+            request_id = parsed["request_id"]
+            name = command if isinstance(command, str) and command in COMMANDS else "unknown"
+
+            trace_token = tracing.begin_request(request_id)
+            try:
+                start = time.perf_counter()
+                with tracing.span(f"command.{name}", cat="command"):
+                    response = self.dispatch_command(command, parameters)
+                if self._is_multi(response):
+                    # The handler only built a generator; the work happens as
+                    # the stream is consumed, so it is timed there
+                    response = "MULTI", self._timed_parts(response[1], name, tracing.current_request_id(), start)
+                else:
+                    metrics.observe(f"command.{name}", time.perf_counter() - start)
+            finally:
+                tracing.end_request(trace_token)
+            metrics.inc(f"commands.{name}")
+            if isinstance(response, dict) and not response.get("success", True):
+                metrics.inc(f"errors.{name}")
+
+            return self._attach_request_id(response, request_id)
 
         except Exception as e:
             logger.error(f"Error processing command: {e}")
-            # Don't return error response for GCM errors, just return a generic failure
-            if "mac check in GCM failed" in str(e) or "InvalidTagException" in str(e):
-                return {
-                    "success": False,
-                    "error": "Communication error",
-                    "result": None
-                }
+            return self._command_error(e)
+
+    @staticmethod
+    def _command_error(e):
+        # Don't return error response for GCM errors, just return a generic failure
+        if "mac check in GCM failed" in str(e) or "InvalidTagException" in str(e):
             return {
                 "success": False,
-                "error": str(e),
+                "error": "Communication error",
+                "result": None
+            }
+        return {
+            "success": False,
+            "error": str(e),
+            "result": None
+        }
+
+    def _attach_request_id(self, response, request_id):
+        # Echo the caller's request id so pipelined responses can be matched
+        if self._is_multi(response):
+            return "MULTI", self._multi_parts(response[1], request_id)
+        if request_id is None:
+            return response
+        if isinstance(response, tuple) and len(response) == 3 and response[0] == "STREAM":
+            response[1]["request_id"] = request_id
+        elif isinstance(response, dict):
+            response["request_id"] = request_id
+        return response
+
+    def dispatch_command(self, command, parameters):
+        if command == "CONVERT_TO_TTL":
+            return self.handle_convert_to_ttl(parameters)
+        elif command == "OPEN_TTL":
+            return self.handle_open_ttl(parameters)
+        elif command == "CANCEL":
+            return self.handle_cancel(parameters)
+        elif command == "OPEN_TTL_BATCH":
+            return self.handle_open_ttl_batch(parameters)
+        elif command == "BATCH_CONVERT":
+            return self.handle_batch_convert(parameters)
+        elif command == "GET_REGION":
+            return self.handle_get_region(parameters)
+        elif command == "EXTEND_TTL":
+            return self.handle_extend_ttl(parameters)
+        elif command == "LIST_TTL":
+            return self.handle_list_ttl(parameters)
+        elif command == "WATCH_DIRECTORY":
+            return self.handle_watch_directory(parameters)
+        elif command == "UNWATCH_DIRECTORY":
+            return self.handle_unwatch_directory(parameters)
+        elif command == "SUBSCRIBE_EXPIRY":
+            return self.handle_subscribe_expiry(parameters)
+        elif command == "UNSUBSCRIBE_EXPIRY":
+            return self.handle_unsubscribe_expiry(parameters)
+        elif command == "GET_CONFIG":
+            return self.handle_get_config(parameters)
+        elif command == "SET_CONFIG":
+            return self.handle_set_config(parameters)
+        elif command == "GET_METRICS":
+            return self.handle_get_metrics(parameters)
+        elif command == "SET_TRACING":
+            return self.handle_set_tracing(parameters)
+        elif command == "EXPORT_TRACE":
+            return self.handle_export_trace(parameters)
+        else:
+            return {
+                "success": False,
+                "error": f"Unknown command: {command}",
                 "result": None
             }
 
     def handle_open_ttl(self, parameters):
+        """Decrypt one container for display.
+
+        The result depends on the request:
+          - thumbnail_mode, or no target size: the image, base64-encoded;
+          - target_width / target_height (the viewer box): {"data" (base64),
+            "width", "height", "format", "scaled"}, scaled down to fit;
+          - output_format "raw": a STREAM response whose metadata is
+            {"width", "height", "stride", "pixel_format"} (plus "scaled"
+            with a target size), followed by the Bgra32 pixels.
+        """
         try:
-            logger.info(f"Received parameters: {parameters}")
+            logger.debug("open_ttl parameters: %s", sorted((parameters or {}).keys()))
         
             if parameters is None:
                 logger.error("Parameters is None")
@@ -197,23 +651,45 @@ class SecureBackend:
         
             input_path = parameters.get('input_path')
             thumbnail_mode = parameters.get('thumbnail_mode', False)
-            max_size = parameters.get('max_size', 1024)
+            max_size = parameters.get('max_size', self._thumbnail_max_size)
+            # "raw" sends Bgra32 pixels instead of an encoded image
+            output_format = parameters.get('output_format', 'encoded')
+            if output_format not in ('encoded', 'raw'):
+                return {"success": False, "error": "output_format must be encoded or raw", "result": None}
+            # Screen-fit render: the viewer box picks a pyramid level and the
+            # image is scaled down to it; the full size is fetched on zoom.
+            # display_width/display_height are accepted as older names.
+            target_size = None
+            width = parameters.get('target_width', parameters.get('display_width'))
+            height = parameters.get('target_height', parameters.get('display_height'))
+            if not thumbnail_mode and (width or height):
+                target_size = (width, height)
+                if not all(v is None or (isinstance(v, int) and v > 0) for v in target_size):
+                    return {"success": False, "error": "target_width/target_height must be positive integers", "result": None}
             
-            logger.info(f"Opening TTL file: {input_path} (thumbnail: {thumbnail_mode}, max_size: {max_size})")
+            logger.info("Opening TTL file: %s (thumbnail: %s, max_size: %s)", input_path, thumbnail_mode, max_size, extra=SAMPLED)
         
             try:
                 from secure_image_service import SecureImageService
                 service = SecureImageService()
             
                 if thumbnail_mode:
-                    payload_bytes = service.render_ttl_thumbnail_secure(input_path, max_size=max_size)
+                    payload_bytes = service.render_ttl_thumbnail_secure(input_path, max_size=max_size, output=output_format)
                 else:
-                    payload_bytes = service.render_ttl_image_secure(input_path, max_display_time=30)
+                    payload_bytes = service.render_ttl_image_secure(input_path, max_display_time=30,
+                                                                    output=output_format, target_size=target_size)
             
-                if payload_bytes:
+                if isinstance(payload_bytes, dict):
+                    self._track_memory_usage(len(payload_bytes["data"]))
+                    if "pixel_format" in payload_bytes:
+                        return self._raw_response(payload_bytes)
+                    # Screen-fit encoded render: size and whether it was scaled ride along
+                    result = dict(payload_bytes, data=base64.b64encode(payload_bytes["data"]).decode('utf-8'))
+                    return {"success": True, "error": None, "result": result}
+                elif payload_bytes:
                     payload_base64 = base64.b64encode(payload_bytes).decode('utf-8')
                 
-                    logger.info(f"Successfully converted {len(payload_bytes)} bytes to base64")
+                    logger.debug("Encoded %d bytes to base64", len(payload_bytes))
                     
                     self._track_memory_usage(len(payload_bytes))
                     
@@ -233,10 +709,154 @@ class SecureBackend:
             logger.error(f"Error in open_ttl: {e}")
             return {"success": False, "error": str(e), "result": None}
 
+    def handle_open_ttl_batch(self, parameters):
+        """Thumbnails (or full renders) for many files in one request.
+
+        Files are input_paths, or one page (page, page_size) of the valid
+        containers in directory. Streams one message per file as it
+        finishes, marked "partial" and carrying its index in the file list,
+        then a final summary message. A file that fails only fails its own
+        message. With output "atlas" the thumbnails come back instead as a
+        single STREAM response: the rectangle map, then one atlas image.
+        """
+        try:
+            parameters = parameters or {}
+            input_paths = parameters.get('input_paths')
+            page_info = None
+            if input_paths is None and parameters.get('directory'):
+                input_paths, page_info = self._directory_page(parameters)
+            if not isinstance(input_paths, list) or not input_paths:
+                return {"success": False, "error": "Provide a non-empty input_paths list or a non-empty directory page",
+                        "result": None}
+            thumbnail_mode = parameters.get('thumbnail_mode', True)
+            max_size = parameters.get('max_size', self._thumbnail_max_size)
+            output_format = parameters.get('output_format', 'encoded')
+            if output_format not in ('encoded', 'raw'):
+                return {"success": False, "error": "output_format must be encoded or raw", "result": None}
+
+            if parameters.get('output') == "atlas":
+                import thumbnail_atlas
+                atlas = thumbnail_atlas.build_atlas(input_paths, max_size)
+                data = atlas.pop("data")
+                if page_info:
+                    atlas.update(page_info)
+                self._track_memory_usage(len(data))
+                ok = len(atlas["failed"]) < len(input_paths)
+                error = f"{len(atlas['failed'])} file(s) failed" if atlas["failed"] else None
+                return "STREAM", {"success": ok, "error": error, "result": atlas}, data
+
+            from secure_image_service import SecureImageService
+            results = SecureImageService().render_many(input_paths, thumbnail=thumbnail_mode, max_size=max_size,
+                                                       output=output_format)
+            return "MULTI", self._open_batch_parts(input_paths, results)
+
+        except Exception as e:
+            logger.error(f"Error in open_ttl_batch: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    @staticmethod
+    def _raw_response(frame, partial=False, **fields):
+        # Pixel metadata first, then the pixels as their own binary line
+        result = {k: v for k, v in frame.items() if k != "data"}
+        result.update(fields)
+        meta = {"success": True, "error": None, "result": result}
+        if partial:
+            meta["partial"] = True
+        return "STREAM", meta, frame["data"]
+
+    @staticmethod
+    def _directory_page(parameters):
+        import ttl_index
+        directory = parameters['directory']
+        if not os.path.isdir(directory):
+            raise ValueError(f"Not a directory: {directory}")
+        page = int(parameters.get('page', 0))
+        page_size = int(parameters.get('page_size', 100))
+        if page < 0 or page_size <= 0:
+            raise ValueError("page must be >= 0 and page_size > 0")
+        listing = ttl_index.get_index().list_directory(directory, recursive=bool(parameters.get('recursive', False)))
+        paths = [entry["path"] for entry in listing["files"] if entry["valid"]]
+        return paths[page * page_size:(page + 1) * page_size], {"page": page, "page_size": page_size, "total": len(paths)}
+
+    def _open_batch_parts(self, input_paths, results):
+        positions = {}
+        for index, path in enumerate(input_paths):
+            positions.setdefault(path, []).append(index)
+        failed = payload_size = 0
+        for path, payload_bytes, error in results:
+            index = positions[path].pop(0)
+            if error is not None:
+                failed += 1
+                yield {"success": False, "error": error, "result": {"index": index, "path": path}, "partial": True}
+                continue
+            if isinstance(payload_bytes, dict):
+                payload_size += len(payload_bytes["data"])
+                yield self._raw_response(payload_bytes, index=index, path=path, partial=True)
+                continue
+            payload_size += len(payload_bytes)
+            yield {"success": True, "error": None, "partial": True,
+                   "result": {"index": index, "path": path, "data": base64.b64encode(payload_bytes).decode('utf-8')}}
+        self._track_memory_usage(payload_size)
+        ok = failed < len(input_paths)
+        yield {"success": ok, "error": f"{failed} file(s) failed" if failed else None,
+               "result": {"done": True, "count": len(input_paths), "failed": failed}}
+
+    def handle_cancel(self, parameters):
+        """Cancel requests by request_ids and/or by priority class.
+
+        Queued requests are dropped and answered as cancelled; running ones
+        stop at their next stage boundary. Outside the async dispatcher
+        requests run one at a time, so there is never anything to cancel.
+        """
+        try:
+            parameters = parameters or {}
+            request_ids = parameters.get('request_ids') or []
+            if parameters.get('request_id') is not None:
+                request_ids = list(request_ids) + [parameters['request_id']]
+            priorities = parameters.get('priorities') or []
+            unknown = [p for p in priorities if p not in PRIORITIES]
+            if unknown:
+                return {"success": False, "error": f"Unknown priorities: {unknown}", "result": None}
+            if not request_ids and not priorities:
+                return {"success": False, "error": "Provide request_ids or priorities", "result": None}
+
+            wanted = set(request_ids)
+            dropped = []
+            running = 0
+            found = set()
+            with self._jobs_lock:
+                for job in list(self._jobs):
+                    if job.cancel.is_set():
+                        continue
+                    if job.request_id in wanted or job.priority in priorities:
+                        job.cancel.set()
+                        found.add(job.request_id)
+                        if job.running:
+                            running += 1
+                        else:
+                            self._jobs.discard(job)
+                            dropped.append(job)
+            # Queued requests are answered now rather than when a dispatcher
+            # gets round to popping them
+            for job in dropped:
+                self._enqueue_lines(self._format_response_lines(self._cancelled_response(job.request_id)))
+            metrics.inc("dispatch.cancel_requests")
+            if dropped:
+                metrics.inc("dispatch.cancelled_queued", len(dropped))
+            return {"success": True, "error": None, "result": {
+                "cancelled_queued": len(dropped),
+                "cancelled_running": running,
+                "not_found": [r for r in request_ids if r not in found],
+            }}
+
+        except Exception as e:
+            logger.error(f"Error in cancel: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
     def handle_convert_to_ttl(self, parameters):
         """Convert an image to a TTL container via TTLFileManager"""
         try:
-            logger.info(f"handle_convert_to_ttl called with params: {parameters}")
+            logger.debug("convert_to_ttl parameters: %s", sorted((parameters or {}).keys()))
 
             if parameters is None:
                 return {"success": False, "error": "Parameters is None", "result": None}
@@ -252,7 +872,7 @@ class SecureBackend:
                 from file_manager import TTLFileManager
                 manager = TTLFileManager()
                 ttl_path = manager.create_ttl_file(input_path, expiry_ts, output_path)
-                logger.info(f"TTL file created at {ttl_path}")
+                logger.info("TTL file created at %s", ttl_path, extra=SAMPLED)
                 return {"success": True, "error": None, "result": ttl_path}
             except Exception as e:
                 logger.error(f"TTL creation failed: {e}")
@@ -261,11 +881,42 @@ class SecureBackend:
             logger.error(f"Error in handle_convert_to_ttl: {e}")
             return {"success": False, "error": str(e), "result": None}
 
+    def handle_batch_convert(self, parameters):
+        """Convert a list of images or a directory; incremental by default"""
+        try:
+            parameters = parameters or {}
+            from file_manager import TTLFileManager, find_images
+
+            input_paths = parameters.get('input_paths')
+            input_dir = parameters.get('input_dir')
+            if input_paths is None and input_dir:
+                if not os.path.isdir(input_dir):
+                    return {"success": False, "error": f"Not a directory: {input_dir}", "result": None}
+                input_paths = find_images(input_dir, recursive=bool(parameters.get('recursive', False)))
+            if not isinstance(input_paths, list):
+                return {"success": False, "error": "Provide input_paths (list) or input_dir", "result": None}
+
+            result = TTLFileManager().batch_convert(
+                input_paths,
+                output_dir=parameters.get('output_dir'),
+                expiry_ts=parameters.get('expiry_ts'),
+                incremental=bool(parameters.get('incremental', True)),
+            )
+            # Partial failures are reported per file; only an all-failed batch fails
+            failed = result["failed"]
+            ok = not failed or bool(result["converted"] or result["skipped"])
+            return {"success": ok, "error": f"{len(failed)} file(s) failed" if failed else None, "result": result}
+
+        except Exception as e:
+            logger.error(f"Error in batch_convert: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
     def _track_memory_usage(self, bytes_used):
         try:
             import psutil
             process = psutil.Process()
             memory_mb = process.memory_info().rss / (1024 * 1024)
+            metrics.registry.gauge("memory.rss_mb").set(round(memory_mb, 1))
             
             if memory_mb > 400: 
                 logger.warning(f"High memory usage detected: {memory_mb:.1f}MB, triggering cleanup")
@@ -288,16 +939,194 @@ class SecureBackend:
         # with mappingproxy objects and other internal Python structures
         logger.info("Secure memory cleanup completed")
 
+    def handle_get_region(self, parameters):
+        try:
+            parameters = parameters or {}
+            input_path = parameters.get('input_path')
+            if not input_path or not os.path.isfile(input_path):
+                return {"success": False, "error": "input_path missing or file not found", "result": None}
+            try:
+                x, y = int(parameters.get('x', 0)), int(parameters.get('y', 0))
+                width, height = int(parameters['width']), int(parameters['height'])
+                zoom = float(parameters.get('zoom', 1.0))
+            except (KeyError, TypeError, ValueError):
+                return {"success": False, "error": "Provide integer x, y, width, height and a numeric zoom", "result": None}
+
+            from file_manager import TTLFileManager
+            region = TTLFileManager().read_region(input_path, x, y, width, height, zoom)
+            payload_size = 0
+            for tile in region["tiles"]:
+                payload_size += len(tile["data"])
+                tile["data"] = base64.b64encode(tile["data"]).decode('utf-8')
+            self._track_memory_usage(payload_size)
+            return {"success": True, "error": None, "result": region}
+
+        except Exception as e:
+            logger.error(f"Error in get_region: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_extend_ttl(self, parameters):
+        try:
+            parameters = parameters or {}
+            input_path = parameters.get('input_path')
+            if not input_path:
+                return {"success": False, "error": "No input_path provided", "result": None}
+
+            expiry_ts = parameters.get('expiry_ts')
+            if expiry_ts is None:
+                import ttl_format
+                extend_seconds = parameters.get('extend_seconds')
+                if extend_seconds is None:
+                    extend_seconds = float(parameters.get('extend_hours', 0)) * 3600
+                if extend_seconds <= 0:
+                    return {"success": False, "error": "Provide expiry_ts, extend_seconds or extend_hours", "result": None}
+                expiry_ts = ttl_format.peek_header(input_path).expiry + extend_seconds
+
+            from file_manager import TTLFileManager
+            result = TTLFileManager().extend_ttl_file(input_path, int(expiry_ts))
+            return {"success": True, "error": None, "result": result}
+
+        except Exception as e:
+            logger.error(f"Error in extend_ttl: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_list_ttl(self, parameters):
+        try:
+            directory = (parameters or {}).get('directory')
+            if not directory or not os.path.isdir(directory):
+                return {"success": False, "error": f"Not a directory: {directory}", "result": None}
+            recursive = bool(parameters.get('recursive', False))
+
+            import ttl_index
+            from time_utils import get_cached_time
+            listing = ttl_index.get_index().list_directory(directory, recursive=recursive)
+
+            # Expiry is advisory here; OPEN_TTL still enforces it against NTP
+            now = get_cached_time()
+            time_trusted = now is not None
+            if now is None:
+                now = time.time()
+            for entry in listing["files"]:
+                expiry = entry["expiry"]
+                entry["expired"] = expiry is not None and now > expiry
+            listing.update({"directory": directory, "now": now, "time_trusted": time_trusted})
+            return {"success": True, "error": None, "result": listing}
+
+        except Exception as e:
+            logger.error(f"Error in list_ttl: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_watch_directory(self, parameters):
+        try:
+            directory = (parameters or {}).get('directory')
+            if not directory or not os.path.isdir(directory):
+                return {"success": False, "error": f"Not a directory: {directory}", "result": None}
+            recursive = bool(parameters.get('recursive', False))
+
+            if self._watcher is None:
+                import ttl_watcher
+                self._watcher = ttl_watcher.TTLWatcher(
+                    lambda changes: self.send_event("ttl_changed", {"changes": changes})
+                )
+            listing = self._watcher.watch(directory, recursive=recursive)
+            listing.update({"directory": directory, "watcher": self._watcher.backend})
+            return {"success": True, "error": None, "result": listing}
+
+        except Exception as e:
+            logger.error(f"Error in watch_directory: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_unwatch_directory(self, parameters):
+        try:
+            directory = (parameters or {}).get('directory')
+            removed = self._watcher is not None and self._watcher.unwatch(directory)
+            return {"success": True, "error": None, "result": {"directory": directory, "removed": bool(removed)}}
+
+        except Exception as e:
+            logger.error(f"Error in unwatch_directory: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def _push_expired(self, batch):
+        from time_utils import get_cached_time
+        # The sweeper reports every indexed file; only push the subscribed
+        # ones, each once
+        files = []
+        for item in batch:
+            key = _norm_path(item["path"])
+            if key in self._expiry_paths:
+                self._expiry_paths.discard(key)
+                files.append(item)
+        if files:
+            self.send_event("ttl_expired", {"files": files, "now": get_cached_time()})
+
+    def handle_subscribe_expiry(self, parameters):
+        try:
+            import expiry_sweeper
+            import ttl_index
+            from time_utils import get_current_time_with_fallback
+
+            sweeper = expiry_sweeper.get_sweeper()
+            # Started only if the config allows it; with the sweeper off the
+            # reply still lists expired files but nothing will be pushed
+            push_enabled = config.load_config().get("expiry_sweeper", True)
+            if push_enabled:
+                self._start_expiry_sweeper()
+            if push_enabled and self._expiry_listener is None:
+                self._expiry_listener = self._push_expired
+                sweeper.add_listener(self._expiry_listener)
+
+            # Index the files the UI is showing so they get scheduled; files
+            # already past expiry are answered here, later ones are pushed
+            index = ttl_index.get_index()
+            now, _ = get_current_time_with_fallback()
+            tracked, expired, errors = [], [], []
+            for path in (parameters or {}).get('paths') or []:
+                try:
+                    entry = index.get(path)
+                except OSError as e:
+                    errors.append({"path": path, "error": str(e)})
+                    continue
+                expiry = entry.get("expiry")
+                if not entry.get("valid") or expiry is None:
+                    errors.append({"path": path, "error": entry.get("error", "Invalid TTL file")})
+                elif now > expiry:
+                    expired.append({"path": path, "expiry": expiry})
+                else:
+                    tracked.append({"path": path, "expiry": expiry})
+                    if push_enabled:
+                        self._expiry_paths.add(_norm_path(path))
+
+            return {"success": True, "error": None, "result": {
+                "tracked": tracked,
+                "expired": expired,
+                "errors": errors,
+                "now": now,
+                "next_expiry": sweeper.next_expiry() if push_enabled else None,
+                "push_enabled": push_enabled,
+            }}
+
+        except Exception as e:
+            logger.error(f"Error in subscribe_expiry: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_unsubscribe_expiry(self, parameters):
+        try:
+            if self._expiry_listener is not None:
+                import expiry_sweeper
+                expiry_sweeper.get_sweeper().remove_listener(self._expiry_listener)
+                self._expiry_listener = None
+            self._expiry_paths = set()
+            return {"success": True, "error": None, "result": "Unsubscribed"}
+
+        except Exception as e:
+            logger.error(f"Error in unsubscribe_expiry: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
     def handle_get_config(self, parameters):
         try:
-            logger.info("Starting handle_get_config")
-            from config import load_config
-            logger.info("Imported config module")
-            config = load_config()
-            logger.info(f"Loaded config: {config}")
-            result = {"success": True, "error": None, "result": config}
-            logger.info(f"Returning result: {result}")
-            return result
+            cfg = config.load_config()
+            logger.debug("get_config: %d keys", len(cfg))
+            return {"success": True, "error": None, "result": cfg}
 
         except Exception as e:
             logger.error(f"Error in get_config: {e}")
@@ -305,14 +1134,49 @@ class SecureBackend:
 
 
 
+    def handle_get_metrics(self, parameters):
+        try:
+            reset = bool((parameters or {}).get('reset', False))
+            return {"success": True, "error": None, "result": metrics.registry.snapshot(reset=reset)}
+
+        except Exception as e:
+            logger.error(f"Error in get_metrics: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_set_tracing(self, parameters):
+        try:
+            parameters = parameters or {}
+            tracing.tracer.enable(parameters.get('enabled', True))
+            if parameters.get('clear', False):
+                tracing.tracer.clear()
+            return {"success": True, "error": None, "result": {"enabled": tracing.tracer.enabled}}
+
+        except Exception as e:
+            logger.error(f"Error in set_tracing: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
+    def handle_export_trace(self, parameters):
+        """Return Chrome trace-event JSON, or write it to output_path."""
+        try:
+            parameters = parameters or {}
+            clear = bool(parameters.get('clear', False))
+            output_path = parameters.get('output_path')
+            if output_path:
+                count = tracing.tracer.write_chrome(output_path, clear=clear)
+                return {"success": True, "error": None, "result": {"path": output_path, "events": count}}
+            return {"success": True, "error": None, "result": tracing.tracer.export_chrome(clear=clear)}
+
+        except Exception as e:
+            logger.error(f"Error in export_trace: {e}")
+            return {"success": False, "error": str(e), "result": None}
+
     def handle_set_config(self, parameters):
         try:
             config_data = parameters.get('config')
             if not config_data:
                 return {"success": False, "error": "No config data provided", "result": None}
 
-            from config import save_config
-            save_config(config_data)
+            config.save_config(config_data)
 
             return {"success": True, "error": None, "result": "Configuration saved"}
 
@@ -345,9 +1209,19 @@ def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
+    use_async = "--async" in sys.argv[1:] or os.environ.get("IMAGED_ASYNC") == "1"
+
+    try:
+        configure_logging(config.load_config())
+    except Exception:
+        configure_logging()
+
     try:
         backend = SecureBackend()
-        backend.process_commands()
+        if use_async:
+            backend.process_commands_async()
+        else:
+            backend.process_commands()
     except KeyboardInterrupt:
         logger.info("Received interrupt signal, shutting down")
     except Exception as e:
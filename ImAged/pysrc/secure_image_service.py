@@ -1,5 +1,6 @@
 ﻿import gc
 import ctypes
+import os
 import threading
 import time
 import logging
@@ -7,233 +8,452 @@ from typing import Optional, Tuple
 from PIL import Image, ImageOps
 import io
 from aes_gcm import AES_GCM 
+import cancellation
+import config
+import metrics
+import tracing
+import ttl_format
+from pipeline import Pipeline, Stage
+from logging_setup import SAMPLED
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SESSION_SECONDS = 10
+
+# What render/thumbnail calls hand back: encoded image bytes, a PIL image,
+# or raw Bgra32 pixels (image_processor.to_bgra32)
+OUTPUT_ENCODED = "encoded"
+OUTPUT_IMAGE = "image"
+OUTPUT_RAW = "raw"
+
+
+# Screen-fit renders: JPEG quality and the Image.thumbnail() reducing_gap
+FIT_JPEG_QUALITY = 90
+FIT_REDUCING_GAP = 2.0
+
+
+def _fits(size, box) -> bool:
+    width, height = size
+    return (not box[0] or width <= box[0]) and (not box[1] or height <= box[1])
+
+
+_PROBE = object()
+
+
+def _thumbnail_size(size, max_size: int) -> tuple:
+    width, height = size
+    if width > height:
+        new_width = max_size
+        new_height = int(height * (max_size / width))
+    else:
+        new_height = max_size
+        new_width = int(width * (max_size / height))
+    # Ensure minimum size for quality
+    return max(new_width, 64), max(new_height, 64)
+
+
+def _close_to(size, other) -> bool:
+    # Within a pixel either way (rounding of the short side)
+    return abs(size[0] - other[0]) <= 1 and abs(size[1] - other[1]) <= 1
+
+
+def _output_size(result):
+    if isinstance(result, dict):
+        return len(result["data"])
+    return len(result) if isinstance(result, (bytes, bytearray)) else None
 
 
 class SecureImageService:
     
+    # Factory for session cleanup timers; the asyncio backend swaps in a
+    # loop-scheduled timer so cleanups don't each spawn a thread.
+    timer_factory = threading.Timer
+
     def __init__(self):
         self._active_sessions = {}
         self._cleanup_lock = threading.Lock()
     
-    def _log_timing(self, step_name, start_time, data_size=None):
-        elapsed = time.time() - start_time
+    def _log_timing(self, stage, start_time, data_size=None):
+        end_time = time.perf_counter()
+        elapsed = end_time - start_time
+        metrics.observe(stage, elapsed)
+        tracing.record(stage, start_time, end_time, cat="ttl")
         if data_size:
-            size_mb = data_size / (1024 * 1024)
-            speed = size_mb / elapsed if elapsed > 0 else 0
-            message = f"{step_name}: {elapsed:.3f}s | {size_mb:.2f} MB | {speed:.2f} MB/s"
-        else:
-            message = f"{step_name}: {elapsed:.3f}s"
-        
-        logging.info(message)
-        print(f"  {message}")
+            metrics.inc(f"bytes.{stage}", data_size)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %.3fs%s", stage, elapsed, f" | {data_size} bytes" if data_size else "")
     
-    def render_ttl_image_secure(self, ttl_path: str, max_display_time: int = 30) -> Optional[bytes]:
+    def render_ttl_image_secure(self, ttl_path: str, max_display_time: int = 30,
+                                output: str = OUTPUT_ENCODED, target_size=None):
+        """Decrypt a container for viewing.
+
+        Returns the stored image bytes, or with OUTPUT_RAW a to_bgra32()
+        dict; None on failure. target_size (width, height; either may be
+        None) is the viewer box: it picks the smallest pyramid level that
+        covers it and the image is scaled down to fit, returned as a dict
+        with data, width, height, format and scaled (raw frames carry
+        scaled as well).
+        """
         session_id = f"render_{hash(ttl_path)}_{int(time.time())}"
         
-        total_start = time.time()
-        print(f"Starting secure TTL rendering process")
-        logging.info(f"Starting secure TTL rendering process")
+        total_start = time.perf_counter()
+        logger.debug("Starting secure TTL rendering process")
         
         try:
             # Load encrypted TTL file into memory (remains encrypted)
-            step_start = time.time()
-            encrypted_bytes = self._load_encrypted_ttl(ttl_path)
-            self._log_timing("Load encrypted TTL", step_start, len(encrypted_bytes))
+            step_start = time.perf_counter()
+            encrypted_bytes, level, level_parts = self._load_for_display(ttl_path, target_size)
+            self._log_timing(metrics.STAGE_READ, step_start, len(encrypted_bytes))
+            cancellation.check()
             
             # Execute just-in-time decryption in memory only
-            step_start = time.time()
-            decrypted_bytes = self._decrypt_just_in_time_memory_only(encrypted_bytes)
-            self._log_timing("Decrypt TTL", step_start, len(decrypted_bytes))
-            
-            # Initialize automatic cleanup timer for memory management
-            step_start = time.time()
-            cleanup_timer = threading.Timer(
-                max_display_time, 
-                self._secure_cleanup_session, 
-                args=[session_id, decrypted_bytes]
-            )
-            cleanup_timer.start()
-            self._log_timing("Setup cleanup timer", step_start)
+            step_start = time.perf_counter()
+            decrypted_bytes = self._decrypt_just_in_time_memory_only(encrypted_bytes, level, level_parts)
+            self._log_timing("service.decrypt_total", step_start, len(decrypted_bytes))
+            cancellation.check()
             
-            # Track session metadata without storing decrypted content
-            step_start = time.time()
-            with self._cleanup_lock:
-                self._active_sessions[session_id] = {
-                    'encrypted_bytes': encrypted_bytes,
-                    'timer': cleanup_timer,
-                    'created': time.time(),
-                    'ttl_path': ttl_path
-                }
-            self._log_timing("Track session", step_start)
+            if target_size:
+                rendered = self._fit_output(decrypted_bytes, target_size, output)
+            else:
+                rendered = self._render_output(decrypted_bytes, output)
+
+            # Automatic cleanup timer; session metadata holds no decrypted content
+            self._track_session(session_id, ttl_path, encrypted_bytes, decrypted_bytes, max_display_time)
             
-            total_elapsed = time.time() - total_start
-            completion_message = f"Secure TTL rendering completed in {total_elapsed:.3f}s"
-            logging.info(completion_message)
-            print(completion_message)
-            logging.info(f"Secure render session {session_id} created, auto-cleanup in {max_display_time}s")
-            return decrypted_bytes
+            total_elapsed = time.perf_counter() - total_start
+            metrics.observe("op.render", total_elapsed)
+            tracing.record("op.render", total_start, total_start + total_elapsed, cat="ttl")
+            logger.info("Secure TTL rendering completed in %.3fs", total_elapsed, extra=SAMPLED)
+            logger.debug(f"Secure render session {session_id} created, auto-cleanup in {max_display_time}s")
+            return rendered
             
+        except cancellation.Cancelled:
+            logger.debug("Secure TTL rendering of %s cancelled", ttl_path)
+            return None
+
         except Exception as e:
-            total_elapsed = time.time() - total_start
+            total_elapsed = time.perf_counter() - total_start
+            metrics.inc("errors.render")
             error_message = f"Secure TTL rendering failed after {total_elapsed:.3f}s: {e}"
-            logging.error(error_message)
-            print(error_message)
+            logger.error(error_message)
             return None
             
-    def render_ttl_thumbnail_secure(self, ttl_path: str, max_size: int = 128) -> Optional[bytes]:
+    def render_ttl_thumbnail_secure(self, ttl_path: str, max_size: int = 128, output: str = OUTPUT_ENCODED):
         session_id = f"thumb_{hash(ttl_path)}_{int(time.time())}"
         
-        total_start = time.time()
-        print(f"Starting secure TTL thumbnail generation")
-        logging.info(f"Starting secure TTL thumbnail generation")
+        total_start = time.perf_counter()
+        logger.debug("Starting secure TTL thumbnail generation")
         
         try:
             # Load encrypted TTL file into memory
-            step_start = time.time()
-            encrypted_bytes = self._load_encrypted_ttl(ttl_path)
-            self._log_timing("Load encrypted TTL", step_start, len(encrypted_bytes))
+            step_start = time.perf_counter()
+            encrypted_bytes, level, level_parts = self._load_for_display(ttl_path, (max_size, max_size))
+            self._log_timing(metrics.STAGE_READ, step_start, len(encrypted_bytes))
+            cancellation.check()
             
             # Execute just-in-time decryption
-            step_start = time.time()
-            decrypted_bytes = self._decrypt_just_in_time_memory_only(encrypted_bytes)
-            self._log_timing("Decrypt TTL", step_start, len(decrypted_bytes))
+            step_start = time.perf_counter()
+            decrypted_bytes = self._decrypt_just_in_time_memory_only(encrypted_bytes, level, level_parts)
+            self._log_timing("service.decrypt_total", step_start, len(decrypted_bytes))
+            cancellation.check()
             
             # Create optimized thumbnail
-            step_start = time.time()
-            thumbnail_bytes = self._create_optimized_thumbnail(decrypted_bytes, max_size)
-            self._log_timing("Create thumbnail", step_start, len(thumbnail_bytes))
+            step_start = time.perf_counter()
+            thumbnail_bytes = self._thumbnail_output(decrypted_bytes, max_size, output)
+            self._log_timing("service.thumbnail_total", step_start, _output_size(thumbnail_bytes))
             
-            # Setup cleanup timer
-            step_start = time.time()
-            cleanup_timer = threading.Timer(
-                10,  # Shorter timeout for thumbnails
-                self._secure_cleanup_session, 
-                args=[session_id, decrypted_bytes]
-            )
-            cleanup_timer.start()
-            self._log_timing("Setup cleanup timer", step_start)
+            # Shorter cleanup timeout for thumbnails
+            self._track_session(session_id, ttl_path, encrypted_bytes, decrypted_bytes, THUMBNAIL_SESSION_SECONDS)
             
-            # Track session
-            step_start = time.time()
-            with self._cleanup_lock:
-                self._active_sessions[session_id] = {
-                    'encrypted_bytes': encrypted_bytes,
-                    'timer': cleanup_timer,
-                    'created': time.time(),
-                    'ttl_path': ttl_path
-                }
-            self._log_timing("Track session", step_start)
-            
-            total_elapsed = time.time() - total_start
-            completion_message = f"Secure TTL thumbnail generation completed in {total_elapsed:.3f}s"
-            logging.info(completion_message)
-            print(completion_message)
+            total_elapsed = time.perf_counter() - total_start
+            metrics.observe("op.thumbnail", total_elapsed)
+            tracing.record("op.thumbnail", total_start, total_start + total_elapsed, cat="ttl")
+            logger.info("Secure TTL thumbnail generation completed in %.3fs", total_elapsed, extra=SAMPLED)
             
             return thumbnail_bytes
             
+        except cancellation.Cancelled:
+            logger.debug("Secure TTL thumbnail generation for %s cancelled", ttl_path)
+            return None
+
         except Exception as e:
-            total_elapsed = time.time() - total_start
+            total_elapsed = time.perf_counter() - total_start
+            metrics.inc("errors.thumbnail")
             error_message = f"Secure TTL thumbnail generation failed after {total_elapsed:.3f}s: {e}"
-            logging.error(error_message)
-            print(error_message)
+            logger.error(error_message)
             return None
 
-    def _create_optimized_thumbnail(self, image_bytes: bytes, max_size: int) -> bytes:
+    def render_many(self, ttl_paths, thumbnail: bool = True, max_size: int = 128,
+                    max_display_time: int = 30, stop: threading.Event = None, output: str = OUTPUT_ENCODED):
+        """Thumbnail or render many containers through a read/decrypt/image pipeline.
+
+        Files are read ahead on their own thread while earlier ones are
+        decrypted and resized, so disk and CPU overlap instead of taking
+        turns. Generator of (ttl_path, bytes or None, error message or
+        None) in completion order; stop (by default the current request's
+        cancel flag) or closing the generator abandons the rest. output picks encoded bytes, PIL images or raw
+        pixels, as for the single-file calls. Read-ahead depth and CPU
+        workers come from pipeline_read_ahead and pipeline_workers.
+        """
+        cfg = config.load_config()
+        if stop is None:
+            stop = cancellation.current_event()
+        workers = cfg.get("pipeline_workers") or min(4, os.cpu_count() or 1)
+        display_size = (max_size, max_size) if thumbnail else None
+        prefix = "thumb" if thumbnail else "render"
+
+        def read(ttl_path):
+            step_start = time.perf_counter()
+            loaded = self._load_for_display(ttl_path, display_size)
+            self._log_timing(metrics.STAGE_READ, step_start, len(loaded[0]))
+            return ttl_path, loaded
+
+        def decrypt(item):
+            ttl_path, (encrypted_bytes, level, level_parts) = item
+            step_start = time.perf_counter()
+            decrypted_bytes = self._decrypt_just_in_time_memory_only(encrypted_bytes, level, level_parts)
+            self._log_timing("service.decrypt_total", step_start, len(decrypted_bytes))
+            return ttl_path, encrypted_bytes, decrypted_bytes
+
+        def finish(item):
+            ttl_path, encrypted_bytes, decrypted_bytes = item
+            session_id = f"{prefix}_{hash(ttl_path)}_{int(time.time())}"
+            if not thumbnail:
+                rendered = self._render_output(decrypted_bytes, output)
+                self._track_session(session_id, ttl_path, encrypted_bytes, decrypted_bytes, max_display_time)
+                return rendered
+            step_start = time.perf_counter()
+            thumb = self._thumbnail_output(decrypted_bytes, max_size, output)
+            self._log_timing("service.thumbnail_total", step_start, _output_size(thumb))
+            self._track_session(session_id, ttl_path, encrypted_bytes, decrypted_bytes, THUMBNAIL_SESSION_SECONDS)
+            return thumb
+
+        pipeline = Pipeline([Stage("read", read), Stage("decrypt", decrypt, workers),
+                             Stage("image", finish, workers)],
+                            depth=cfg.get("pipeline_read_ahead", 4))
+        total_start = time.perf_counter()
+        count = 0
         try:
-            # Load image from bytes
-            with Image.open(io.BytesIO(image_bytes)) as img:
-                # Preserve transparency if present
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    # Keep RGBA for better quality and transparency support
-                    if img.mode != 'RGBA':
-                        img = img.convert('RGBA')
-                else:
-                    img = img.convert('RGB')
-                
-                # Calculate dimensions preserving aspect ratio
-                width, height = img.size
-                if width > height:
-                    new_width = max_size
-                    new_height = int(height * (max_size / width))
-                else:
-                    new_height = max_size
-                    new_width = int(width * (max_size / height))
-                
-                # Ensure minimum size for quality
-                if new_width < 64: new_width = 64
-                if new_height < 64: new_height = 64
-                
-                # Resize with high quality
-                img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # Convert to optimized format with higher quality
-                output = io.BytesIO()
-                if img.mode == 'RGBA':
-                    # Use PNG for transparency support and better quality
-                    img.save(output, format='PNG', optimize=True)
+            for ttl_path, result, error in pipeline.run(((p, p) for p in ttl_paths), stop):
+                count += 1
+                if error is not None:
+                    metrics.inc("errors.thumbnail" if thumbnail else "errors.render")
+                    logger.error(f"Pipelined {prefix} failed for {ttl_path}: {error}")
+                    yield ttl_path, None, str(error)
                 else:
-                    # Use JPEG with higher quality for RGB images
-                    img.save(output, format='JPEG', quality=95, optimize=True)
-                output.seek(0)
-                
-                return output.getvalue()
-                
+                    yield ttl_path, result, None
+        finally:
+            total_elapsed = time.perf_counter() - total_start
+            metrics.observe("op.render_many", total_elapsed)
+            tracing.record("op.render_many", total_start, total_start + total_elapsed, cat="ttl", files=count)
+            logger.info("Pipelined %s of %d files completed in %.3fs", prefix, count, total_elapsed, extra=SAMPLED)
+
+    def _track_session(self, session_id: str, ttl_path: str, encrypted_bytes: bytes, decrypted_bytes: bytes,
+                       timeout: float):
+        step_start = time.perf_counter()
+        cleanup_timer = self.timer_factory(
+            timeout,
+            self._secure_cleanup_session,
+            args=[session_id, decrypted_bytes]
+        )
+        cleanup_timer.start()
+        self._log_timing("service.cleanup_timer", step_start)
+
+        step_start = time.perf_counter()
+        with self._cleanup_lock:
+            self._active_sessions[session_id] = {
+                'encrypted_bytes': encrypted_bytes,
+                'timer': cleanup_timer,
+                'created': time.time(),
+                'ttl_path': ttl_path
+            }
+        self._log_timing("service.track_session", step_start)
+
+    def _thumbnail_output(self, image_bytes: bytes, max_size: int, output: str):
+        if output == OUTPUT_ENCODED:
+            return self._create_optimized_thumbnail(image_bytes, max_size)
+        img = self._thumbnail_image(image_bytes, max_size)
+        return img if output == OUTPUT_IMAGE else self._raw_frame(img)
+
+    def _render_output(self, image_bytes: bytes, output: str):
+        # Full renders are passed through as stored unless pixels are wanted
+        if output == OUTPUT_ENCODED:
+            return image_bytes
+        img, _ = self._decode_fitted(image_bytes, None)
+        return img if output == OUTPUT_IMAGE else self._raw_frame(img)
+
+    def _fit_output(self, image_bytes: bytes, target_size, output: str):
+        """Scale a render down to fit target_size (screen-fit first paint)."""
+        if output == OUTPUT_ENCODED:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                fits = _fits(img.size, target_size)
+                size, fmt = img.size, img.format
+            if fits:
+                # Already small enough: send the stored bytes untouched
+                metrics.inc("render.fit_passthrough")
+                return {"data": image_bytes, "width": size[0], "height": size[1], "format": fmt, "scaled": False}
+        img, scaled = self._decode_fitted(image_bytes, target_size)
+        metrics.inc("render.fit_scaled" if scaled else "render.fit_passthrough")
+        if output == OUTPUT_IMAGE:
+            return img
+        if output == OUTPUT_RAW:
+            frame = self._raw_frame(img)
+            frame["scaled"] = scaled
+            return frame
+        step_start = time.perf_counter()
+        buffer = io.BytesIO()
+        params = {"exif": img.info["exif"]} if img.info.get("exif") else {}
+        if img.mode == 'RGBA':
+            fmt = "PNG"
+            img.save(buffer, format=fmt, compress_level=1, **params)
+        else:
+            fmt = "JPEG"
+            img.save(buffer, format=fmt, quality=FIT_JPEG_QUALITY, **params)
+        self._log_timing(metrics.STAGE_ENCODE, step_start, buffer.tell())
+        return {"data": buffer.getvalue(), "width": img.width, "height": img.height, "format": fmt, "scaled": scaled}
+
+    def _decode_fitted(self, image_bytes: bytes, box):
+        # Decode, scaled down to fit box if it is larger. thumbnail() with a
+        # reducing_gap lets JPEG decode at 1/2..1/8 scale (draft) and shrinks
+        # further with a cheap box reduce before the final resample.
+        step_start = time.perf_counter()
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            exif = img.info.get("exif")
+            scaled = box is not None and not _fits(img.size, box)
+            if scaled:
+                img.thumbnail((box[0] or img.width, box[1] or img.height), Image.Resampling.LANCZOS,
+                              reducing_gap=FIT_REDUCING_GAP)
+            img = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'P', 'PA') else 'RGB')
+        if exif:
+            img.info["exif"] = exif
+        self._log_timing(metrics.STAGE_THUMBNAIL if scaled else metrics.STAGE_DECODE, step_start)
+        return img, scaled
+
+    def _raw_frame(self, img: Image.Image) -> dict:
+        from image_processor import to_bgra32
+        step_start = time.perf_counter()
+        frame = to_bgra32(img)
+        self._log_timing(metrics.STAGE_ENCODE, step_start, len(frame["data"]))
+        metrics.inc("render.raw_frames")
+        return frame
+
+    def _create_optimized_thumbnail(self, image_bytes: bytes, max_size: int) -> bytes:
+        try:
+            embedded = self._exif_thumbnail(image_bytes, max_size)
+            if embedded is not None and _close_to(embedded[1], _thumbnail_size(embedded[2], max_size)):
+                # The camera already stored exactly this thumbnail
+                metrics.inc("thumbnail.exif_direct")
+                return embedded[0]
+            img = self._thumbnail_image(image_bytes, max_size, embedded)
+
+            # Convert to optimized format with higher quality
+            step_start = time.perf_counter()
+            output = io.BytesIO()
+            if img.mode == 'RGBA':
+                # Use PNG for transparency support and better quality
+                img.save(output, format='PNG', optimize=True)
+            else:
+                # Use JPEG with higher quality for RGB images
+                img.save(output, format='JPEG', quality=95, optimize=True)
+            output.seek(0)
+            self._log_timing(metrics.STAGE_ENCODE, step_start)
+
+            return output.getvalue()
+
         except Exception as e:
-            logging.error(f"Error creating thumbnail: {e}")
+            logger.error(f"Error creating thumbnail: {e}")
             raise
+
+    def _exif_thumbnail(self, image_bytes: bytes, max_size: int):
+        """A camera JPEG's embedded thumbnail if it can stand in for a full decode.
+
+        It must be at least max_size on its long side and have the frame's
+        aspect ratio (thumbnails for other ratios are letterboxed).
+        Returns exif_thumbnail()'s (bytes, size, image_size) or None.
+        """
+        if not config.load_config().get("exif_thumbnails", True):
+            return None
+        from image_processor import exif_thumbnail
+        embedded = exif_thumbnail(image_bytes)
+        if embedded is None:
+            return None
+        (width, height), (image_width, image_height) = embedded[1], embedded[2]
+        if max(width, height) < max_size or not _close_to(_thumbnail_size((image_width, image_height), max(width, height)),
+                                                          (width, height)):
+            metrics.inc("thumbnail.exif_unsuitable")
+            return None
+        return embedded
+
+    def _thumbnail_image(self, image_bytes: bytes, max_size: int, embedded=_PROBE) -> Image.Image:
+        # Decoded and resized, RGBA when the source has transparency else RGB.
+        # Decodes the embedded Exif thumbnail instead of the image when it is
+        # big enough (embedded: a previous _exif_thumbnail() result).
+        if embedded is _PROBE:
+            embedded = self._exif_thumbnail(image_bytes, max_size)
+        if embedded is not None:
+            image_bytes = embedded[0]
+            metrics.inc("thumbnail.exif")
+        else:
+            metrics.inc("thumbnail.full_decode")
+        step_start = time.perf_counter()
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # Preserve transparency if present
+            if img.mode in ('RGBA', 'LA', 'P'):
+                # Keep RGBA for better quality and transparency support
+                if img.mode != 'RGBA':
+                    img = img.convert('RGBA')
+            else:
+                img = img.convert('RGB')
+            self._log_timing(metrics.STAGE_DECODE, step_start)
+            
+            # Calculate dimensions preserving aspect ratio
+            new_width, new_height = _thumbnail_size(img.size, max_size)
+            
+            # Resize with high quality
+            step_start = time.perf_counter()
+            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            self._log_timing(metrics.STAGE_THUMBNAIL, step_start)
+            return img
     
     def _load_encrypted_ttl(self, ttl_path: str) -> bytes:
         with open(ttl_path, 'rb') as f:
             return f.read()
+
+    def _load_for_display(self, ttl_path: str, display_size) -> Tuple[bytes, Optional[int], Optional[tuple]]:
+        # Only the header and one pyramid level when a level fills the
+        # display size; otherwise the whole file
+        if display_size:
+            with open(ttl_path, 'rb') as f:
+                head = f.read(ttl_format.PEEK_LEN)
+                header = ttl_format.parse_header(head)
+                level = ttl_format.select_level(header, *display_size)
+                if level is not None:
+                    return head, level, ttl_format.read_level(f, header, level)
+        return self._load_encrypted_ttl(ttl_path), None, None
     
-    def _decrypt_just_in_time_memory_only(self, encrypted_bytes: bytes) -> bytes:
+    def _decrypt_just_in_time_memory_only(self, encrypted_bytes: bytes, level: int = None, level_parts: tuple = None) -> bytes:
         def decrypt_ttl_from_memory(ttl_bytes: bytes) -> bytes:
-            import struct
-            from crypto import derive_cek, derive_subkey
             from time_utils import get_current_time_with_fallback
 
-            total_start = time.time()
-            print(f"    Starting TTL decryption from memory")
-            logging.info(f"    Starting TTL decryption from memory")
+            total_start = time.perf_counter()
+            logger.debug("Starting TTL decryption from memory")
             
             # Parse and validate TTL file header structure
-            step_start = time.time()
-            MAGIC = b"IMAGED"
-            min_len = len(MAGIC) + 16 + 12 + 8 + 16 + 12 + 16
-            if len(ttl_bytes) < min_len:
+            step_start = time.perf_counter()
+            header = ttl_format.parse_header(ttl_bytes)
+            if level is None and len(ttl_bytes) < header.min_length:
                 raise ValueError("Invalid TTL file (too short)")
-
-            off = 0
-            magic = ttl_bytes[off:off+len(MAGIC)]; off += len(MAGIC)
-            if magic != MAGIC:
-                raise ValueError("Not an ImAged file")
-            salt = ttl_bytes[off:off+16]; off += 16
-
-            base = off
-            nonce_hdr   = ttl_bytes[base:base+12]
-            cand_header = ttl_bytes[base+12:base+20]
-            cand_taghdr = ttl_bytes[base+20:base+36]
-            self._log_timing("Parse header", step_start)
+            self._log_timing(metrics.STAGE_PARSE, step_start)
             
             # Verify header authentication using derived key
-            step_start = time.time()
-            key_hdr = derive_subkey(salt, b"ImAged HDR")
-            aes_hdr = AES_GCM(key_hdr)
-            try:
-                # Current format: AAD = header, data = tag only (empty ciphertext)
-                aes_hdr.decrypt(nonce_hdr, cand_taghdr, cand_header)
-            except Exception:
-                # Backward compatibility: legacy format may have used header as ciphertext and no AAD
-                try:
-                    aes_hdr.decrypt(nonce_hdr, cand_header + cand_taghdr, b"")
-                    logging.info("Header auth verified using legacy format fallback")
-                except Exception:
-                    raise ValueError("Invalid TTL format")
-            self._log_timing("Verify header auth", step_start)
+            step_start = time.perf_counter()
+            if ttl_format.verify_header(header, allow_legacy=True):
+                logger.info("Header auth verified using legacy format fallback")
+            self._log_timing(metrics.STAGE_HEADER_VERIFY, step_start)
             
             # Validate file expiry timestamp
-            step_start = time.time()
-            expiry_ts = struct.unpack(">Q", cand_header)[0]
+            step_start = time.perf_counter()
+            expiry_ts = header.expiry
             try:
                 current_time, _fallback = get_current_time_with_fallback()
                 if current_time > expiry_ts:
@@ -241,28 +461,26 @@ class SecureImageService:
                     raise ValueError(f"File expired on {datetime.fromtimestamp(expiry_ts)}")
             except RuntimeError as e:
                 raise ValueError(f"NTP time validation failed: {e}")
-            self._log_timing("Check expiry", step_start)
+            self._log_timing(metrics.STAGE_EXPIRY_CHECK, step_start)
             
-            # Decrypt payload body using derived content encryption key
-            step_start = time.time()
-            if len(ttl_bytes) < base + 36 + 12 + 16:
-                raise ValueError("Invalid TTL file (truncated)")
-            nonce_body = ttl_bytes[base+36:base+48]
-            tag_body   = ttl_bytes[base+48:base+64]
-            ciphertext = ttl_bytes[base+64:]
-
-            cek = derive_cek(salt)
-            aes_body = AES_GCM(cek)
+            # Decrypt payload body using the container's content key
+            step_start = time.perf_counter()
+            if level is None:
+                nonce_body, tag_body, ciphertext = ttl_format.split_body(header, ttl_bytes)
+                body_aad = header.body_aad
+            else:
+                nonce_body, tag_body, ciphertext = level_parts
+                body_aad = ttl_format.level_aad(header.prefix, level)
+
+            aes_body = AES_GCM(ttl_format.content_key(header))
             try:
-                payload_data = aes_body.decrypt(nonce_body, ciphertext + tag_body, cand_header)
+                payload_data = aes_body.decrypt(nonce_body, ciphertext + tag_body, body_aad)
             except Exception:
                 raise ValueError("Authentication failed")
-            self._log_timing("Decrypt body", step_start, len(payload_data))
+            self._log_timing(metrics.STAGE_DECRYPT, step_start, len(payload_data))
             
-            total_elapsed = time.time() - total_start
-            completion_message = f"    TTL decryption completed in {total_elapsed:.3f}s"
-            logging.info(completion_message)
-            print(completion_message)
+            total_elapsed = time.perf_counter() - total_start
+            logger.info("TTL decryption completed in %.3fs", total_elapsed, extra=SAMPLED)
 
             # Return decrypted payload bytes for image processing
             return payload_data
@@ -271,9 +489,7 @@ class SecureImageService:
     
     def _secure_cleanup_session(self, session_id: str, decrypted_bytes: bytes):
         cleanup_start = time.time()
-        cleanup_message = f"Starting secure cleanup for session {session_id}"
-        logging.info(cleanup_message)
-        print(cleanup_message)
+        logger.debug(f"Starting secure cleanup for session {session_id}")
         
         with self._cleanup_lock:
             if session_id in self._active_sessions:
@@ -296,9 +512,7 @@ class SecureImageService:
             gc.collect()
         
         cleanup_elapsed = time.time() - cleanup_start
-        completion_message = f"Secure cleanup completed in {cleanup_elapsed:.3f}s"
-        logging.info(completion_message)
-        print(completion_message)
+        logger.info("Secure cleanup completed in %.3fs", cleanup_elapsed, extra=SAMPLED)
     
     def _zero_memory(self, data: bytes):
         try:
@@ -320,15 +534,13 @@ class SecureImageService:
     
     def force_cleanup_all_sessions(self):
         cleanup_start = time.time()
-        cleanup_message = f"Starting force cleanup of all sessions"
-        logging.info(cleanup_message)
-        print(cleanup_message)
+        logger.debug("Starting force cleanup of all sessions")
         
         with self._cleanup_lock:
             for session_id, session in list(self._active_sessions.items()):
                 if session['timer'] is not None:
                     session['timer'].cancel()
-                logging.info(f"Force cleanup: Session {session_id} cleared")
+                logger.debug(f"Force cleanup: Session {session_id} cleared")
             
             # Handle case where _active_sessions might be a mappingproxy
             try:
@@ -341,6 +553,4 @@ class SecureImageService:
             gc.collect()
         
         cleanup_elapsed = time.time() - cleanup_start
-        completion_message = f"Force cleanup completed in {cleanup_elapsed:.3f}s"
-        logging.info(completion_message)
-        print(completion_message)
\ No newline at end of file
+        logger.info("Force cleanup completed in %.3fs", cleanup_elapsed, extra=SAMPLED)
\ No newline at end of file
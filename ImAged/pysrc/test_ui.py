@@ -13,6 +13,7 @@ import logging
 from file_manager import TTLFileManager
 from secure_image_service import SecureImageService
 from config import load_config
+import metrics
 
 # Configure logging to actually show in console
 logging.basicConfig(
@@ -317,6 +318,7 @@ class SimpleTestUI:
             data_size: Optional data size in bytes for throughput calculation
         """
         elapsed = time.time() - start_time
+        metrics.observe("ui." + step_name.lower().replace(" ", "_"), elapsed)
         if data_size:
             size_mb = data_size / (1024 * 1024)
             speed = size_mb / elapsed if elapsed > 0 else 0
@@ -324,9 +326,8 @@ class SimpleTestUI:
         else:
             message = f"{step_name}: {elapsed:.3f}s"
         
-        # Ensure visibility through both logging and console output
+        # Console handler already mirrors log records to stdout
         logging.info(message)
-        print(f"  {message}")
 
     def convert_image(self):
         """
@@ -411,17 +412,31 @@ class SimpleTestUI:
             file_size = os.path.getsize(ttl_path)
             self._log_timing("Get file size", step_start)
             
-            # Execute secure TTL decryption in memory
-            step_start = time.time()
-            payload_bytes = self.secure_service.render_ttl_image_secure(ttl_path, max_display_time=30)
-            if not payload_bytes:
-                raise Exception("Failed to decrypt TTL file or file expired.")
-            self._log_timing("Decrypt TTL file", step_start, len(payload_bytes))
-            
+            # Tiled containers: decode only the tiles of the level that fits
+            # the screen instead of the whole image
+            import ttl_format
+            tiles = ttl_format.parse_header(open(ttl_path, "rb").read(ttl_format.PEEK_LEN)).tiles
+            if tiles is not None:
+                step_start = time.time()
+                from image_processor import compose_region
+                fit = min(self.root.winfo_screenwidth() * 0.8 / tiles.width,
+                          self.root.winfo_screenheight() * 0.8 / tiles.height, 1.0)
+                region = self.ttl_manager.read_region(ttl_path, 0, 0, tiles.width, tiles.height, zoom=fit)
+                img = compose_region(region).convert("RGBA")
+                self._log_timing("Decrypt TTL tiles", step_start, sum(len(t["data"]) for t in region["tiles"]))
+            else:
+                # Execute secure TTL decryption in memory
+                step_start = time.time()
+                payload_bytes = self.secure_service.render_ttl_image_secure(ttl_path, max_display_time=30)
+                if not payload_bytes:
+                    raise Exception("Failed to decrypt TTL file or file expired.")
+                self._log_timing("Decrypt TTL file", step_start, len(payload_bytes))
+
             # Interpret decrypted payload as a standard image
             step_start = time.time()
             import io
-            img = Image.open(io.BytesIO(payload_bytes)).convert("RGBA")
+            if tiles is None:
+                img = Image.open(io.BytesIO(payload_bytes)).convert("RGBA")
             pixel_message = f"Loaded image: {img.width}x{img.height} pixels"
             logging.info(pixel_message)
             print(pixel_message)
@@ -758,15 +773,34 @@ class SimpleTestUI:
         off = 0
         MAGIC = stages["file_bytes"][:6]
         self._append_section_to(R, "MAGIC", "File marker", off, MAGIC, "seg-magic"); off += len(MAGIC)
+        if stages.get("version", 1) >= 2:
+            self._append_section_to(R, "version/flags", "Container version and flags", off, stages["prefix"][off:off+2], "seg-header"); off += 2
         self._append_section_to(R, "salt", "HKDF salt for CEK/HDR keys", off, stages["salt"], "seg-salt"); off += 16
+        if stages.get("version", 1) >= 2:
+            self._append_section_to(R, "content_id", "Random content id (body AAD = prefix)", off, stages["prefix"][off:off+16], "seg-salt"); off += 16
+        if stages.get("source_format"):
+            self._append_section_to(R, "source_format", f"Body transcoded losslessly from {stages['source_format']}", off, stages["prefix"][off:off+1], "seg-header"); off += 1
+        levels = stages.get("levels") or []
+        if levels:
+            table_len = 1 + 12 * len(levels)
+            self._append_section_to(R, "level_table", f"Pyramid table: {len(levels)} level(s) (width, height, length)", off, stages["prefix"][off:off+table_len], "seg-header"); off += table_len
+        if stages.get("tiles"):
+            self._append_section_to(R, "tile_header", "Tile size, image size, zoom levels, index and tile lengths", off, stages["prefix"][off:off+23], "seg-header"); off += 23
+        if stages.get("key_block"):
+            self._append_section_to(R, "key_block", "KEK id + wrapped random CEK (AAD = prefix)", off, stages["key_block"], "seg-header"); off += len(stages["key_block"])
         self._append_section_to(R, "nonce_hdr", "GCM nonce for header tag", off, stages["nonce_hdr"], "seg-nonce"); off += 12
         self._append_section_to(R, "header", "expiry_ts (8-byte big-endian)", off, stages["header"], "seg-header"); off += 8
         import struct, datetime as _dt
         expiry_ts = struct.unpack(">Q", stages["header"])[0]
         self._append_field_to(R, "expiry_ts", f"{expiry_ts} ({_dt.datetime.fromtimestamp(expiry_ts)})")
         self._append_section_to(R, "tag_hdr", "AES-GCM tag authenticating header", off, stages["tag_hdr"], "seg-tag"); off += 16
+        for i, (w, h, sealed) in enumerate(levels):
+            self._append_section_to(R, f"level_{i + 1}", f"Pyramid level {w}x{h}: nonce | tag | ciphertext (AAD = prefix + {i + 1})", off, sealed, "seg-ct"); off += len(sealed)
+        if stages.get("tiles"):
+            self._append_section_to(R, "tiles", "Sealed tile index, then one sealed record per tile", off, stages["tiles"], "seg-ct"); off += len(stages["tiles"])
         self._append_section_to(R, "nonce_body", "GCM nonce for body", off, stages["nonce_body"], "seg-nonce"); off += 12
-        self._append_section_to(R, "tag_body", "AES-GCM tag for body (AAD=header)", off, stages["tag_body"], "seg-tag"); off += 16
+        body_aad = "prefix" if stages.get("version", 1) >= 2 else "header"
+        self._append_section_to(R, "tag_body", f"AES-GCM tag for body (AAD={body_aad})", off, stages["tag_body"], "seg-tag"); off += 16
         self._append_section_to(R, "ciphertext_body", "Encrypted payload bytes", off, stages["ciphertext_body"], "seg-ct")
         self._append_section_to(R, "payload", "Decrypted payload bytes (plaintext after decryption)", 0, stages["payload"], "seg-payload")
 
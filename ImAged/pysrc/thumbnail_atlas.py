@@ -0,0 +1,215 @@
+"""
+Thumbnail atlases: a page of thumbnails packed into one image.
+
+Instead of N encoded thumbnails the client gets one image plus a map of
+rectangles, so it decodes and uploads one texture per gallery page.
+Thumbnails are laid out on shelves in request order, each shelf as tall
+as its tallest thumbnail, in a grid roughly as wide as it is tall.
+
+Atlases are cached in memory per page (its list of paths and the
+thumbnail size). An entry is dropped when one of its files changes on
+disk, when the first of them expires (or the sweeper reports it
+expired), or after atlas_cache_seconds, whichever comes first.
+"""
+
+import io
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+import cancellation
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_ENTRIES = 16
+DEFAULT_CACHE_SECONDS = 300
+JPEG_QUALITY = 90
+
+
+def pack(images: list, max_size: int):
+    """Lay out images on shelves; returns (atlas image, [(x, y, w, h)])."""
+    columns = max(1, math.ceil(math.sqrt(len(images))))
+    width = columns * max_size
+    rects = []
+    x = y = shelf_height = 0
+    for img in images:
+        if x and x + img.width > width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        rects.append((x, y, img.width, img.height))
+        x += img.width
+        shelf_height = max(shelf_height, img.height)
+    used_width = max((rx + rw for rx, _, rw, _ in rects), default=1)
+    mode = "RGBA" if any(img.mode == "RGBA" for img in images) else "RGB"
+    atlas = Image.new(mode, (used_width, max(y + shelf_height, 1)))
+    for img, (rx, ry, _, _) in zip(images, rects):
+        atlas.paste(img if img.mode == mode else img.convert(mode), (rx, ry))
+    return atlas, rects
+
+
+def encode(atlas: Image.Image):
+    """PNG when the atlas has transparency, else JPEG; returns (bytes, format)."""
+    output = io.BytesIO()
+    if atlas.mode == "RGBA":
+        atlas.save(output, format="PNG", compress_level=6)
+        return output.getvalue(), "PNG"
+    atlas.save(output, format="JPEG", quality=JPEG_QUALITY)
+    return output.getvalue(), "JPEG"
+
+
+def _signature(paths) -> tuple:
+    sig = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+
+def _now() -> float:
+    # Trusted time only, like every other open path: with the local clock a
+    # rolled-back system time would keep expired atlases on screen
+    from time_utils import get_current_time_with_fallback
+    try:
+        now, _ = get_current_time_with_fallback()
+    except RuntimeError as e:
+        raise ValueError(f"NTP time validation failed: {e}")
+    return now
+
+
+class AtlasCache:
+    def __init__(self, max_entries: int = None, max_age: float = None):
+        cfg = config.load_config()
+        self.max_entries = max_entries or cfg.get("atlas_cache_entries", DEFAULT_CACHE_ENTRIES)
+        self.max_age = max_age or cfg.get("atlas_cache_seconds", DEFAULT_CACHE_SECONDS)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (atlas, signature, valid_until)
+
+    @staticmethod
+    def _key(paths, max_size) -> tuple:
+        return max_size, tuple(os.path.normcase(os.path.abspath(p)) for p in paths)
+
+    def get(self, paths, max_size: int):
+        key = self._key(paths, max_size)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+        if cached is None:
+            metrics.inc("atlas.cache_misses")
+            return None
+        atlas, signature, valid_until = cached
+        if _now() >= valid_until or _signature(paths) != signature:
+            with self._lock:
+                self._entries.pop(key, None)
+            metrics.inc("atlas.cache_misses")
+            return None
+        metrics.inc("atlas.cache_hits")
+        return atlas
+
+    def put(self, paths, max_size: int, atlas: dict, signature: tuple, expiry=None):
+        valid_until = _now() + self.max_age
+        if expiry is not None:
+            valid_until = min(valid_until, expiry)
+        with self._lock:
+            self._entries[self._key(paths, max_size)] = (atlas, signature, valid_until)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def drop_paths(self, paths):
+        """Forget every atlas that contains one of paths."""
+        gone = {os.path.normcase(os.path.abspath(p)) for p in paths}
+        with self._lock:
+            for key in [k for k in self._entries if gone.intersection(k[1])]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def on_expired(self, batch):
+        # ExpirySweeper listener
+        self.drop_paths(item["path"] for item in batch)
+
+
+def build_atlas(paths: list, max_size: int, service=None) -> dict:
+    """Thumbnail every path and pack the results into one atlas.
+
+    Returns {"data", "format", "width", "height", "rects", "failed",
+    "cached"}; rects and failed entries carry the index of their path.
+    """
+    cache = get_cache()
+    signature = _signature(paths)
+    atlas = cache.get(paths, max_size)
+    if atlas is not None:
+        return dict(atlas, cached=True)
+
+    start = time.perf_counter()
+    if service is None:
+        from secure_image_service import SecureImageService
+        service = SecureImageService()
+    positions = {}
+    for index, path in enumerate(paths):
+        positions.setdefault(path, []).append(index)
+    thumbnails = {}
+    failed = []
+    for path, img, error in service.render_many(paths, thumbnail=True, max_size=max_size, output="image"):
+        index = positions[path].pop(0)
+        if error is not None:
+            failed.append({"index": index, "path": path, "error": error})
+        else:
+            thumbnails[index] = img
+    # A cancelled render stops early; a partial page must never be cached
+    if cancellation.is_cancelled() or len(thumbnails) + len(failed) != len(paths):
+        raise cancellation.Cancelled("Atlas build cancelled")
+    order = sorted(thumbnails)
+    image, rects = pack([thumbnails[i] for i in order], max_size)
+    data, fmt = encode(image)
+    atlas = {
+        "data": data,
+        "format": fmt,
+        "width": image.width,
+        "height": image.height,
+        "rects": [{"index": i, "path": paths[i], "x": x, "y": y, "width": w, "height": h}
+                  for i, (x, y, w, h) in zip(order, rects)],
+        "failed": sorted(failed, key=lambda item: item["index"]),
+    }
+
+    expiry = None
+    try:
+        import ttl_index
+        index = ttl_index.get_index()
+        expiries = [index.get(paths[i]).get("expiry") for i in order]
+        expiry = min((e for e in expiries if e is not None), default=None)
+    except Exception as e:
+        logger.debug("Could not look up atlas expiry: %s", e)
+    # Failed files are not cached: they may be readable on the next try
+    if not failed:
+        cache.put(paths, max_size, atlas, signature, expiry)
+    metrics.observe("op.atlas", time.perf_counter() - start)
+    return dict(atlas, cached=False)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> AtlasCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AtlasCache()
+            try:
+                import expiry_sweeper
+                expiry_sweeper.get_sweeper().add_listener(_cache.on_expired)
+            except Exception as e:
+                logger.debug("Atlas cache not tied to the expiry sweeper: %s", e)
+        return _cache
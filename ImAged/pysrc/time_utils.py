@@ -1,35 +1,143 @@
+import asyncio
 import socket
 import struct
 import logging
+import threading
+import time
+import metrics
+import tracing
+import config
 from config import load_config
 
+logger = logging.getLogger(__name__)
+
+NTP_EPOCH_OFFSET = 2208988800
+NTP_REQUEST = b"\x1b" + 47 * b"\0"
+
+# Trusted time base: last NTP reading anchored to the monotonic clock, so
+# that later reads advance with real elapsed time regardless of the local
+# wall clock. Refreshed by every successful fetch.
+TIME_BASE_MAX_AGE = 60
+_time_base = None
+_time_base_lock = threading.Lock()
+
+def _on_config_change(cfg: dict, changed: set):
+    # A reading from a different server must not keep vouching for the clock
+    global _time_base
+    if "ntp_server" in changed:
+        with _time_base_lock:
+            _time_base = None
+
+config.subscribe(_on_config_change)
+
+def _ntp_address(server: str) -> tuple:
+    # "host" or "host:port"; the port defaults to the standard NTP port
+    host, sep, port = server.rpartition(":")
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return server, 123
+
+def _parse_ntp_response(res: bytes) -> float:
+    return struct.unpack("!12I", res[:48])[10] - NTP_EPOCH_OFFSET
+
+def record_ntp_time(ntp_time: float, monotonic_at: float = None):
+    global _time_base
+    if monotonic_at is None:
+        monotonic_at = time.monotonic()
+    with _time_base_lock:
+        _time_base = (ntp_time, monotonic_at)
+
+def get_cached_time(max_age: float = None):
+    if max_age is None:
+        max_age = TIME_BASE_MAX_AGE
+    with _time_base_lock:
+        base = _time_base
+    if base is None:
+        return None
+    ntp_time, anchor = base
+    elapsed = time.monotonic() - anchor
+    if elapsed > max_age:
+        return None
+    return ntp_time + elapsed
+
 def fetch_ntp_time(timeout: int = 10, server: str = None) -> float:
     cfg = load_config()
     if server is None:
         server = cfg.get("ntp_server", "time.google.com")
-    
+
+    try:
+        addr = _ntp_address(server)
+        with tracing.span(metrics.STAGE_NTP, cat="ntp", server=server), \
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(timeout)
+            sent_at = time.monotonic()
+            s.sendto(NTP_REQUEST, addr)
+            res, _ = s.recvfrom(1024)
+        t = _parse_ntp_response(res)
+        record_ntp_time(t, sent_at)
+        metrics.observe(metrics.STAGE_NTP, time.monotonic() - sent_at)
+        logger.debug("NTP time from %s: %s", server, t)
+        return t
+    except Exception as e:
+        metrics.inc("errors.ntp")
+        error_msg = f"NTP fetch from {server} failed: {e}"
+        logger.error(error_msg)
+        raise RuntimeError(error_msg)
+
+class _NTPClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, future):
+        self._future = future
+
+    def datagram_received(self, data, addr):
+        if not self._future.done():
+            self._future.set_result(data)
+
+    def error_received(self, exc):
+        if not self._future.done():
+            self._future.set_exception(exc)
+
+async def fetch_ntp_time_async(timeout: int = 10, server: str = None) -> float:
+    """Event-loop variant of fetch_ntp_time; updates the same time base."""
+    if server is None:
+        server = load_config().get("ntp_server", "time.google.com")
+
+    loop = asyncio.get_running_loop()
+    transport = None
+    span_start = time.perf_counter()
     try:
-        addr = (server, 123)
-        msg = b"\x1b" + 47 * b"\0"
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(timeout)
-        s.sendto(msg, addr)
-        res, _ = s.recvfrom(1024)
-        t = struct.unpack("!12I", res)[10] - 2208988800
-        logging.info("NTP time from %s: %s", server, t)
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _NTPClientProtocol(future), remote_addr=_ntp_address(server), family=socket.AF_INET
+        )
+        sent_at = time.monotonic()
+        transport.sendto(NTP_REQUEST)
+        res = await asyncio.wait_for(future, timeout)
+        t = _parse_ntp_response(res)
+        record_ntp_time(t, sent_at)
+        metrics.observe(metrics.STAGE_NTP, time.monotonic() - sent_at)
+        tracing.record(metrics.STAGE_NTP, span_start, cat="ntp", server=server, mode="async")
+        logger.debug("NTP time from %s: %s", server, t)
         return t
     except Exception as e:
+        metrics.inc("errors.ntp")
         error_msg = f"NTP fetch from {server} failed: {e}"
-        logging.error(error_msg)
+        logger.error(error_msg)
         raise RuntimeError(error_msg)
+    finally:
+        if transport is not None:
+            transport.close()
 
 def get_current_time() -> float:
     return fetch_ntp_time()
 
 def get_current_time_with_fallback() -> tuple[float, bool]:
+    cached = get_cached_time()
+    if cached is not None:
+        metrics.inc("ntp.cache_hits")
+        return cached, False
     ntp_time = fetch_ntp_time()
     return ntp_time, False
 
 def validate_expiry_time(expiry_ts: int) -> bool:
     current_time = get_current_time()
-    return current_time <= expiry_ts
\ No newline at end of file
+    return current_time <= expiry_ts
@@ -0,0 +1,145 @@
+"""
+Span-based request tracing for the ImAged backend.
+
+Spans are tagged with the request id of the command being processed (held
+in a context variable, so worker threads started through
+contextvars.copy_context() inherit it) and can be exported as Chrome
+trace-event JSON for chrome://tracing or Perfetto. Tracing is off by
+default; enable it with IMAGED_TRACE=1 or the SET_TRACING command. When
+disabled a span costs one attribute check.
+"""
+
+import collections
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+_request_id = contextvars.ContextVar("imaged_request_id", default=None)
+_request_counter = itertools.count(1)
+
+MAX_EVENTS = 200_000
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("_tracer", "_name", "_cat", "_args", "_start")
+
+    def __init__(self, tracer, name, cat, args):
+        self._tracer = tracer
+        self._name = name
+        self._cat = cat
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        self._tracer.record(self._name, self._start, cat=self._cat, **self._args)
+        return False
+
+
+class Tracer:
+    def __init__(self, max_events: int = MAX_EVENTS):
+        self.enabled = os.environ.get("IMAGED_TRACE") == "1"
+        self._events = collections.deque(maxlen=max_events)
+        self._thread_names = {}
+        self._epoch = time.perf_counter()
+        self._pid = os.getpid()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = bool(enabled)
+
+    def span(self, name: str, cat: str = "backend", **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def record(self, name: str, start: float, end: float = None, cat: str = "backend", **args):
+        """Record a completed span from perf_counter() timestamps."""
+        if not self.enabled:
+            return
+        if end is None:
+            end = time.perf_counter()
+        request_id = _request_id.get()
+        if request_id is not None:
+            args["request_id"] = request_id
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._thread_names:
+            self._thread_names[tid] = thread.name
+        self._events.append({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self._epoch) * 1_000_000,
+            "dur": (end - start) * 1_000_000,
+            "pid": self._pid,
+            "tid": tid,
+            "args": args,
+        })
+
+    def export_chrome(self, clear: bool = False) -> dict:
+        events = list(self._events)
+        if clear:
+            self._events.clear()
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self._thread_names.items()
+        ]
+        metadata.append({"name": "process_name", "ph": "M", "pid": self._pid, "args": {"name": "imaged-backend"}})
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def write_chrome(self, path: str, clear: bool = False) -> int:
+        trace = self.export_chrome(clear=clear)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+        return len(trace["traceEvents"])
+
+    def clear(self):
+        self._events.clear()
+
+    @property
+    def event_count(self) -> int:
+        return len(self._events)
+
+
+tracer = Tracer()
+
+
+def span(name: str, cat: str = "backend", **args):
+    return tracer.span(name, cat, **args)
+
+
+def record(name: str, start: float, end: float = None, cat: str = "backend", **args):
+    tracer.record(name, start, end, cat, **args)
+
+
+def begin_request(request_id=None):
+    """Bind a request id to the current context; returns a token for end_request."""
+    if request_id is None:
+        request_id = f"req-{next(_request_counter)}"
+    return _request_id.set(request_id)
+
+
+def end_request(token):
+    _request_id.reset(token)
+
+
+def current_request_id():
+    return _request_id.get()
@@ -0,0 +1,477 @@
+"""
+On-disk layout of .ttl containers.
+
+    v1: MAGIC | salt(16) | nonce_hdr(12) | expiry(8, BE) | tag_hdr(16)
+        | nonce_body(12) | tag_body(16) | ciphertext
+
+    v2: MAGIC_V2 | version(1) | flags(1) | salt(16) | content_id(16)
+        [| source_format(1)] [| level_count(1) | (width(4) | height(4) | length(4)) * n]
+        [| tile_size(2) | width(4) | height(4) | tile_levels(1) | index_len(4) | tiles_len(8)]
+        [| kek_id(8) | wrap_nonce(12) | wrap_tag(16) | wrapped_cek(32)]
+        | nonce_hdr(12) | expiry(8, BE) | tag_hdr(16)
+        [| (nonce(12) | tag(16) | ciphertext) per level]
+        [| sealed tile index | (nonce(12) | tag(16) | ciphertext) per tile]
+        | nonce_body(12) | tag_body(16) | ciphertext
+
+The header tag is AES-GCM over an empty plaintext, keyed from the salt, so
+a header can be authenticated without reading or decrypting the body.
+
+In v1 the expiry bytes are both the header AAD and the body AAD, so a new
+expiry means re-encrypting the body. In v2 the body is bound to the fixed
+prefix (which carries a random content id) instead, and the expiry record
+is sealed with AAD = prefix + expiry. The record has a fixed size and
+offset, so it can be rewritten in place without touching the body.
+
+With FLAG_WRAPPED the body key is a random CEK stored wrapped (AES-GCM,
+AAD = prefix) under a key-encryption key derived from the master key, and
+the header key is derived from the CEK. Rotating the master key then only
+rewraps the key block; expiry record and body stay as they are.
+
+FLAG_TRANSCODED marks a body that was losslessly re-encoded before
+encryption; the source_format byte records what the input file was.
+
+FLAG_PYRAMID adds reduced-resolution renditions of the image, largest
+first, each sealed on its own under the content key with AAD = prefix +
+level number. The level table is part of the prefix, so it is
+authenticated along with everything else, and the full-size body still
+runs to the end of the file.
+
+FLAG_TILED adds the image cut into tile_size x tile_size tiles at zoom
+levels 1, 1/2, 1/4, ... (down to a single tile), each sealed on its own
+with AAD = prefix + (level, column, row), so a viewport can be decoded
+without touching the rest. The sealed tile index (AAD = prefix + "TILES")
+holds the sealed length of every tile, level by level in row-major order.
+"""
+
+import os
+import struct
+from typing import NamedTuple
+
+from aes_gcm import AES_GCM
+from crypto import CURRENT_KEK, CURRENT_KEK_ID, KEK_ID_LEN, derive_cek, derive_key, derive_subkey, kek_for_id
+
+MAGIC = b"IMAGED"
+MAGIC_V2 = b"IMAGEX"
+VERSION_1 = 1
+VERSION_2 = 2
+
+FLAG_WRAPPED = 0x01
+FLAG_TRANSCODED = 0x02
+FLAG_PYRAMID = 0x04
+FLAG_TILED = 0x08
+
+# Codes for the source_format byte of transcoded containers
+SOURCE_FORMATS = {1: "BMP", 2: "TIFF", 3: "PNG", 4: "PPM"}
+SOURCE_FORMAT_CODES = {name: code for code, name in SOURCE_FORMATS.items()}
+
+HDR_INFO = b"ImAged HDR"
+SALT_LEN = 16
+CONTENT_ID_LEN = 16
+NONCE_LEN = 12
+TAG_LEN = 16
+EXPIRY_LEN = 8
+EXPIRY_RECORD_LEN = NONCE_LEN + EXPIRY_LEN + TAG_LEN
+CEK_LEN = 32
+KEY_BLOCK_LEN = KEK_ID_LEN + NONCE_LEN + CEK_LEN + TAG_LEN
+SOURCE_FORMAT_LEN = 1
+MAX_LEVELS = 8
+_LEVEL_ENTRY = struct.Struct(">III")
+LEVEL_TABLE_MAX = 1 + MAX_LEVELS * _LEVEL_ENTRY.size
+_TILE_HEADER = struct.Struct(">HIIBIQ")
+_TILE_KEY = struct.Struct(">BII")
+TILE_INDEX_AAD = b"TILES"
+MAX_TILE_LEVELS = 32
+
+# Bytes needed to authenticate the expiry header
+HEADER_LEN_V1 = len(MAGIC) + SALT_LEN + EXPIRY_RECORD_LEN
+PREFIX_LEN_V2 = len(MAGIC_V2) + 2 + SALT_LEN + CONTENT_ID_LEN
+HEADER_LEN_V2 = PREFIX_LEN_V2 + EXPIRY_RECORD_LEN
+# Smallest valid file: header plus body nonce and tag
+MIN_LEN_V1 = HEADER_LEN_V1 + NONCE_LEN + TAG_LEN
+MIN_LEN_V2 = HEADER_LEN_V2 + NONCE_LEN + TAG_LEN
+PEEK_LEN = max(HEADER_LEN_V1, HEADER_LEN_V2 + SOURCE_FORMAT_LEN + LEVEL_TABLE_MAX + _TILE_HEADER.size + KEY_BLOCK_LEN)
+
+
+class Level(NamedTuple):
+    width: int
+    height: int
+    offset: int
+    length: int
+
+
+class TileInfo(NamedTuple):
+    tile_size: int
+    width: int
+    height: int
+    level_count: int
+    index_offset: int
+    index_length: int
+    tiles_offset: int
+    tiles_length: int
+
+    def grid(self, level: int) -> tuple:
+        """(columns, rows, width, height) of a zoom level."""
+        scale = 1 << level
+        width = max(1, -(-self.width // scale))
+        height = max(1, -(-self.height // scale))
+        return -(-width // self.tile_size), -(-height // self.tile_size), width, height
+
+    def tile_number(self, level: int, col: int, row: int) -> int:
+        number = 0
+        for lower in range(level):
+            cols, rows, _, _ = self.grid(lower)
+            number += cols * rows
+        return number + row * self.grid(level)[0] + col
+
+
+class Header(NamedTuple):
+    version: int
+    flags: int
+    salt: bytes
+    content_id: bytes
+    source_format: str
+    levels: tuple
+    tiles: TileInfo
+    prefix: bytes
+    key_block: bytes
+    nonce_hdr: bytes
+    expiry_header: bytes
+    tag_hdr: bytes
+    expiry_offset: int
+    body_offset: int
+
+    @property
+    def expiry(self) -> int:
+        return struct.unpack(">Q", self.expiry_header)[0]
+
+    @property
+    def wrapped(self) -> bool:
+        return bool(self.flags & FLAG_WRAPPED)
+
+    @property
+    def transcoded(self) -> bool:
+        return bool(self.flags & FLAG_TRANSCODED)
+
+    @property
+    def key_block_offset(self) -> int:
+        return len(self.prefix)
+
+    @property
+    def header_aad(self) -> bytes:
+        return self.prefix + self.expiry_header if self.version >= VERSION_2 else self.expiry_header
+
+    @property
+    def body_aad(self) -> bytes:
+        return self.prefix if self.version >= VERSION_2 else self.expiry_header
+
+    @property
+    def min_length(self) -> int:
+        return self.body_offset + NONCE_LEN + TAG_LEN
+
+
+def parse_header(data: bytes) -> Header:
+    """Split the fixed header fields off a file prefix (no authentication)."""
+    magic = data[:len(MAGIC)]
+    if magic == MAGIC:
+        if len(data) < HEADER_LEN_V1:
+            raise ValueError("Invalid TTL file (too short)")
+        off = len(MAGIC)
+        salt = data[off:off + SALT_LEN]; off += SALT_LEN
+        version, flags, content_id, source_format, prefix, key_block = VERSION_1, 0, b"", None, b"", b""
+        table, tile_fields = (), None
+    elif magic == MAGIC_V2:
+        if len(data) < HEADER_LEN_V2:
+            raise ValueError("Invalid TTL file (too short)")
+        off = len(MAGIC_V2)
+        version, flags = data[off], data[off + 1]; off += 2
+        if version != VERSION_2:
+            raise ValueError(f"Unsupported TTL container version {version}")
+        salt = data[off:off + SALT_LEN]; off += SALT_LEN
+        content_id = data[off:off + CONTENT_ID_LEN]; off += CONTENT_ID_LEN
+        source_format = None
+        if flags & FLAG_TRANSCODED:
+            source_format = SOURCE_FORMATS.get(data[off], "UNKNOWN"); off += SOURCE_FORMAT_LEN
+        table = ()
+        if flags & FLAG_PYRAMID:
+            count = data[off]; off += 1
+            if count > MAX_LEVELS or len(data) < off + count * _LEVEL_ENTRY.size:
+                raise ValueError("Invalid TTL level table")
+            table = tuple(_LEVEL_ENTRY.unpack_from(data, off + i * _LEVEL_ENTRY.size) for i in range(count))
+            off += count * _LEVEL_ENTRY.size
+        tile_fields = None
+        if flags & FLAG_TILED:
+            if len(data) < off + _TILE_HEADER.size:
+                raise ValueError("Invalid TTL file (too short)")
+            tile_fields = _TILE_HEADER.unpack_from(data, off); off += _TILE_HEADER.size
+            if not tile_fields[0] or not 0 < tile_fields[3] <= MAX_TILE_LEVELS:
+                raise ValueError("Invalid TTL tile header")
+        prefix = data[:off]
+        key_block = b""
+        if flags & FLAG_WRAPPED:
+            key_block = data[off:off + KEY_BLOCK_LEN]; off += KEY_BLOCK_LEN
+        if len(data) < off + EXPIRY_RECORD_LEN:
+            raise ValueError("Invalid TTL file (too short)")
+    else:
+        raise ValueError("Not an ImAged file")
+    expiry_offset = off
+    nonce_hdr = data[off:off + NONCE_LEN]; off += NONCE_LEN
+    expiry_header = data[off:off + EXPIRY_LEN]; off += EXPIRY_LEN
+    tag_hdr = data[off:off + TAG_LEN]; off += TAG_LEN
+    levels = []
+    for width, height, length in table:
+        levels.append(Level(width, height, off, length))
+        off += length
+    tiles = None
+    if tile_fields is not None:
+        tile_size, width, height, level_count, index_length, tiles_length = tile_fields
+        tiles = TileInfo(tile_size, width, height, level_count, off, index_length,
+                         off + index_length, tiles_length)
+        off += index_length + tiles_length
+    return Header(version, flags, salt, content_id, source_format, tuple(levels), tiles, prefix, key_block,
+                  nonce_hdr, expiry_header, tag_hdr, expiry_offset, off)
+
+
+def verify_header(header: Header, allow_legacy: bool = False, cek: bytes = None) -> bool:
+    """Check the header tag; raises ValueError if the expiry was tampered with.
+
+    Returns True when the tag only verified under the legacy layout (expiry
+    sealed as ciphertext, no AAD), which is accepted if allow_legacy is set.
+    """
+    aes_hdr = AES_GCM(header_key(header, cek))
+    try:
+        aes_hdr.decrypt(header.nonce_hdr, header.tag_hdr, header.header_aad)
+        return False
+    except Exception:
+        if allow_legacy and header.version == VERSION_1:
+            try:
+                aes_hdr.decrypt(header.nonce_hdr, header.expiry_header + header.tag_hdr, b"")
+                return True
+            except Exception:
+                pass
+        raise ValueError("Invalid TTL format")
+
+
+def peek_header(path: str, allow_legacy: bool = False) -> Header:
+    """Read and authenticate only the header of a container."""
+    with open(path, "rb") as f:
+        prefix = f.read(PEEK_LEN)
+    header = parse_header(prefix)
+    verify_header(header, allow_legacy)
+    return header
+
+
+def wrap_cek(cek: bytes, prefix: bytes, kek: bytes = None, key_id: bytes = None) -> bytes:
+    """Key block for a wrapped container (defaults to the current KEK)."""
+    if kek is None:
+        kek, key_id = CURRENT_KEK, CURRENT_KEK_ID
+    nonce = os.urandom(NONCE_LEN)
+    sealed = AES_GCM(kek).encrypt(nonce, cek, prefix)
+    return key_id + nonce + sealed[-TAG_LEN:] + sealed[:-TAG_LEN]
+
+
+def unwrap_cek(header: Header, kek: bytes = None) -> bytes:
+    """Recover the CEK of a wrapped container; kek defaults to the keyring entry."""
+    block = header.key_block
+    key_id = block[:KEK_ID_LEN]
+    if kek is None:
+        kek = kek_for_id(key_id)
+    off = KEK_ID_LEN
+    nonce = block[off:off + NONCE_LEN]; off += NONCE_LEN
+    tag = block[off:off + TAG_LEN]; off += TAG_LEN
+    try:
+        return AES_GCM(kek).decrypt(nonce, block[off:] + tag, header.prefix)
+    except Exception:
+        raise ValueError("Key unwrap failed")
+
+
+def key_block_kek_id(header: Header) -> bytes:
+    return header.key_block[:KEK_ID_LEN]
+
+
+def header_key(header: Header, cek: bytes = None) -> bytes:
+    if header.wrapped:
+        return derive_key(cek or unwrap_cek(header), header.salt, HDR_INFO)
+    return derive_subkey(header.salt, HDR_INFO)
+
+
+def content_key(header: Header) -> bytes:
+    """Key for the body of a parsed container."""
+    if header.wrapped:
+        return unwrap_cek(header)
+    return derive_cek(header.salt)
+
+
+def split_body(header: Header, data: bytes) -> tuple:
+    """(nonce, tag, ciphertext) of the body in a whole-file buffer."""
+    if len(data) < header.min_length:
+        raise ValueError("Invalid TTL file (truncated)")
+    off = header.body_offset
+    return data[off:off + NONCE_LEN], data[off + NONCE_LEN:off + NONCE_LEN + TAG_LEN], data[off + NONCE_LEN + TAG_LEN:]
+
+
+def build_prefix_v2(salt: bytes, content_id: bytes = None, flags: int = 0, source_format: str = None,
+                    levels=(), tiles=None) -> bytes:
+    if content_id is None:
+        content_id = os.urandom(CONTENT_ID_LEN)
+    extra = b""
+    if source_format is not None:
+        flags |= FLAG_TRANSCODED
+        extra += bytes((SOURCE_FORMAT_CODES[source_format],))
+    if levels:
+        if len(levels) > MAX_LEVELS:
+            raise ValueError(f"At most {MAX_LEVELS} pyramid levels")
+        flags |= FLAG_PYRAMID
+        extra += bytes((len(levels),)) + b"".join(_LEVEL_ENTRY.pack(*entry) for entry in levels)
+    if tiles is not None:
+        flags |= FLAG_TILED
+        extra += _TILE_HEADER.pack(*tiles)
+    return MAGIC_V2 + bytes((VERSION_2, flags)) + salt + content_id + extra
+
+
+def level_aad(prefix: bytes, index: int) -> bytes:
+    """AAD of pyramid level index (0 = largest reduced level)."""
+    return prefix + bytes((index + 1,))
+
+
+def sealed_level_length(payload_len: int) -> int:
+    return NONCE_LEN + TAG_LEN + payload_len
+
+
+def select_level(header: Header, width: int = None, height: int = None):
+    """Index of the smallest level that fills a width x height box, or None.
+
+    A level fills the box if it is at least as wide or at least as tall as
+    the box (whichever bounds the fitted image). None means only the
+    full-size body will do.
+    """
+    if not width and not height:
+        return None
+    for index in range(len(header.levels) - 1, -1, -1):
+        level = header.levels[index]
+        if (width and level.width >= width) or (height and level.height >= height):
+            return index
+    return None
+
+
+def split_sealed(blob: bytes) -> tuple:
+    """(nonce, tag, ciphertext) of a nonce | tag | ciphertext record."""
+    return blob[:NONCE_LEN], blob[NONCE_LEN:NONCE_LEN + TAG_LEN], blob[NONCE_LEN + TAG_LEN:]
+
+
+def tile_aad(prefix: bytes, level: int, col: int, row: int) -> bytes:
+    return prefix + _TILE_KEY.pack(level, col, row)
+
+
+def tile_index_plaintext(lengths) -> bytes:
+    return struct.pack(f">{len(lengths)}I", *lengths)
+
+
+def tile_index_length(tile_count: int) -> int:
+    return sealed_level_length(4 * tile_count)
+
+
+def read_tile_index(f, header: Header, aes) -> list:
+    """Absolute (offset, length) of every tile, decrypted with aes (content key)."""
+    info = header.tiles
+    f.seek(info.index_offset)
+    blob = f.read(info.index_length)
+    if len(blob) != info.index_length:
+        raise ValueError("Invalid TTL file (truncated)")
+    nonce, tag, ct = split_sealed(blob)
+    try:
+        plain = aes.decrypt(nonce, ct + tag, header.prefix + TILE_INDEX_AAD)
+    except Exception:
+        raise ValueError("Authentication failed")
+    lengths = struct.unpack(f">{len(plain) // 4}I", plain)
+    if sum(lengths) != info.tiles_length:
+        raise ValueError("Invalid TTL tile index")
+    spans = []
+    off = info.tiles_offset
+    for length in lengths:
+        spans.append((off, length))
+        off += length
+    return spans
+
+
+def read_level(f, header: Header, index: int) -> tuple:
+    """(nonce, tag, ciphertext) of a pyramid level, read from an open file."""
+    level = header.levels[index]
+    f.seek(level.offset)
+    blob = f.read(level.length)
+    if len(blob) != level.length:
+        raise ValueError("Invalid TTL file (truncated)")
+    return split_sealed(blob)
+
+
+def seal_expiry_record(hdr_key: bytes, aad_prefix: bytes, expiry_ts: int) -> bytes:
+    """nonce | expiry | tag, authenticated over aad_prefix + expiry."""
+    expiry_header = struct.pack(">Q", expiry_ts)
+    nonce = os.urandom(NONCE_LEN)
+    tag = AES_GCM(hdr_key).encrypt(nonce, b"", aad_prefix + expiry_header)
+    return nonce + expiry_header + tag[-TAG_LEN:]
+
+
+def build_header_v2(expiry_ts: int, wrapped: bool = True, source_format: str = None,
+                    levels=(), tiles=None) -> tuple:
+    """(header bytes, body key, body AAD) for a new v2 container.
+
+    source_format names the input format of a transcoded body (see
+    SOURCE_FORMATS); None for a body stored as read. levels lists
+    (width, height, sealed length) of the pyramid levels, largest first;
+    tiles is (tile_size, width, height, levels, index length, tiles length).
+    """
+    salt = os.urandom(SALT_LEN)
+    if wrapped:
+        cek = os.urandom(CEK_LEN)
+        prefix = build_prefix_v2(salt, flags=FLAG_WRAPPED, source_format=source_format, levels=levels,
+                                 tiles=tiles)
+        key_block = wrap_cek(cek, prefix)
+        hdr_key = derive_key(cek, salt, HDR_INFO)
+    else:
+        cek = derive_cek(salt)
+        prefix = build_prefix_v2(salt, source_format=source_format, levels=levels, tiles=tiles)
+        key_block = b""
+        hdr_key = derive_subkey(salt, HDR_INFO)
+    return prefix + key_block + seal_expiry_record(hdr_key, prefix, expiry_ts), cek, prefix
+
+
+def rewrite_expiry(path: str, expiry_ts: int) -> Header:
+    """Replace the expiry record of a v2 container in place.
+
+    Only EXPIRY_RECORD_LEN bytes at a fixed offset inside the first sector
+    are written; the body and its tag are untouched.
+    """
+    with open(path, "r+b") as f:
+        header = parse_header(f.read(PEEK_LEN))
+        verify_header(header)
+        if header.version < VERSION_2:
+            raise ValueError("Container version 1 binds the body to its expiry")
+        record = seal_expiry_record(header_key(header), header.prefix, expiry_ts)
+        f.seek(header.expiry_offset)
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+    return parse_header(header.prefix + header.key_block + record)
+
+
+def rewrap_key_block(path: str, old_kek: bytes, new_kek: bytes, new_kek_id: bytes) -> bool:
+    """Rewrap a container's CEK under new_kek in place.
+
+    Returns False if the file is already wrapped under new_kek. Only the
+    key block is rewritten; the expiry record and body are bound to the CEK
+    and prefix, neither of which changes.
+    """
+    with open(path, "r+b") as f:
+        header = parse_header(f.read(PEEK_LEN))
+        if not header.wrapped:
+            raise ValueError("Container key is not wrapped")
+        if key_block_kek_id(header) == new_kek_id:
+            return False
+        cek = unwrap_cek(header, old_kek)
+        verify_header(header, cek=cek)
+        block = wrap_cek(cek, header.prefix, new_kek, new_kek_id)
+        f.seek(header.key_block_offset)
+        f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
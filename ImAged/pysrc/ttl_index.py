@@ -0,0 +1,361 @@
+"""
+Persistent index of verified .ttl header metadata.
+
+Entries are keyed by normalized path and only trusted while the file's
+mtime and size match what was recorded, so a directory listing needs one
+stat per file and a header read only for new or changed files. The index
+is stored encrypted (AES-GCM, key derived from the master key) because
+file names and expiry times are themselves sensitive.
+
+    index.bin: INDEX_MAGIC | salt(16) | nonce(12) | AESGCM(zlib(json))
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import config
+import metrics
+import ttl_format
+from crypto import derive_subkey
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b"IMIDX1"
+INDEX_INFO = b"ImAged INDEX"
+INDEX_FORMAT = 1
+TTL_SUFFIX = ".ttl"
+
+
+def _norm(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+class TTLIndex:
+    def __init__(self, path=None):
+        if path is None:
+            path = config.load_config().get("index_path") or (config.app_data_dir() / "index.bin")
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        self._entries = None
+        self._salt = None
+        self._dirty = False
+        self._tracked = {}
+        self._listeners = []
+
+    # -- listeners -------------------------------------------------------
+
+    def add_listener(self, callback):
+        """Register callback(changes) with changes = [(key, entry or None)]."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def _emit(self, changes):
+        # Called without the lock held so listeners may query the index
+        if not changes:
+            return
+        for callback in list(self._listeners):
+            try:
+                callback(changes)
+            except Exception as e:
+                logger.error(f"Index listener {callback!r} failed: {e}")
+
+    def items(self) -> list:
+        """Snapshot of (key, entry) pairs."""
+        with self._lock:
+            self._ensure_loaded()
+            return [(k, dict(v)) for k, v in self._entries.items()]
+
+    # -- persistence -----------------------------------------------------
+
+    def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            blob = self.path.read_bytes()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.warning(f"Could not read TTL index {self.path}: {e}")
+            return
+        try:
+            if blob[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError("bad magic")
+            off = len(INDEX_MAGIC)
+            salt, nonce = blob[off:off + 16], blob[off + 16:off + 28]
+            aes = AESGCM(derive_subkey(salt, INDEX_INFO))
+            doc = json.loads(zlib.decompress(aes.decrypt(nonce, blob[off + 28:], INDEX_MAGIC)))
+            if doc.get("format") != INDEX_FORMAT:
+                raise ValueError(f"unsupported format {doc.get('format')}")
+            self._entries = doc.get("entries", {})
+            self._salt = salt
+        except Exception as e:
+            # A corrupt or foreign index is only a cache; start over
+            logger.warning(f"Discarding unreadable TTL index {self.path}: {e}")
+            self._entries = {}
+
+    def flush(self):
+        """Write the index if it changed (temp file + atomic replace)."""
+        with self._lock:
+            if not self._dirty or self._entries is None:
+                return
+            if self._salt is None:
+                self._salt = os.urandom(16)
+            payload = zlib.compress(json.dumps(
+                {"format": INDEX_FORMAT, "entries": self._entries}, separators=(",", ":")
+            ).encode("utf-8"))
+            nonce = os.urandom(12)
+            sealed = AESGCM(derive_subkey(self._salt, INDEX_INFO)).encrypt(nonce, payload, INDEX_MAGIC)
+            self._dirty = False
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(INDEX_MAGIC + self._salt + nonce + sealed)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write TTL index {self.path}: {e}")
+            with self._lock:
+                self._dirty = True
+
+    # -- entries ---------------------------------------------------------
+
+    def _build_entry(self, path: str, st) -> dict:
+        entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+        try:
+            header = ttl_format.peek_header(path, allow_legacy=True)
+            entry.update({"valid": True, "expiry": header.expiry, "version": header.version})
+            if header.source_format:
+                entry["source_format"] = header.source_format
+        except (OSError, ValueError) as e:
+            entry.update({"valid": False, "error": str(e)})
+        return entry
+
+    def _lookup(self, key: str, st):
+        entry = self._entries.get(key)
+        if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            return entry
+        return None
+
+    def get(self, path: str) -> dict:
+        """Metadata for one file, reading its header only if not indexed."""
+        st = os.stat(path)
+        key = _norm(path)
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._lookup(key, st)
+        if entry is None:
+            entry = self._build_entry(path, st)
+            with self._lock:
+                self._entries[key] = entry
+                self._dirty = True
+            self._emit([(key, entry)])
+        return entry
+
+    def record(self, path: str, preserve=(), **fields):
+        """Index a file we just wrote or opened, merging known fields (e.g. dimensions).
+
+        Fields named in preserve are carried over from the previous entry even
+        if the file changed (e.g. dimensions across a header-only rewrite).
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        key = _norm(path)
+        with self._lock:
+            self._ensure_loaded()
+            previous = self._entries.get(key) or {}
+            entry = self._lookup(key, st)
+            if entry is None:
+                entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+                if "expiry" not in fields:
+                    entry = self._build_entry(path, st)
+                else:
+                    entry.update({"valid": True, "version": fields.get("version", ttl_format.VERSION_1)})
+            entry.update({k: previous[k] for k in preserve if k in previous})
+            entry.update({k: v for k, v in fields.items() if v is not None})
+            self._entries[key] = entry
+            self._dirty = True
+        self._emit([(key, entry)])
+
+    def forget(self, path: str) -> bool:
+        key = _norm(path)
+        with self._lock:
+            self._ensure_loaded()
+            if self._entries.pop(key, None) is None:
+                return False
+            self._dirty = True
+        self._emit([(key, None)])
+        return True
+
+    def paths_under(self, directory: str) -> list:
+        """Indexed paths anywhere below directory."""
+        prefix = _norm(directory).rstrip(os.sep) + os.sep
+        with self._lock:
+            self._ensure_loaded()
+            return [k for k in self._entries if k.startswith(prefix)]
+
+    def refresh(self, path: str):
+        """Re-index one file after a change notification.
+
+        Returns (description, is_new), or None if the file is gone (its entry
+        is dropped).
+        """
+        key = _norm(path)
+        with self._lock:
+            self._ensure_loaded()
+            is_new = key not in self._entries
+        try:
+            entry = self.get(path)
+        except OSError:
+            self.forget(path)
+            return None
+        return self.describe(path, os.path.basename(path), entry), is_new
+
+    def mark_tracked(self, directory: str, recursive: bool = False):
+        """Declare that a watcher keeps this directory's entries current.
+
+        Listings of a tracked directory are served from the index without
+        walking it.
+        """
+        with self._lock:
+            self._tracked[_norm(directory)] = recursive
+
+    def untrack(self, directory: str):
+        with self._lock:
+            self._tracked.pop(_norm(directory), None)
+
+    def _tracked_listing(self, directory: str, recursive: bool):
+        key = _norm(directory)
+        with self._lock:
+            tracked_recursive = self._tracked.get(key)
+            if tracked_recursive is None or (recursive and not tracked_recursive):
+                return None
+            self._ensure_loaded()
+            prefix = key.rstrip(os.sep) + os.sep
+            return [
+                (k, os.path.basename(k), entry) for k, entry in self._entries.items()
+                if k.startswith(prefix) and (recursive or os.sep not in k[len(prefix):])
+            ]
+
+    def list_directory(self, directory: str, recursive: bool = False) -> dict:
+        """Return header metadata for every .ttl file under directory."""
+        start = time.perf_counter()
+        tracked = self._tracked_listing(directory, recursive)
+        if tracked is not None:
+            metrics.inc("index.hits", len(tracked))
+            metrics.observe("op.list_ttl", time.perf_counter() - start)
+            tracked.sort(key=lambda item: item[1].lower())
+            return {
+                "files": [self.describe(path, name, entry) for path, name, entry in tracked],
+                "index_hits": len(tracked),
+                "index_misses": 0,
+            }
+
+        found = []
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for de in it:
+                        if recursive and de.is_dir(follow_symlinks=False):
+                            stack.append(de.path)
+                        elif de.name.lower().endswith(TTL_SUFFIX) and de.is_file():
+                            found.append((de.path, de.name, de.stat()))
+            except OSError as e:
+                if current == directory:
+                    raise
+                # One unreadable subdirectory should not sink the whole listing
+                logger.warning(f"Skipping {e.filename}: {e.strerror}")
+
+        hits = 0
+        misses = []
+        files = []
+        with self._lock:
+            self._ensure_loaded()
+            for path, name, st in found:
+                entry = self._lookup(_norm(path), st)
+                if entry is None:
+                    misses.append((path, name, st))
+                else:
+                    hits += 1
+                    files.append((path, name, entry))
+        for path, name, st in misses:
+            files.append((path, name, self._build_entry(path, st)))
+
+        changes = []
+        with self._lock:
+            for path, name, entry in files[hits:]:
+                self._entries[_norm(path)] = entry
+                changes.append((_norm(path), entry))
+            # Drop entries for files that disappeared from this directory
+            prefix = _norm(directory).rstrip(os.sep) + os.sep
+            present = {_norm(path) for path, _, _ in found}
+            stale = [k for k in self._entries
+                     if k.startswith(prefix) and k not in present
+                     and (recursive or os.sep not in k[len(prefix):])]
+            for k in stale:
+                del self._entries[k]
+                changes.append((k, None))
+            if misses or stale:
+                self._dirty = True
+        self._emit(changes)
+
+        if self._dirty:
+            self.flush()
+        metrics.inc("index.hits", hits)
+        metrics.inc("index.misses", len(misses))
+        metrics.observe("op.list_ttl", time.perf_counter() - start)
+
+        files.sort(key=lambda item: item[1].lower())
+        return {
+            "files": [self.describe(path, name, entry) for path, name, entry in files],
+            "index_hits": hits,
+            "index_misses": len(misses),
+        }
+
+    @staticmethod
+    def describe(path: str, name: str, entry: dict) -> dict:
+        result = {
+            "path": path,
+            "name": name,
+            "size": entry["size"],
+            "mtime": entry["mtime_ns"] / 1e9,
+            "valid": entry.get("valid", False),
+            "expiry": entry.get("expiry"),
+            "version": entry.get("version"),
+            "width": entry.get("width"),
+            "height": entry.get("height"),
+            "source_format": entry.get("source_format"),
+        }
+        if not result["valid"]:
+            result["error"] = entry.get("error")
+        return result
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> TTLIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TTLIndex()
+            atexit.register(_index.flush)
+        return _index
@@ -0,0 +1,340 @@
+"""
+Incremental change tracking for watched TTL directories.
+
+A TTLWatcher keeps the TTL index current for the directories it watches
+and reports batches of changes to a callback:
+
+    [{"type": "added" | "modified" | "removed", "path": ..., ...metadata}]
+
+On Linux the kernel's inotify interface is used (through ctypes, no extra
+dependency), and inotify-watched directories are marked as tracked in the
+index so LIST_TTL can answer from memory. Elsewhere, or if inotify is
+unavailable, a polling source diffs (mtime, size) snapshots of each
+directory every watch_poll_interval seconds.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+import config
+import metrics
+import ttl_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 2.0
+# Events for the same path within this window are coalesced into one change
+DEBOUNCE_SECONDS = 0.1
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _is_ttl(name: str) -> bool:
+    return name.lower().endswith(ttl_index.TTL_SUFFIX)
+
+
+def _walk_dirs(directory: str, recursive: bool):
+    yield directory
+    if not recursive:
+        return
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for de in it:
+                    if de.is_dir(follow_symlinks=False):
+                        stack.append(de.path)
+                        yield de.path
+        except OSError:
+            continue
+
+
+def _snapshot(directory: str, recursive: bool) -> dict:
+    snap = {}
+    for current in _walk_dirs(directory, recursive):
+        try:
+            with os.scandir(current) as it:
+                for de in it:
+                    if _is_ttl(de.name) and de.is_file():
+                        st = de.stat()
+                        snap[de.path] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            continue
+    return snap
+
+
+class _InotifySource:
+    name = "inotify"
+
+    def __init__(self, on_paths, on_overflow, indexed_under):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._on_paths = on_paths
+        self._on_overflow = on_overflow
+        self._indexed_under = indexed_under
+        self._wds = {}  # wd -> (directory, root)
+        self._roots = {}  # root -> recursive
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="imaged-inotify", daemon=True)
+        self._thread.start()
+
+    def _add_watch(self, directory: str, root: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch failed: {os.strerror(err)}", directory)
+        self._wds[wd] = (directory, root)
+
+    def watch(self, directory: str, recursive: bool):
+        with self._lock:
+            self._roots[directory] = recursive
+            for current in _walk_dirs(directory, recursive):
+                self._add_watch(current, directory)
+
+    def unwatch(self, directory: str):
+        with self._lock:
+            self._roots.pop(directory, None)
+            for wd, (_, root) in list(self._wds.items()):
+                if root == directory:
+                    self._libc.inotify_rm_watch(self._fd, wd)
+                    del self._wds[wd]
+
+    def _drop_watches(self, directory: str):
+        prefix = directory.rstrip(os.sep) + os.sep
+        with self._lock:
+            for wd, (current, _) in list(self._wds.items()):
+                if current == directory or current.startswith(prefix):
+                    self._libc.inotify_rm_watch(self._fd, wd)
+                    del self._wds[wd]
+
+    def _handle(self, wd: int, mask: int, name: str, pending: dict):
+        if mask & IN_Q_OVERFLOW:
+            with self._lock:
+                roots = dict(self._roots)
+            for root, recursive in roots.items():
+                self._on_overflow(root, recursive)
+            return
+        with self._lock:
+            located = self._wds.get(wd)
+            if mask & IN_IGNORED:
+                self._wds.pop(wd, None)
+        if located is None or not name:
+            return
+        directory, root = located
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            # New subdirectory in a recursive watch: watch it and pick up
+            # anything written before the watch was in place
+            if mask & (IN_CREATE | IN_MOVED_TO) and self._roots.get(root):
+                with self._lock:
+                    try:
+                        self._add_watch(path, root)
+                    except OSError as e:
+                        logger.warning(f"Could not watch {path}: {e}")
+                for found in _snapshot(path, True):
+                    pending[found] = time.monotonic()
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                # Subdirectory moved out or deleted: a moved inode keeps its
+                # watch and would go on reporting under the old path, and
+                # everything indexed below it is gone
+                self._drop_watches(path)
+                for gone in self._indexed_under(path):
+                    pending[gone] = time.monotonic()
+            return
+        if _is_ttl(name):
+            pending[path] = time.monotonic()
+
+    def _run(self):
+        pending = {}
+        buf_size = 64 * 1024
+        while not self._stopped:
+            timeout = DEBOUNCE_SECONDS if pending else None
+            try:
+                ready, _, _ = select.select([self._fd, self._wake_r], [], [], timeout)
+            except (OSError, ValueError):
+                break
+            if self._fd in ready:
+                try:
+                    data = os.read(self._fd, buf_size)
+                except BlockingIOError:
+                    data = b""
+                off = 0
+                while off + _EVENT_HEADER.size <= len(data):
+                    wd, mask, _cookie, name_len = _EVENT_HEADER.unpack_from(data, off)
+                    off += _EVENT_HEADER.size
+                    name = data[off:off + name_len].rstrip(b"\0").decode(sys.getfilesystemencoding(), "surrogateescape")
+                    off += name_len
+                    self._handle(wd, mask, name, pending)
+            now = time.monotonic()
+            due = [p for p, seen in pending.items() if now - seen >= DEBOUNCE_SECONDS]
+            if due:
+                for p in due:
+                    del pending[p]
+                self._on_paths(due)
+
+    def stop(self):
+        self._stopped = True
+        try:
+            os.write(self._wake_w, b"x")
+        except OSError:
+            pass
+        self._thread.join(timeout=2)
+        for fd in (self._fd, self._wake_r, self._wake_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class _PollingSource:
+    name = "polling"
+
+    def __init__(self, on_paths, interval: float):
+        self._on_paths = on_paths
+        self._interval = interval
+        self._roots = {}  # root -> (recursive, snapshot)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="imaged-dirpoll", daemon=True)
+        self._thread.start()
+
+    def watch(self, directory: str, recursive: bool):
+        snap = _snapshot(directory, recursive)
+        with self._lock:
+            self._roots[directory] = (recursive, snap)
+
+    def unwatch(self, directory: str):
+        with self._lock:
+            self._roots.pop(directory, None)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            with self._lock:
+                roots = dict(self._roots)
+            for root, (recursive, old) in roots.items():
+                new = _snapshot(root, recursive)
+                changed = [p for p, sig in new.items() if old.get(p) != sig]
+                changed.extend(p for p in old if p not in new)
+                with self._lock:
+                    if root in self._roots:
+                        self._roots[root] = (recursive, new)
+                if changed:
+                    self._on_paths(changed)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+
+class TTLWatcher:
+    """Watch directories, keep the index current and report changes."""
+
+    def __init__(self, on_changes, index: ttl_index.TTLIndex = None, backend: str = "auto",
+                 poll_interval: float = None):
+        self._on_changes = on_changes
+        self._index = index or ttl_index.get_index()
+        if poll_interval is None:
+            poll_interval = config.load_config().get("watch_poll_interval", DEFAULT_POLL_INTERVAL)
+        self._source = None
+        if backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+            try:
+                self._source = _InotifySource(self._apply, self._resync, self._index.paths_under)
+            except (OSError, AttributeError) as e:
+                if backend == "inotify":
+                    raise
+                logger.info(f"inotify unavailable ({e}), polling watched directories")
+        if self._source is None:
+            self._source = _PollingSource(self._apply, poll_interval)
+        self._watched = {}
+
+    @property
+    def backend(self) -> str:
+        return self._source.name
+
+    def watch(self, directory: str, recursive: bool = False) -> dict:
+        """Start watching; returns the initial listing (indexed as a side effect)."""
+        directory = os.path.abspath(directory)
+        if directory in self._watched:
+            self.unwatch(directory)
+        self._source.watch(directory, recursive)
+        self._watched[directory] = recursive
+        listing = self._index.list_directory(directory, recursive=recursive)
+        if self._source.name == "inotify":
+            self._index.mark_tracked(directory, recursive)
+        return listing
+
+    def unwatch(self, directory: str) -> bool:
+        directory = os.path.abspath(directory)
+        if self._watched.pop(directory, None) is None:
+            return False
+        self._source.unwatch(directory)
+        self._index.untrack(directory)
+        return True
+
+    def watched(self) -> dict:
+        return dict(self._watched)
+
+    def _apply(self, paths):
+        changes = []
+        for path in paths:
+            refreshed = self._index.refresh(path)
+            if refreshed is None:
+                changes.append({"type": "removed", "path": path, "name": os.path.basename(path)})
+                continue
+            description, is_new = refreshed
+            description["type"] = "added" if is_new else "modified"
+            changes.append(description)
+        if not changes:
+            return
+        metrics.inc("watch.changes", len(changes))
+        self._index.flush()
+        try:
+            self._on_changes(changes)
+        except Exception as e:
+            logger.error(f"Watch change callback failed: {e}")
+
+    def _resync(self, root: str, recursive: bool):
+        # The kernel queue overflowed, so events were lost: fall back to a
+        # walk of the tree until the next full listing
+        logger.warning(f"inotify queue overflow, rescanning {root}")
+        self._index.untrack(root)
+        listing = self._index.list_directory(root, recursive)
+        self._index.mark_tracked(root, recursive)
+        try:
+            self._on_changes([{"type": "resync", "path": root, "count": len(listing["files"])}])
+        except Exception as e:
+            logger.error(f"Watch change callback failed: {e}")
+
+    def stop(self):
+        self._source.stop()
+        for directory in list(self._watched):
+            self._index.untrack(directory)
+        self._watched.clear()